@@ -0,0 +1,275 @@
+"""Async read path: the public pages served from an ASGI event loop.
+
+The homepage, post and user pages and the tag pages are answered by async
+views over an async SQLAlchemy engine (asyncpg on Postgres, aiosqlite on
+SQLite), so a request waiting on the database holds a coroutine rather
+than a worker thread. Every other request, writes included, is handed to
+the regular Flask app in a thread pool.
+
+Serve it with an ASGI server, e.g. `uvicorn asgi:app`.
+
+The async views reuse the Flask app's URL map, templates, page cache,
+request hooks and query builders. Their statements run on the async
+engine, so they aren't counted by /metrics or the query checks.
+"""
+
+import io
+import sys
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import (abort, current_app, g, make_response, render_template,
+                   request)
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import HTTPException
+
+from app import (conditional, get_page_cache, get_cached_homepage_version,
+                 set_cached_homepage_version, HOMEPAGE_KEY)
+from models import (recent_posts_query, user_detail_query, user_posts_query,
+                    post_detail_query, tags_query, tag_detail_query,
+                    tag_posts_query, related_posts_query,
+                    related_tags_query, homepage_version_query,
+                    user_version_query, post_version_query,
+                    tag_version_query, TAG_ORDER, TAG_POPULAR_ORDER,
+                    POST_ORDER)
+from pagination import paginate_request_async
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_database_url(url):
+    """The async-driver equivalent of a SQLAlchemy database URL."""
+
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+def make_async_engine(config):
+    """An async engine for the database the Flask app uses."""
+
+    url = async_database_url(config['SQLALCHEMY_DATABASE_URI'])
+    options = {key: value
+               for key, value in config['SQLALCHEMY_ENGINE_OPTIONS'].items()
+               if key != 'connect_args'}
+
+    timeout = config['STATEMENT_TIMEOUT_MS']
+    if timeout and url.get_backend_name() == "postgresql":
+        options['connect_args'] = {
+            'server_settings': {'statement_timeout': str(timeout)}}
+
+    return create_async_engine(url, echo=config['SQLALCHEMY_ECHO'], **options)
+
+
+def get_session():
+    """The AsyncSession for this request, opened on first use."""
+
+    if 'async_session' not in g:
+        g.async_session = current_app.extensions['async_sessionmaker']()
+    return g.async_session
+
+
+async def first_or_404(query):
+    result = await get_session().execute(query.limit(1).statement)
+    obj = result.scalars().first()
+    if obj is None:
+        abort(404)
+    return obj
+
+
+async def fetch_version(statement):
+    return (await get_session().execute(statement)).one_or_none()
+
+
+############################# Views #############################################
+# Async twins of the read-only views in app.py, keyed by endpoint name.
+
+async def homepage_version():
+    version = get_cached_homepage_version()
+    if version is None:
+        version = list(await fetch_version(homepage_version_query()))
+        set_cached_homepage_version(version)
+    return version
+
+
+async def user_version(user_id):
+    return await fetch_version(user_version_query(user_id))
+
+
+async def post_version(post_id):
+    return await fetch_version(post_version_query(post_id))
+
+
+async def tag_version(tag_id):
+    return await fetch_version(tag_version_query(tag_id))
+
+
+@conditional(homepage_version)
+async def display_home():
+    page_cache = get_page_cache()
+    html = page_cache.get(HOMEPAGE_KEY)
+
+    if html is None:
+        result = await get_session().execute(recent_posts_query(5).statement)
+        html = render_template("posts/homepage.html",
+                               posts=result.scalars().all())
+        page_cache.set(HOMEPAGE_KEY, html)
+
+    return html
+
+
+@conditional(user_version)
+async def show_user_detail(user_id):
+    user = await first_or_404(user_detail_query(user_id))
+    posts = await paginate_request_async(
+        get_session(), user_posts_query(user_id), POST_ORDER, descending=True)
+
+    return render_template("user_detail.html", user=user, posts=posts)
+
+
+@conditional(post_version)
+async def show_post(post_id):
+    post = await first_or_404(post_detail_query(post_id))
+    related = await get_session().execute(related_posts_query(
+        post_id, current_app.config['RELATED_POSTS_LIMIT']).statement)
+
+    return render_template('posts/post_detail.html', post=post,
+                           tags=post.tags, related=related.scalars().all())
+
+
+async def list_tags():
+    sort = request.args.get('sort')
+    if sort == 'popular':
+        tags = await paginate_request_async(
+            get_session(), tags_query(), TAG_POPULAR_ORDER, descending=True)
+    else:
+        tags = await paginate_request_async(get_session(), tags_query(),
+                                            TAG_ORDER)
+
+    return render_template('tags/all.html', tags=tags, sort=sort)
+
+
+@conditional(tag_version)
+async def show_tag_detail(tag_id):
+    tag = await first_or_404(tag_detail_query(tag_id))
+    related = await get_session().execute(related_tags_query(
+        tag_id, current_app.config['RELATED_TAGS_LIMIT']).statement)
+    posts = await paginate_request_async(
+        get_session(), tag_posts_query(tag_id), POST_ORDER, descending=True)
+
+    return render_template('tags/detail.html', tag=tag,
+                           related=related.scalars().all(), posts=posts)
+
+
+ASYNC_VIEWS = {
+    "blog.display_home": display_home,
+    "blog.show_user_detail": show_user_detail,
+    "blog.show_post": show_post,
+    "blog.list_tags": list_tags,
+    "blog.show_tag_detail": show_tag_detail,
+}
+
+
+############################# ASGI ##############################################
+
+def wsgi_environ(scope):
+    """A WSGI environ for an ASGI HTTP request without a body."""
+
+    server = scope.get("server") or ("localhost", 80)
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if path.startswith(root_path):
+        path = path[len(root_path):]
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode().decode("latin-1"),
+        "PATH_INFO": path.encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    return environ
+
+
+class AsyncReadApp:
+    """ASGI app serving ASYNC_VIEWS natively and the rest through Flask."""
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.engine = make_async_engine(app.config)
+        app.extensions['async_sessionmaker'] = async_sessionmaker(
+            self.engine, expire_on_commit=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            with self.app.request_context(wsgi_environ(scope)) as ctx:
+                view = ASYNC_VIEWS.get(ctx.request.endpoint)
+                if view is not None:
+                    response = await self.dispatch(view, ctx.request.view_args)
+                    return await self.respond(
+                        response, send, head=scope["method"] == "HEAD")
+
+        await self.wsgi(scope, receive, send)
+
+    async def dispatch(self, view, view_args):
+        """Run an async view with Flask's request hooks around it."""
+
+        try:
+            response = self.app.preprocess_request()
+            if response is None:
+                response = await view(**view_args)
+            response = self.app.process_response(make_response(response))
+        except HTTPException as exc:
+            response = exc.get_response()
+        finally:
+            session = g.pop('async_session', None)
+            if session is not None:
+                await session.close()
+
+        return response
+
+    async def respond(self, response, send, head=False):
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": [(name.lower().encode("latin-1"),
+                         value.encode("latin-1"))
+                        for name, value in response.headers.items()],
+        })
+        await send({
+            "type": "http.response.body",
+            "body": b"" if head else response.get_data(),
+        })
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
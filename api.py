@@ -0,0 +1,412 @@
+"""JSON API for Blogly, version 1.
+
+Every collection supports:
+
+    GET    /api/v1/<things>            list, keyset paginated
+    POST   /api/v1/<things>            create one (object) or many (array)
+    PATCH  /api/v1/<things>            update many (array of objects with id)
+    GET    /api/v1/<things>/<id>       get one
+    PATCH  /api/v1/<things>/<id>       update one
+    DELETE /api/v1/<things>/<id>       delete one
+
+Reads accept ?fields=a,b,c to load and return only those fields, and batch
+writes are applied in a single transaction: all of them or none.
+"""
+
+from contextlib import contextmanager
+
+from flask import Blueprint, abort, jsonify, request
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only, selectinload
+from werkzeug.exceptions import HTTPException
+
+from models import (db, User, Post, Tag, PostTag, utcnow, set_post_tags,
+                    count_tag_pairs, retagged, soft_delete, USER_ORDER,
+                    TAG_ORDER, POST_ORDER)
+from pagination import paginate_request
+from search import highlight, search_query
+from vocabulary import resolve_tags
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+
+TYPE_NAMES = {str: "a string", int: "an integer"}
+
+
+def check_value(name, value, kind, nullable, length):
+    """400 unless `value` fits a column of that type, nullability and
+    length."""
+
+    if value is None:
+        if not nullable:
+            abort(400, f"{name} can't be null")
+    elif (isinstance(value, bool) and kind is not bool
+            or not isinstance(value, kind)):
+        abort(400, f"{name} must be {TYPE_NAMES.get(kind, kind.__name__)}")
+    elif length is not None and len(value) > length:
+        abort(400, f"{name} must be at most {length} characters")
+
+
+class Resource:
+    """How one model is exposed through the API."""
+
+    model = None
+    order = ()
+    descending = False
+    # readable fields that are plain columns
+    columns = ()
+    required = ()
+    writable = ()
+
+    @property
+    def fields(self):
+        return set(self.columns)
+
+    @property
+    def specs(self):
+        """(type, nullable, max length) of each writable column, read from
+        the model; required fields can't be null."""
+
+        table = self.model.__table__
+        return {name: (table.c[name].type.python_type,
+                       table.c[name].nullable and name not in self.required,
+                       getattr(table.c[name].type, "length", None))
+                for name in self.writable if name in table.c}
+
+    def requested_fields(self):
+        """The ?fields= the client asked for, defaulting to all of them."""
+
+        if 'fields' not in request.args:
+            return self.fields
+
+        fields = {f for f in request.args['fields'].split(",") if f}
+        unknown = fields - self.fields
+        if unknown:
+            abort(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+
+        return fields | {"id"}
+
+    def query(self, fields):
+        """A query loading only what `fields` (and the sort key) need."""
+
+        names = (fields & set(self.columns)) | {col.key for col in self.order}
+        attrs = [getattr(self.model, name) for name in sorted(names)]
+        return self.model.query.options(load_only(*attrs))
+
+    def to_dict(self, obj, fields):
+        data = {}
+        for name in fields:
+            value = getattr(obj, name)
+            if hasattr(value, "isoformat"):
+                value = value.isoformat()
+            data[name] = value
+        return data
+
+    def validate(self, data, partial=False):
+        """Check a request object, returning the writable values it sets."""
+
+        if not isinstance(data, dict):
+            abort(400, "Expected a JSON object")
+
+        unknown = set(data) - set(self.writable) - {"id"}
+        if unknown:
+            abort(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+
+        if not partial:
+            missing = [name for name in self.required if name not in data]
+            if missing:
+                abort(400, f"Missing fields: {', '.join(missing)}")
+
+        values = {name: data[name] for name in self.writable if name in data}
+        specs = self.specs
+        for name, value in values.items():
+            if name in specs:
+                check_value(name, value, *specs[name])
+        return values
+
+    def check_references(self, values):
+        """Hook run on a batch of validated values before they're written."""
+
+    def create(self, values):
+        obj = self.model(**values)
+        db.session.add(obj)
+        return obj
+
+    def update(self, obj, values):
+        for name, value in values.items():
+            setattr(obj, name, value)
+
+    def after_create(self, pairs):
+        """Hook run after a batch of new objects has been flushed."""
+
+    def after_update(self, pairs):
+        """Hook run after a batch of objects has been updated."""
+
+
+class UserResource(Resource):
+    model = User
+    order = USER_ORDER
+    columns = ("id", "first_name", "last_name", "full_name", "image_url",
+               "updated_at")
+    required = ("first_name", "last_name")
+    writable = ("first_name", "last_name", "image_url")
+
+
+class TagResource(Resource):
+    model = Tag
+    order = TAG_ORDER
+    columns = ("id", "name", "updated_at")
+    required = ("name",)
+    writable = ("name",)
+
+
+class PostResource(Resource):
+    model = Post
+    order = POST_ORDER
+    descending = True
+    columns = ("id", "title", "content", "excerpt", "word_count",
+               "created_at", "updated_at", "user_id", "author_name")
+    required = ("title", "content", "user_id")
+    writable = ("title", "content", "user_id", "tags")
+
+    @property
+    def fields(self):
+        return set(self.columns) | {"tags"}
+
+    def query(self, fields):
+        query = super().query(fields)
+        if "tags" in fields:
+            query = query.options(selectinload(Post.tags))
+        return query
+
+    def to_dict(self, obj, fields):
+        data = super().to_dict(obj, fields - {"tags"})
+        if "tags" in fields:
+            data["tags"] = [tag.name for tag in obj.tags]
+        return data
+
+    def validate(self, data, partial=False):
+        values = super().validate(data, partial)
+        tags = values.get("tags", [])
+        if (not isinstance(tags, list)
+                or not all(isinstance(tag, str) for tag in tags)):
+            abort(400, "tags must be a list of tag names")
+        return values
+
+    def check_references(self, values):
+        # one IN query for every author in the batch; deleted users 404 too
+        user_ids = {v["user_id"] for v in values if "user_id" in v}
+        if user_ids:
+            get_many(RESOURCES["users"], sorted(user_ids))
+
+    def create(self, values):
+        return super().create(
+            {k: v for k, v in values.items() if k != "tags"})
+
+    def update(self, obj, values):
+        super().update(obj, {k: v for k, v in values.items() if k != "tags"})
+        if "tags" in values:
+            # tag changes don't dirty the posts row
+            obj.updated_at = utcnow()
+
+    def after_create(self, pairs):
+        # one IN query for every tag in the batch, one INSERT for all rows
+        names = {name for _, values in pairs
+                 for name in values.get("tags", [])}
+        tag_ids = resolve_tags(names)
+        rows = [{"post_id": post.id, "tag_id": tag_ids[name]}
+                for post, values in pairs
+                for name in set(values.get("tags", []))
+                if name in tag_ids]
+        if rows:
+            db.session.execute(insert(PostTag), rows)
+            post_ids = [post.id for post, _ in pairs]
+            count_tag_pairs(post_ids, 1)
+            retagged(post_ids)
+
+    def after_update(self, pairs):
+        for post, values in pairs:
+            if "tags" in values:
+                set_post_tags(post.id, resolve_tags(values["tags"]).values())
+
+
+RESOURCES = {
+    "users": UserResource(),
+    "posts": PostResource(),
+    "tags": TagResource(),
+}
+
+COLLECTION = "/<any(users, posts, tags):kind>"
+
+
+@contextmanager
+def transaction():
+    """Commit the block's writes, turning constraint violations into 409s."""
+
+    try:
+        yield
+        db.session.commit()
+    except IntegrityError as exc:
+        db.session.rollback()
+        abort(409, str(exc.orig))
+
+
+def get_many(resource, ids):
+    """Load objects by id with one IN query, 404ing if any are missing."""
+
+    objs = {obj.id: obj for obj in
+            resource.model.query.filter(resource.model.id.in_(ids))}
+    missing = [i for i in ids if i not in objs]
+    if missing:
+        abort(404, f"Not found: {', '.join(map(str, missing))}")
+    return objs
+
+
+def serialize(resource, ids):
+    """Reload objects by id in one query and render them, in `ids` order.
+
+    Used after a commit, which expires everything in the session; touching
+    each object instead would reload them one query at a time.
+    """
+
+    fields = resource.fields
+    objs = {obj.id: obj for obj in resource.query(fields)
+            .filter(resource.model.id.in_(ids))}
+    return [resource.to_dict(objs[i], fields) for i in ids]
+
+
+@api.errorhandler(HTTPException)
+def handle_error(exc):
+    """Answer API errors with JSON rather than HTML pages."""
+
+    return jsonify(error=exc.name, message=exc.description), exc.code
+
+
+@api.get("/search")
+def search_posts():
+    """Ranked full-text search over posts, with highlighted snippets."""
+
+    terms = request.args.get('q', '').strip()
+    if not terms:
+        abort(400, "Missing q")
+
+    query, order = search_query(terms,
+                                tag=request.args.get('tag'),
+                                author=request.args.get('author', type=int))
+    page = paginate_request(query, order, descending=True)
+
+    return jsonify(data=[{"id": row.id,
+                          "title": row.title,
+                          "score": row.score,
+                          "snippet": str(highlight(row.snippet))}
+                         for row in page],
+                   next=page.next_cursor,
+                   prev=page.prev_cursor)
+
+
+@api.get(COLLECTION)
+def list_things(kind):
+    """List a collection, one page at a time."""
+
+    resource = RESOURCES[kind]
+    fields = resource.requested_fields()
+
+    page = paginate_request(resource.query(fields), resource.order,
+                            descending=resource.descending)
+
+    return jsonify(data=[resource.to_dict(obj, fields) for obj in page],
+                   next=page.next_cursor,
+                   prev=page.prev_cursor)
+
+
+@api.get(COLLECTION + "/<int:id>")
+def get_thing(kind, id):
+    """Get a single object."""
+
+    resource = RESOURCES[kind]
+    fields = resource.requested_fields()
+
+    obj = resource.query(fields).filter(resource.model.id == id).first_or_404()
+
+    return jsonify(data=resource.to_dict(obj, fields))
+
+
+@api.post(COLLECTION)
+def create_things(kind):
+    """Create an object, or an array of objects in one transaction."""
+
+    resource = RESOURCES[kind]
+    body = request.get_json(silent=True)
+    batch = isinstance(body, list)
+
+    values = [resource.validate(data) for data in (body if batch else [body])]
+    resource.check_references(values)
+
+    with transaction():
+        pairs = [(resource.create(v), v) for v in values]
+        db.session.flush()
+        resource.after_create(pairs)
+        ids = [obj.id for obj, _ in pairs]
+
+    created = serialize(resource, ids)
+
+    return jsonify(data=created if batch else created[0]), 201
+
+
+@api.patch(COLLECTION)
+def update_things(kind):
+    """Update an array of objects, each carrying its id, in one transaction."""
+
+    resource = RESOURCES[kind]
+    body = request.get_json(silent=True)
+
+    if not isinstance(body, list):
+        abort(400, "Expected a JSON array")
+    if not all(isinstance(data, dict) and isinstance(data.get("id"), int)
+               for data in body):
+        abort(400, "Every object needs an integer id")
+
+    ids = [data["id"] for data in body]
+    objs = get_many(resource, ids)
+
+    values = [resource.validate(data, partial=True) for data in body]
+    resource.check_references(values)
+
+    with transaction():
+        pairs = list(zip((objs[i] for i in ids), values))
+        for obj, v in pairs:
+            resource.update(obj, v)
+        resource.after_update(pairs)
+
+    return jsonify(data=serialize(resource, ids))
+
+
+@api.patch(COLLECTION + "/<int:id>")
+def update_thing(kind, id):
+    """Update a single object."""
+
+    resource = RESOURCES[kind]
+    obj = resource.model.query.get_or_404(id)
+
+    values = resource.validate(request.get_json(silent=True), partial=True)
+    resource.check_references([values])
+
+    with transaction():
+        resource.update(obj, values)
+        resource.after_update([(obj, values)])
+
+    return jsonify(data=serialize(resource, [id])[0])
+
+
+@api.delete(COLLECTION + "/<int:id>")
+def delete_thing(kind, id):
+    """Delete a single object."""
+
+    resource = RESOURCES[kind]
+    obj = resource.model.query.get_or_404(id)
+
+    with transaction():
+        soft_delete(obj)
+
+    return "", 204
@@ -1,52 +1,421 @@
 """Blogly application."""
 
+import hashlib
+import json
 import os
-
-from flask import Flask, redirect, render_template, request
+from datetime import datetime, timezone
+from functools import wraps
+from inspect import iscoroutinefunction
+from itertools import chain
+
+from flask import (Blueprint, Flask, Response, abort, current_app, g,
+                   has_app_context, make_response, redirect, render_template,
+                   request, stream_template, url_for)
 from flask_debugtoolbar import DebugToolbarExtension
-from models import db, connect_db, User, Post, Tag, PostTag
-from sqlalchemy import desc
+from flask_migrate import Migrate
+from models import (db, connect_db, User, Post, Tag,
+                    recent_posts_query, users_query, user_detail_query,
+                    latest_posts_query,
+                    user_posts_query, post_detail_query, tags_query,
+                    tag_detail_query, tag_posts_query,
+                    related_posts_query, related_tags_query,
+                    homepage_version, user_version, post_version,
+                    tag_version, utcnow, add_post_tags,
+                    set_post_tags, soft_delete, include_in_migrations,
+                    USER_ORDER, USER_POPULAR_ORDER, TAG_ORDER,
+                    TAG_POPULAR_ORDER, POST_ORDER)
+from pagination import paginate_request
+from api import api
+from config import CONFIGS
+from commands import cli
+from search import highlight, search_query
+from cache import make_cache, invalidate_on_commit, watch_session
+from metrics import init_metrics
+from querycheck import init_query_check, query_budget
+from templating import init_templates
+from jobs import enqueue, init_jobs, job, watch_jobs
+from vocabulary import (get_tag_vocabulary, init_tag_vocabulary,
+                        resolve_tags, watch_tags)
+from related import watch_related
+from replicas import (configure_replicas, init_replicas, reading_from_primary,
+                      watch_writes)
+from sqlalchemy import event, inspect
+
+blog = Blueprint("blog", __name__)
+migrate = Migrate()
+toolbar = DebugToolbarExtension()
+
+
+def create_app(config_name=None):
+    """Build a Blogly app using the named profile from config.py.
+
+    Defaults to the BLOGLY_CONFIG environment variable, else development.
+    """
+
+    config_name = config_name or os.environ.get("BLOGLY_CONFIG", "development")
+
+    app = Flask(__name__)
+    app.config.from_object(CONFIGS[config_name])
+
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError("SECRET_KEY must be set")
+
+    timeout = app.config['STATEMENT_TIMEOUT_MS']
+    if timeout and app.config['SQLALCHEMY_DATABASE_URI'].startswith("postgres"):
+        options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        options['connect_args'] = {
+            **options.get('connect_args', {}),
+            'options': f"-c statement_timeout={timeout}",
+        }
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    configure_replicas(app)
+    connect_db(app)
+    init_replicas(app, db)
+    migrate.init_app(app, db, include_object=include_in_migrations)
+
+    if app.config['DEBUG_TOOLBAR']:
+        toolbar.init_app(app)
+
+    app.extensions['page_cache'] = make_cache(app.config)
+    init_metrics(app)
+    init_query_check(app)
+    init_jobs(app)
+    init_tag_vocabulary(app)
+
+    app.register_blueprint(blog)
+    app.register_blueprint(api)
+    app.cli.add_command(cli)
+
+    # last, so templates compile against every registered filter
+    init_templates(app)
+
+    return app
+
+
+def get_page_cache():
+    """The current app's page cache."""
+
+    return current_app.extensions['page_cache']
+
+
+watch_session(db.session)
+watch_writes(db.session)
+watch_jobs(db.session)
+watch_tags(db.session)
+watch_related(db.session)
+
+HOMEPAGE_KEY = "homepage"
+HOMEPAGE_VERSION_KEY = "homepage:version"
+
+
+def _validators(version):
+    """The ETag and Last-Modified for a version row."""
+
+    etag = hashlib.sha1(repr(tuple(version)).encode()).hexdigest()
+    stamps = [v for v in version if isinstance(v, datetime)]
+    last_modified = (max(stamps).replace(tzinfo=timezone.utc)
+                     if stamps else None)
+    return etag, last_modified
+
+
+def _is_fresh(etag, last_modified):
+    """Whether the client's cached copy matches these validators."""
+
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    return (last_modified is not None
+            and request.if_modified_since is not None
+            and last_modified.replace(microsecond=0)
+            <= request.if_modified_since)
+
+
+def _finish(response, etag, last_modified):
+    if last_modified and response.status_code != 304:
+        response.last_modified = last_modified
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional(version_func):
+    """Answer GETs with 304 Not Modified when the client's copy is current.
+
+    `version_func` gets the view's URL arguments and returns a row of
+    timestamps and counts describing the page, or None if the resource is
+    missing. It runs before the view, so a 304 costs one aggregate query
+    and no relationship loading or template rendering. Async views take an
+    async `version_func`. Views can read the page's ETag as g.etag, e.g. to
+    key a cache entry by version.
+    """
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(**kwargs):
+                version = await version_func(**kwargs)
+                if version is None:
+                    abort(404)
+
+                etag, last_modified = _validators(version)
+                g.etag = etag
+                if _is_fresh(etag, last_modified):
+                    response = make_response("", 304)
+                else:
+                    response = make_response(await view(**kwargs))
+                return _finish(response, etag, last_modified)
+
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(**kwargs):
+            version = version_func(**kwargs)
+            if version is None:
+                abort(404)
+
+            etag, last_modified = _validators(version)
+            g.etag = etag
+            if _is_fresh(etag, last_modified):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(**kwargs))
+            return _finish(response, etag, last_modified)
+
+        return wrapper
+
+    return decorator
+
+
+def get_cached_homepage_version():
+    """The homepage version from the page cache, or None if it isn't there."""
+
+    cached = get_page_cache().get(HOMEPAGE_VERSION_KEY)
+    if cached is None:
+        return None
+    return [datetime.fromisoformat(v) if isinstance(v, str) else v
+            for v in json.loads(cached)]
+
+
+def set_cached_homepage_version(version):
+    get_page_cache().set(HOMEPAGE_VERSION_KEY, json.dumps(
+        [v.isoformat() if isinstance(v, datetime) else v for v in version]))
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
-    "DATABASE_URL", 'postgresql:///flask_blog')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
 
-connect_db(app)
+def cached_homepage_version():
+    """homepage_version(), kept in the page cache next to the page itself."""
 
-app.config['SECRET_KEY'] = "SECRET!"
-debug = DebugToolbarExtension(app)
+    version = get_cached_homepage_version()
+    if version is None:
+        with reading_from_primary():
+            version = list(homepage_version())
+        set_cached_homepage_version(version)
+    return version
 
 
-@app.get("/")
+def cached_homepage():
+    """The rendered homepage, from the page cache or rendered into it."""
+
+    page_cache = get_page_cache()
+    html = page_cache.get(HOMEPAGE_KEY)
+
+    if html is None:
+        # cached for everyone, so don't risk a lagging replica's copy
+        with reading_from_primary():
+            top_five_posts = recent_posts_query(5).all()
+            html = render_template("posts/homepage.html", posts=top_five_posts)
+        page_cache.set(HOMEPAGE_KEY, html)
+
+    return html
+
+
+@job
+def warm_homepage():
+    """Render the homepage back into the cache after a write dropped it,
+    so the next visitor doesn't wait for it. Only useful where the job
+    shares the web process' cache: the thread queue, or PAGE_CACHE=redis."""
+
+    with current_app.test_request_context("/"):
+        cached_homepage_version()
+        cached_homepage()
+
+
+@blog.get("/")
+@query_budget(2)
+@conditional(cached_homepage_version)
 def display_home():
-    """Displays 5 most recent posts. """
+    """Displays 5 most recent posts, from the page cache when it is fresh. """
+
+    return cached_homepage()
+
+
+@event.listens_for(db.session, "after_flush")
+def expire_homepage_on_flush(session, flush_context):
+    """Drop the cached homepage when a flush changes a post or an author."""
+
+    if not has_app_context():
+        return
+
+    def renamed(user):
+        state = inspect(user)
+        return (state.attrs.first_name.history.has_changes()
+                or state.attrs.last_name.history.has_changes())
+
+    if (any(isinstance(obj, Post)
+            for obj in chain(session.new, session.dirty, session.deleted))
+            or any(isinstance(obj, User) for obj in session.deleted)
+            or any(isinstance(obj, User) and renamed(obj)
+                   for obj in session.dirty)):
+        invalidate_on_commit(session, get_page_cache(),
+                             HOMEPAGE_KEY, HOMEPAGE_VERSION_KEY)
+        enqueue(session, "warm_homepage")
+
+
+@event.listens_for(db.session, "do_orm_execute")
+def expire_homepage_on_bulk_write(orm_execute_state):
+    """Drop the cached homepage after bulk INSERT/UPDATE/DELETE statements."""
+
+    state = orm_execute_state
+    if not has_app_context():
+        return
+
+    if ((state.is_insert or state.is_update or state.is_delete)
+            and state.bind_mapper in (Post.__mapper__, User.__mapper__)):
+        invalidate_on_commit(state.session, get_page_cache(),
+                             HOMEPAGE_KEY, HOMEPAGE_VERSION_KEY)
+        enqueue(state.session, "warm_homepage")
+
+
+############################# Feeds #############################################
+# Atom feeds of the newest posts: site-wide, per user and per tag. Each is
+# cached under its version's ETag, so any change to the feed's posts makes a
+# new entry and the old one simply ages out; polling clients get 304s.
+
+def atom_date(value):
+    """A naive UTC datetime as an RFC 3339 timestamp."""
 
-    top_five_posts = Post.query.order_by(desc('created_at')).limit(5)
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
 
-    return render_template("posts/homepage.html", posts=top_five_posts)
+
+blog.add_app_template_filter(atom_date)
+
+
+def cached_feed(render):
+    """The feed `render()` builds, from the page cache when it's current."""
+
+    page_cache = get_page_cache()
+    key = f"feed:{request.base_url}:{g.etag}"
+    xml = page_cache.get(key)
+
+    if xml is None:
+        xml = render()
+        page_cache.set(key, xml)
+
+    return Response(xml, mimetype="application/atom+xml")
+
+
+def render_feed(title, alternate, posts_query):
+    posts = latest_posts_query(posts_query,
+                               current_app.config['FEED_SIZE']).all()
+    updated = max((post.updated_at for post in posts), default=utcnow())
+
+    return render_template("feed.xml", title=title, alternate=alternate,
+                           posts=posts, updated=updated)
+
+
+@blog.get("/feed.xml")
+@query_budget(2)
+@conditional(cached_homepage_version)
+def site_feed():
+    """Feed of the newest posts."""
+
+    return cached_feed(lambda: render_feed(
+        "Blogly", url_for("blog.display_home", _external=True),
+        Post.query))
+
+
+@blog.get("/users/<int:user_id>/feed.xml")
+@query_budget(3)
+@conditional(user_version)
+def user_feed(user_id):
+    """Feed of a user's newest posts."""
+
+    def render():
+        user = user_detail_query(user_id).first_or_404()
+        return render_feed(
+            f"Blogly: {user.full_name}",
+            url_for("blog.show_user_detail", user_id=user_id, _external=True),
+            user_posts_query(user_id))
+
+    return cached_feed(render)
+
+
+@blog.get("/tags/<int:tag_id>/feed.xml")
+@query_budget(3)
+@conditional(tag_version)
+def tag_feed(tag_id):
+    """Feed of the newest posts carrying a tag."""
+
+    def render():
+        tag = tag_detail_query(tag_id).first_or_404()
+        return render_feed(
+            f"Blogly: {tag.name}",
+            url_for("blog.show_tag_detail", tag_id=tag_id, _external=True),
+            tag_posts_query(tag_id))
+
+    return cached_feed(render)
+
+
+############################# Search ############################################
+
+@blog.get("/search")
+def search():
+    """Search posts by title and content, optionally within a tag or author."""
+
+    terms = request.args.get('q', '').strip()
+    tag = request.args.get('tag') or None
+    author = request.args.get('author', type=int)
+
+    results = None
+    if terms:
+        query, order = search_query(terms, tag=tag, author=author)
+        results = paginate_request(query, order, descending=True)
+
+    return render_template('search.html', terms=terms, tag=tag,
+                           author=author, results=results)
+
+
+blog.add_app_template_filter(highlight)
 
 
 ############################# Users #############################################
 
-@app.get("/users")
+@blog.get("/users")
+@query_budget(1)
 def list_users():
-    """Show all users."""
+    """Show all users, by name or with ?sort=popular by number of posts.
+
+    The page is streamed: rows go out as they are read from the cursor.
+    """
 
-    users = User.query.order_by(User.last_name, User.first_name).all()
+    sort = request.args.get('sort')
+    if sort == 'popular':
+        users = paginate_request(users_query(), USER_POPULAR_ORDER,
+                                 descending=True, stream=True)
+    else:
+        users = paginate_request(users_query(), USER_ORDER, stream=True)
 
-    return render_template("users.html", users=users)
+    return stream_template("users.html", users=users, sort=sort)
 
 
-@app.get("/users/new")
+@blog.get("/users/new")
 def show_add_form():
     """Show an add form for users."""
 
     return render_template("new_user_form.html")
 
 
-@app.post("/users/new")
+@blog.post("/users/new")
 def add_user():
     """Process the add form, adding a new user and going back to /users."""
 
@@ -63,19 +432,20 @@ def add_user():
     return redirect("/users")
 
 
-@app.get("/users/<int:user_id>")
+@blog.get("/users/<int:user_id>")
+@query_budget(3)
+@conditional(user_version)
 def show_user_detail(user_id):
     """Show information about the given user."""
 
-    user = User.query.get_or_404(user_id)
+    user = user_detail_query(user_id).first_or_404()
+    posts = paginate_request(user_posts_query(user_id), POST_ORDER,
+                             descending=True)
 
-    print("user-id", user.id)
-    print("posts-in-user-detail", user.posts)
+    return render_template("user_detail.html", user=user, posts=posts)
 
-    return render_template("user_detail.html", user=user, posts=user.posts)
 
-
-@app.get("/users/<int:user_id>/edit")
+@blog.get("/users/<int:user_id>/edit")
 def show_edit_form(user_id):
     """Show the edit page for a user."""
 
@@ -84,30 +454,31 @@ def show_edit_form(user_id):
     return render_template("edit_user_form.html", user=user)
 
 
-@app.post("/users/<int:user_id>/edit")
+@blog.post("/users/<int:user_id>/edit")
 def edit_user(user_id):
     """Process the edit form, returning the user to the /users page."""
 
     user = User.query.get(user_id)
-    print("user", user)
 
     user.first_name = request.form['fname'] or user.first_name
     user.last_name = request.form['lname'] or user.last_name
     user.image_url = request.form['imgurl'] or user.image_url
 
+    # a rename reaches posts.author_name through the users trigger: one
+    # UPDATE of their posts, in this transaction
     db.session.commit()
 
     return redirect("/users")
 
 
-@app.post("/users/<int:user_id>/delete")
+@blog.post("/users/<int:user_id>/delete")
 def delete_user(user_id):
     """Delete the user."""
 
-    user = User.query.get(user_id)
-    db.session.delete(user)
+    user = User.query.get_or_404(user_id)
 
-    # User.query.filter(User.id == user_id).delete()
+    # soft-deletes their posts too; `flask blog purge` removes the rows
+    soft_delete(user)
     db.session.commit()
 
     return redirect("/users")
@@ -115,63 +486,64 @@ def delete_user(user_id):
 
 ############################# Posts #############################################
 
-@app.get("/users/<int:user_id>/posts/new")
+@blog.get("/users/<int:user_id>/posts/new")
 def show_new_post_form(user_id):
     """Show form to add a post for that user."""
 
     user = User.query.get_or_404(user_id)
-    tags = Tag.query.all()
+    tags = get_tag_vocabulary().tags
 
     return render_template('posts/new_post.html', user=user, tags=tags)
 
 
-@app.post("/users/<int:user_id>/posts/new")
+@blog.post("/users/<int:user_id>/posts/new")
 def handle_new_post(user_id):
     """Handle add form; add post and redirect to the user detail page."""
 
+    user = User.query.get_or_404(user_id)
+
     new_post = Post(title=request.form['title'],
                     content=request.form['content'],
-                    user_id=user_id)
+                    user_id=user.id)
 
     db.session.add(new_post)
-    db.session.commit()
-
-    # create a relationship with post
-    tags = request.form.getlist('tag')
+    db.session.flush()
 
-    for tag in tags:
-        tag_in_db = Tag.query.filter(Tag.name == tag).one()
+    # create a relationship with post, in the same transaction
+    tags = resolve_tags(request.form.getlist('tag'))
+    add_post_tags(new_post.id, tags.values())
 
-        new_post_tag = PostTag(
-            post_id=new_post.id,
-            tag_id=tag_in_db.id
-        )
-
-        db.session.add(new_post_tag)
-        db.session.commit()
+    db.session.commit()
 
     return redirect(f"/users/{user_id}")
 
 
-@app.get("/posts/<int:post_id>")
+@blog.get("/posts/<int:post_id>")
+@query_budget(4)
+@conditional(post_version)
 def show_post(post_id):
-    """Shows a post with tags and shows edit/delete buttons. """
+    """Shows a post with tags and related posts, and edit/delete buttons. """
 
-    post = Post.query.get_or_404(post_id)
+    post = post_detail_query(post_id).first_or_404()
     tags = post.tags
+    related = related_posts_query(
+        post_id, current_app.config['RELATED_POSTS_LIMIT']).all()
 
-    return render_template('posts/post_detail.html', post=post, tags=tags)
+    return render_template('posts/post_detail.html', post=post, tags=tags,
+                           related=related)
 
 
-@app.get("/posts/<int:post_id>/edit")
+@blog.get("/posts/<int:post_id>/edit")
+@query_budget(3)
 def edit_post(post_id):
     """Show form to edit a post, and to cancel back to user page."""
 
-    post = Post.query.get_or_404(post_id)
+    post = post_detail_query(post_id).first_or_404()
 
-    all_tags = Tag.query.all()
     post_tags = post.tags
-    other_tags = [tag for tag in all_tags if tag not in post_tags]
+    checked = {tag.id for tag in post_tags}
+    other_tags = [tag for tag in get_tag_vocabulary().tags
+                  if tag.id not in checked]
 
     return render_template('posts/post_edit.html',
                            post=post,
@@ -179,7 +551,7 @@ def edit_post(post_id):
                            other_tags=other_tags)
 
 
-@app.post("/posts/<int:post_id>/edit")
+@blog.post("/posts/<int:post_id>/edit")
 def handle_edit_post(post_id):
     """Handle editing of a post. Redirect back to the post view."""
 
@@ -187,29 +559,26 @@ def handle_edit_post(post_id):
 
     post.title = request.form['title']
     post.content = request.form['content']
+    # tag changes don't dirty the posts row, so bump its version by hand
+    post.updated_at = utcnow()
 
-    # get all checked tags
-    tags = request.form.getlist('tag')
-    # delete all tags related to the post
-    post.tags.clear()
-    for tag in tags:
-        tag_in_db = Tag.query.filter(Tag.name == tag).first()
-        new_tag_post = PostTag(post_id=post.id, tag_id=tag_in_db.id)
-        db.session.add(new_tag_post)
+    # only insert newly checked tags and delete unchecked ones
+    tags = resolve_tags(request.form.getlist('tag'))
+    set_post_tags(post.id, tags.values())
 
     db.session.commit()
 
     return redirect(f"/posts/{post_id}")
 
 
-@app.post("/posts/<int:post_id>/delete")
+@blog.post("/posts/<int:post_id>/delete")
 def delete_post(post_id):
     """Delete the post."""
 
     post = Post.query.get_or_404(post_id)
     user_id = post.user_id
 
-    db.session.delete(post)
+    soft_delete(post)
     db.session.commit()
 
     return redirect(f"/users/{user_id}")
@@ -217,23 +586,29 @@ def delete_post(post_id):
 
 ############################# Tags #############################################
 
-@app.get("/tags")
+@blog.get("/tags")
+@query_budget(1)
 def list_tags():
-    """Lists all tags. """
+    """Lists all tags, by name or with ?sort=popular by number of posts. """
 
-    tags = Tag.query.all()
+    sort = request.args.get('sort')
+    if sort == 'popular':
+        tags = paginate_request(tags_query(), TAG_POPULAR_ORDER,
+                                descending=True, stream=True)
+    else:
+        tags = paginate_request(tags_query(), TAG_ORDER, stream=True)
 
-    return render_template('tags/all.html', tags=tags)
+    return stream_template('tags/all.html', tags=tags, sort=sort)
 
 
-@app.get("/tags/new")
+@blog.get("/tags/new")
 def show_new_tag_form():
     """Show form for a new tag."""
 
     return render_template('tags/new.html')
 
 
-@app.post("/tags/new")
+@blog.post("/tags/new")
 def handle_new_tag():
     """Process add form, adds tag, and redirect to tag list."""
 
@@ -245,17 +620,23 @@ def handle_new_tag():
     return redirect("/tags")
 
 
-@app.get("/tags/<int:tag_id>")
+@blog.get("/tags/<int:tag_id>")
+@query_budget(4)
+@conditional(tag_version)
 def show_tag_detail(tag_id):
-    """Show detail about a tag. """
+    """Show detail about a tag and the tags used alongside it. """
 
-    tag = Tag.query.get_or_404(tag_id)
-    posts = tag.posts
+    tag = tag_detail_query(tag_id).first_or_404()
+    related = related_tags_query(
+        tag_id, current_app.config['RELATED_TAGS_LIMIT']).all()
+    posts = paginate_request(tag_posts_query(tag_id), POST_ORDER,
+                             descending=True, stream=True)
 
-    return render_template('tags/detail.html', tag=tag, posts=posts)
+    return stream_template('tags/detail.html', tag=tag, related=related,
+                           posts=posts)
 
 
-@app.get("/tags/<int:tag_id>/edit")
+@blog.get("/tags/<int:tag_id>/edit")
 def show_edit_tag_form(tag_id):
     """Show form to edit a tag. """
 
@@ -264,7 +645,7 @@ def show_edit_tag_form(tag_id):
     return render_template('tags/edit.html', tag=tag)
 
 
-@app.post("/tags/<int:tag_id>/edit")
+@blog.post("/tags/<int:tag_id>/edit")
 def handle_edit_tag(tag_id):
     """Handle tag edit. Redirect to tag list. """
 
@@ -278,13 +659,13 @@ def handle_edit_tag(tag_id):
     return redirect("/tags")
 
 
-@app.post("/tags/<int:tag_id>/delete")
+@blog.post("/tags/<int:tag_id>/delete")
 def delete_tag(tag_id):
     """Delete a tag."""
 
     tag = Tag.query.get_or_404(tag_id)
 
-    db.session.delete(tag)
+    soft_delete(tag)
     db.session.commit()
 
     return redirect("/tags")
@@ -0,0 +1,9 @@
+"""ASGI entry point, e.g. `uvicorn asgi:app --workers 4`.
+
+The public read pages are served by async views; see aio.py.
+"""
+
+from aio import AsyncReadApp
+from app import create_app
+
+app = AsyncReadApp(create_app())
@@ -0,0 +1,382 @@
+"""Benchmark every Blogly route and report latency, throughput and SQL use.
+
+Run against a database filled by `flask blog generate`, e.g.:
+
+    DATABASE_URL=postgresql:///blogly_bench python benchmark.py \
+        --requests 500 --server --concurrency 8 --output bench.json
+
+then compare two runs (say, before and after a change) with:
+
+    python benchmark.py --requests 500 --compare bench.json
+
+Production settings cache pages per process (PAGE_CACHE=lru); export
+PAGE_CACHE_URL=redis://... to benchmark with a shared Redis cache instead.
+
+--startup RUNS instead starts fresh processes, with templates compiled on
+first render, precompiled, and precompiled from a warm bytecode cache, and
+reports the median time to build the app and to answer each page's first
+request.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# production-like settings unless told otherwise; config.py reads these
+# at import time
+os.environ.setdefault("BLOGLY_CONFIG", "production")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+from flask import g, has_request_context  # noqa: E402
+from sqlalchemy import event, select  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from app import create_app  # noqa: E402
+from models import db, User, Post, Tag  # noqa: E402
+
+SQL_HEADER = "X-SQL-Statements"
+
+
+class Targets:
+    """Random ids to request, drawn from the rows that are live.
+
+    Picking from the whole id range would hit gaps and soft-deleted rows,
+    and their 404s would be counted as errors.
+    """
+
+    def __init__(self, rng):
+        self.rng = rng
+        # deleted rows are left out by models.exclude_deleted
+        self.ids = {
+            model: db.session.execute(
+                select(model.id).order_by(model.id)).scalars().all()
+            for model in (User, Post, Tag)}
+        self.tag_names = db.session.execute(
+            select(Tag.name).limit(20)).scalars().all()
+
+    def id(self, model):
+        ids = self.ids[model]
+        return self.rng.choice(ids) if ids else 0
+
+
+# (name, method, target -> (url, form data))
+ROUTES = [
+    ("display_home", "GET", lambda t: ("/", None)),
+    ("list_users", "GET", lambda t: ("/users", None)),
+    ("list_users_popular", "GET", lambda t: ("/users?sort=popular", None)),
+    ("show_user_detail", "GET",
+     lambda t: (f"/users/{t.id(User)}", None)),
+    ("show_post", "GET", lambda t: (f"/posts/{t.id(Post)}", None)),
+    ("edit_post", "GET", lambda t: (f"/posts/{t.id(Post)}/edit", None)),
+    ("list_tags", "GET", lambda t: ("/tags", None)),
+    ("show_tag_detail", "GET", lambda t: (f"/tags/{t.id(Tag)}", None)),
+    ("search", "GET", lambda t: ("/search?q=lorem+dolor", None)),
+    ("api_list_posts", "GET",
+     lambda t: ("/api/v1/posts?fields=id,title", None)),
+    ("handle_new_post", "POST",
+     lambda t: (f"/users/{t.id(User)}/posts/new", {
+         "title": "benchmark post",
+         "content": "benchmark content " * 50,
+         "tag": t.rng.sample(t.tag_names, min(3, len(t.tag_names))),
+     })),
+]
+
+
+def instrument(app):
+    """Report the number of SQL statements each request ran in a header."""
+
+    def count_statement(*args):
+        if has_request_context():
+            g.sql_statements = g.get("sql_statements", 0) + 1
+
+    # replicas too, or reads routed to them would go uncounted
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, "before_cursor_execute", count_statement)
+
+    @app.after_request
+    def add_sql_header(response):
+        response.headers[SQL_HEADER] = str(g.get("sql_statements", 0))
+        return response
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(samples, elapsed):
+    """Turn (seconds, statements, status) samples into report numbers."""
+
+    latencies = sorted(s[0] * 1000 for s in samples)
+    statements = [s[1] for s in samples]
+
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for s in samples if s[2] >= 400),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "requests_per_sec": round(len(samples) / elapsed, 1),
+        "sql_per_request": round(sum(statements) / len(statements), 2),
+    }
+
+
+def run_test_client(app, requests, targets):
+    """Drive each route in-process through the Flask test client."""
+
+    client = app.test_client()
+    results = {}
+
+    for name, method, target in ROUTES:
+        samples = []
+        started = time.perf_counter()
+
+        for _ in range(requests):
+            url, data = target(targets)
+            start = time.perf_counter()
+            resp = client.open(url, method=method, data=data)
+            resp.get_data()
+            samples.append((time.perf_counter() - start,
+                            int(resp.headers.get(SQL_HEADER, 0)),
+                            resp.status_code))
+
+        results[name] = summarize(samples, time.perf_counter() - started)
+
+    return results
+
+
+def run_server(app, requests, targets, concurrency):
+    """Drive each route over HTTP against a threaded WSGI server."""
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    opener = urllib.request.build_opener(NoRedirect)
+
+    def fetch(method, url, data):
+        body = (urllib.parse.urlencode(data, doseq=True).encode()
+                if data else None)
+        req = urllib.request.Request(base + url, data=body, method=method)
+        start = time.perf_counter()
+        try:
+            with opener.open(req) as resp:
+                resp.read()
+                status, headers = resp.status, resp.headers
+        except urllib.error.HTTPError as exc:
+            exc.read()
+            status, headers = exc.code, exc.headers
+        return (time.perf_counter() - start,
+                int(headers.get(SQL_HEADER, 0)), status)
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(concurrency) as pool:
+            for name, method, target in ROUTES:
+                calls = [target(targets) for _ in range(requests)]
+                started = time.perf_counter()
+                samples = list(pool.map(
+                    lambda call: fetch(method, *call), calls))
+                results[name] = summarize(samples,
+                                          time.perf_counter() - started)
+    finally:
+        server.shutdown()
+
+    return results
+
+
+STARTUP_VARIANTS = {
+    "lazy": {"TEMPLATE_PRECOMPILE": "off"},
+    "precompiled": {"TEMPLATE_PRECOMPILE": "on"},
+    # TEMPLATE_CACHE_DIR is filled in by run_startup
+    "bytecode_cache": {"TEMPLATE_PRECOMPILE": "on"},
+}
+
+
+def startup_probe():
+    """Time create_app() and each GET route's first request; print JSON.
+
+    Runs in a fresh process started by run_startup.
+    """
+
+    start = time.perf_counter()
+    app = create_app()
+    create_app_ms = (time.perf_counter() - start) * 1000
+
+    with app.app_context():
+        targets = Targets(random.Random(0))
+
+    client = app.test_client()
+    first_request_ms = {}
+    for name, method, target in ROUTES:
+        if method == "GET":
+            url, _ = target(targets)
+            start = time.perf_counter()
+            client.get(url).get_data()
+            first_request_ms[name] = (time.perf_counter() - start) * 1000
+
+    print(json.dumps({"create_app_ms": create_app_ms,
+                      "first_request_ms": first_request_ms}))
+
+
+def run_startup(runs):
+    """Median startup numbers per STARTUP_VARIANTS entry over `runs` fresh
+    processes, each variant after one untimed run to warm its caches."""
+
+    def probe(env):
+        start = time.perf_counter()
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--startup-probe"],
+            env={**os.environ, **env}, capture_output=True, text=True,
+            check=True).stdout
+        result = json.loads(out.splitlines()[-1])
+        result["process_ms"] = (time.perf_counter() - start) * 1000
+        return result
+
+    def median(values):
+        return round(statistics.median(values), 3)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, env in STARTUP_VARIANTS.items():
+            if name == "bytecode_cache":
+                env = {**env, "TEMPLATE_CACHE_DIR": cache_dir}
+            probe(env)
+            samples = [probe(env) for _ in range(runs)]
+
+            routes = samples[0]["first_request_ms"]
+            results[name] = {
+                "process_ms": median([s["process_ms"] for s in samples]),
+                "create_app_ms": median([s["create_app_ms"]
+                                         for s in samples]),
+                "first_requests_ms": median(
+                    [sum(s["first_request_ms"].values()) for s in samples]),
+                "first_request_ms": {
+                    route: median([s["first_request_ms"][route]
+                                   for s in samples])
+                    for route in routes},
+            }
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Print per-route changes in p50/p95 latency and SQL statements, or
+    per-variant changes in startup time."""
+
+    if "startup" in new:
+        print(f"{'variant':<22}{'create_app ms':>22}{'first requests ms':>22}")
+        for name, stats in new["startup"].items():
+            before = old.get("startup", {}).get(name)
+            if before:
+                cells = [f"{before[key]}->{stats[key]}"
+                         for key in ("create_app_ms", "first_requests_ms")]
+                print(f"{name:<22}{cells[0]:>22}{cells[1]:>22}")
+        return
+
+    print(f"{'route':<22}{'p50 ms':>18}{'p95 ms':>18}{'sql/req':>14}")
+    for name, stats in new["routes"].items():
+        before = old["routes"].get(name)
+        if not before:
+            continue
+        cells = []
+        for key in ("p50_ms", "p95_ms", "sql_per_request"):
+            cells.append(f"{before[key]}->{stats[key]}")
+        print(f"{name:<22}{cells[0]:>18}{cells[1]:>18}{cells[2]:>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per route")
+    parser.add_argument("--server", action="store_true",
+                        help="go through a real WSGI server over HTTP")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="client threads in --server mode")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="JSON report to compare against")
+    parser.add_argument("--startup", type=int, metavar="RUNS",
+                        help="compare cold starts with and without "
+                             "precompiled templates instead")
+    parser.add_argument("--startup-probe", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.startup_probe:
+        return startup_probe()
+
+    app = create_app()
+    instrument(app)
+
+    with app.app_context():
+        targets = Targets(random.Random(args.seed))
+        dataset = {model.__tablename__: db.session.query(model).count()
+                   for model in (User, Post, Tag)}
+
+    if args.startup:
+        mode, results = "startup", {"startup": run_startup(args.startup)}
+    elif args.server:
+        mode, results = "server", {"routes": run_server(
+            app, args.requests, targets, args.concurrency)}
+    else:
+        mode, results = "test_client", {"routes": run_test_client(
+            app, args.requests, targets)}
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "mode": mode,
+            "concurrency": args.concurrency if args.server else 1,
+            "requests_per_route": args.startup or args.requests,
+            "database": app.config['SQLALCHEMY_DATABASE_URI'].split(":")[0],
+            "dataset": dataset,
+        },
+        **results,
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""Bulk export and import of Blogly content.
+
+Export streams users, tags and posts out with server-side cursors, one
+batch at a time, as NDJSON (one file, each post carrying its tag names) or
+CSV (a directory with users.csv, tags.csv, posts.csv and posts_tags.csv).
+Import reads either back in batches: COPY on Postgres, executemany
+elsewhere. Memory use stays flat however big the dump is.
+
+Imported rows are appended: users and posts get fresh ids (their exported
+ids shifted past the current maximum, which keeps posts pointing at the
+right author), and tags are matched by name, so importing into a database
+that already has a tag reuses it.
+"""
+
+import csv
+import io
+import itertools
+import json
+import os
+import time
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import func, insert, select, text
+
+from models import (db, utcnow, summarize, tag_ids_by_name,
+                    DEFAULT_IMAGE_URL, User, Post, Tag, PostTag)
+
+USER_FIELDS = ("id", "first_name", "last_name", "image_url")
+TAG_FIELDS = ("id", "name")
+POST_FIELDS = ("id", "title", "content", "created_at", "user_id")
+POST_TAG_FIELDS = ("post_id", "tag")
+
+CSV_FILES = {
+    "user": ("users.csv", USER_FIELDS),
+    "tag": ("tags.csv", TAG_FIELDS),
+    "post": ("posts.csv", POST_FIELDS),
+    "post_tag": ("posts_tags.csv", POST_TAG_FIELDS),
+}
+
+
+############################# Writing ###########################################
+
+def next_id(model):
+    return (db.session.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def write_rows(model, rows, batch_size):
+    """Insert an iterable of row dicts in batches; returns the row count."""
+
+    table = model.__table__
+    rows = iter(rows)
+    count = 0
+
+    for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+        if db.engine.dialect.name == "postgresql":
+            columns = list(batch[0])
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in batch:
+                writer.writerow([row[c] for c in columns])
+            buffer.seek(0)
+
+            cursor = db.session.connection().connection.cursor()
+            cursor.copy_expert(
+                f"COPY {table.name} ({', '.join(columns)}) "
+                "FROM STDIN WITH (FORMAT csv)", buffer)
+        else:
+            db.session.execute(insert(table), batch)
+
+        db.session.commit()
+        count += len(batch)
+
+    return count
+
+
+def reset_sequence(model):
+    """Move a Postgres serial past ids we inserted explicitly."""
+
+    if db.engine.dialect.name == "postgresql":
+        table = model.__tablename__
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"(SELECT max(id) FROM {table}))"))
+        db.session.commit()
+
+
+############################# Export ############################################
+
+def _stream(statement, batch_size):
+    """Rows of `statement`, fetched `batch_size` at a time from the server."""
+
+    result = db.session.execute(
+        statement.execution_options(yield_per=batch_size))
+    for partition in result.partitions():
+        yield partition
+
+
+def _as_record(row):
+    return {key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in row._mapping.items()}
+
+
+def export_records(batch_size=1000, inline_tags=True):
+    """Yield (kind, record) for every user, tag and post.
+
+    With inline_tags, posts carry a "tags" list of names; otherwise the
+    post/tag pairs follow as separate "post_tag" records.
+    """
+
+    users = select(*[getattr(User, f) for f in USER_FIELDS]).order_by(User.id)
+    for partition in _stream(users, batch_size):
+        for row in partition:
+            yield "user", _as_record(row)
+
+    tags = select(*[getattr(Tag, f) for f in TAG_FIELDS]).order_by(Tag.id)
+    for partition in _stream(tags, batch_size):
+        for row in partition:
+            yield "tag", _as_record(row)
+
+    posts = select(*[getattr(Post, f) for f in POST_FIELDS]).order_by(Post.id)
+    for partition in _stream(posts, batch_size):
+        if inline_tags:
+            # one query for the tags of the whole batch
+            names = {}
+            pairs = db.session.execute(
+                select(PostTag.post_id, Tag.name)
+                .join(Tag, Tag.id == PostTag.tag_id)
+                .where(PostTag.post_id.in_([row.id for row in partition]))
+                .order_by(PostTag.post_id, Tag.name))
+            for post_id, name in pairs:
+                names.setdefault(post_id, []).append(name)
+
+        for row in partition:
+            record = _as_record(row)
+            if inline_tags:
+                record["tags"] = names.get(row.id, [])
+            yield "post", record
+
+    if not inline_tags:
+        # both ends joined, so neither a deleted post nor tag is exported
+        pairs = (select(PostTag.post_id, Tag.name.label("tag"))
+                 .join(Post, Post.id == PostTag.post_id)
+                 .join(Tag, Tag.id == PostTag.tag_id)
+                 .order_by(PostTag.post_id, PostTag.tag_id))
+        for partition in _stream(pairs, batch_size):
+            for row in partition:
+                yield "post_tag", _as_record(row)
+
+
+def export_ndjson(out, batch_size=1000):
+    """Write every record to the text stream `out`; returns counts by kind."""
+
+    counts = Counter()
+    for kind, record in export_records(batch_size):
+        out.write(json.dumps({"type": kind, **record}) + "\n")
+        counts[kind] += 1
+    return counts
+
+
+def export_csv(directory, batch_size=1000):
+    """Write one CSV file per kind into `directory`; returns counts."""
+
+    os.makedirs(directory, exist_ok=True)
+    counts = Counter()
+    files = {}
+
+    try:
+        writers = {}
+        for kind, (filename, fields) in CSV_FILES.items():
+            files[kind] = open(os.path.join(directory, filename), "w",
+                               newline="")
+            writers[kind] = csv.DictWriter(files[kind], fields)
+            writers[kind].writeheader()
+
+        for kind, record in export_records(batch_size, inline_tags=False):
+            writers[kind].writerow(record)
+            counts[kind] += 1
+    finally:
+        for f in files.values():
+            f.close()
+
+    return counts
+
+
+############################# Import ############################################
+
+def read_ndjson(lines):
+    """(kind, record) pairs from NDJSON lines."""
+
+    for line in lines:
+        if line.strip():
+            record = json.loads(line)
+            yield record.pop("type"), record
+
+
+def read_csv(directory):
+    """(kind, record) pairs from a directory written by export_csv."""
+
+    for kind, (filename, _) in CSV_FILES.items():
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            with open(path, newline="") as f:
+                for record in csv.DictReader(f):
+                    yield kind, record
+
+
+def _int_or_none(value):
+    return int(value) if value not in (None, "") else None
+
+
+class Importer:
+    """Appends (kind, record) pairs to the database in batches."""
+
+    def __init__(self, batch_size=10000):
+        self.batch_size = batch_size
+        self.user_offset = next_id(User) - 1
+        self.post_offset = next_id(Post) - 1
+        # tag name -> id, for every tag seen so far
+        self.tag_ids = {}
+        self.pending = {kind: [] for kind in CSV_FILES}
+        self.counts = Counter()
+        self.seconds = Counter()
+        self.new_tags = 0
+
+    def add(self, kind, record):
+        if kind not in self.pending:
+            raise ValueError(f"Unknown record type: {kind!r}")
+
+        self.pending[kind].append(record)
+        if kind == "post":
+            for name in record.get("tags") or ():
+                self.pending["post_tag"].append(
+                    {"post_id": record["id"], "tag": name})
+
+        for full in (kind, "post_tag"):
+            if len(self.pending[full]) >= self.batch_size:
+                self.flush(full)
+
+    def flush(self, kind):
+        # rows that the batch refers to must be written first
+        for before in {"post": ["user"],
+                       "post_tag": ["user", "post"]}.get(kind, []):
+            self.flush(before)
+
+        records, self.pending[kind] = self.pending[kind], []
+        if not records:
+            return
+
+        start = time.perf_counter()
+        count = getattr(self, f"_write_{kind}s")(records)
+        elapsed = time.perf_counter() - start
+
+        self.counts[kind] += count
+        self.seconds[kind] += elapsed
+
+    def finish(self):
+        """Write what's left and move sequences past the imported ids.
+
+        Returns rows and seconds per kind, plus how many tags were new.
+        """
+
+        for kind in CSV_FILES:
+            self.flush(kind)
+        reset_sequence(User)
+        reset_sequence(Post)
+
+        report = {kind: {"rows": self.counts[kind],
+                         "seconds": round(self.seconds[kind], 3)}
+                  for kind in CSV_FILES}
+        report["tag"]["new"] = self.new_tags
+        return report
+
+    def resolve_tags(self, names):
+        """Ids for tag names, creating the ones that don't exist yet."""
+
+        missing = {name for name in names if name not in self.tag_ids}
+        if missing:
+            found = tag_ids_by_name(missing)
+            new = missing - set(found)
+            if new:
+                db.session.execute(insert(Tag), [
+                    {"name": name, "updated_at": utcnow(), "post_count": 0}
+                    for name in sorted(new)])
+                found.update(tag_ids_by_name(new))
+                db.session.commit()
+                self.new_tags += len(new)
+            self.tag_ids.update(found)
+
+        return {name: self.tag_ids[name] for name in names}
+
+    def _write_users(self, records):
+        return write_rows(User, (
+            {"id": int(r["id"]) + self.user_offset,
+             "first_name": r["first_name"],
+             "last_name": r["last_name"],
+             "image_url": r.get("image_url") or DEFAULT_IMAGE_URL,
+             "updated_at": utcnow(),
+             "post_count": 0}
+            for r in records), self.batch_size)
+
+    def _write_tags(self, records):
+        self.resolve_tags({r["name"] for r in records})
+        return len(records)
+
+    def _write_posts(self, records):
+        def rows():
+            for r in records:
+                created_at = datetime.fromisoformat(r["created_at"])
+                user_id = _int_or_none(r.get("user_id"))
+                yield {"id": int(r["id"]) + self.post_offset,
+                       "title": r["title"],
+                       "content": r["content"],
+                       **summarize(r["content"]),
+                       "created_at": created_at,
+                       "updated_at": created_at,
+                       "user_id": (user_id + self.user_offset
+                                   if user_id is not None else None)}
+
+        return write_rows(Post, rows(), self.batch_size)
+
+    def _write_post_tags(self, records):
+        tag_ids = self.resolve_tags({r["tag"] for r in records})
+        pairs = {(int(r["post_id"]) + self.post_offset, tag_ids[r["tag"]])
+                 for r in records}
+        return write_rows(PostTag, (
+            {"post_id": post_id, "tag_id": tag_id}
+            for post_id, tag_id in sorted(pairs)), self.batch_size)
+
+
+def import_records(records, batch_size=10000):
+    """Append (kind, record) pairs; see Importer.finish for the report."""
+
+    importer = Importer(batch_size)
+    for kind, record in records:
+        importer.add(kind, record)
+    return importer.finish()
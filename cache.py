@@ -0,0 +1,168 @@
+"""Rendered-page caches for Blogly."""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+log = logging.getLogger("blogly.cache")
+
+
+class NullCache:
+    """Cache that never holds anything; used to switch caching off."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache:
+    """In-process least-recently-used cache with an optional TTL.
+
+    Each worker process has its own copy, so this only suits single-process
+    deployments or data that is invalidated in every worker.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return None
+
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """Cache shared by every worker, stored in Redis.
+
+    `client` is anything with Redis' get/set/delete/scan_iter methods, so a
+    local stand-in can be used in tests. The client raising one of `errors`
+    (say, Redis is down) is logged and the call treated as a miss: pages are
+    rendered uncached rather than failing.
+    """
+
+    def __init__(self, client, prefix="blogly:", ttl=None, errors=()):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.errors = errors
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except self.errors:
+            log.warning("page cache get failed", exc_info=True)
+            return None
+        return value.decode() if isinstance(value, bytes) else value
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.prefix + key, value, ex=self.ttl)
+        except self.errors:
+            log.warning("page cache set failed", exc_info=True)
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        try:
+            self.client.delete(*[self.prefix + key for key in keys])
+        except self.errors:
+            log.warning("page cache delete failed", exc_info=True)
+
+    def clear(self):
+        try:
+            keys = list(self.client.scan_iter(self.prefix + "*"))
+            if keys:
+                self.client.delete(*keys)
+        except self.errors:
+            log.warning("page cache clear failed", exc_info=True)
+
+
+def make_cache(config):
+    """Build the cache described by PAGE_CACHE* settings in `config`."""
+
+    backend = config.get('PAGE_CACHE', 'lru')
+    ttl = config.get('PAGE_CACHE_TTL')
+
+    if backend == 'none':
+        return NullCache()
+
+    if backend == 'lru':
+        return LRUCache(maxsize=config.get('PAGE_CACHE_SIZE', 128), ttl=ttl)
+
+    if backend == 'redis':
+        import redis
+
+        if not config.get('PAGE_CACHE_URL'):
+            raise ValueError("PAGE_CACHE=redis needs a PAGE_CACHE_URL")
+        client = redis.Redis.from_url(config['PAGE_CACHE_URL'])
+        return RedisCache(client, ttl=ttl, errors=redis.RedisError)
+
+    raise ValueError(f"Unknown PAGE_CACHE backend: {backend}")
+
+
+def invalidate_on_commit(session, cache, *keys):
+    """Drop `keys` from `cache` once the session's transaction commits.
+
+    Invalidating any earlier would let a concurrent request re-cache the old
+    rows before the write is visible; invalidating on rollback is pointless.
+    """
+
+    pending = session.info.setdefault('stale_cache_keys', {})
+    pending.setdefault(id(cache), (cache, set()))[1].update(keys)
+
+
+def _flush_stale_keys(session):
+    for cache, keys in session.info.pop('stale_cache_keys', {}).values():
+        cache.delete(*keys)
+
+
+def _forget_stale_keys(session):
+    session.info.pop('stale_cache_keys', None)
+
+
+def watch_session(session):
+    """Install the commit/rollback hooks invalidate_on_commit relies on."""
+
+    event.listen(session, 'after_commit', _flush_stale_keys)
+    event.listen(session, 'after_rollback', _forget_stale_keys)
@@ -0,0 +1,189 @@
+"""Maintenance commands, run as `flask blog <command>`."""
+
+import sys
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from bulk import (export_csv, export_ndjson, import_records, read_csv,
+                  read_ndjson)
+from datagen import generate
+from jobs import Worker
+from models import db, repair_post_counts
+from purge import purge_deleted
+from related import rebuild_related
+from templating import precompile_templates
+
+cli = AppGroup("blog", help="Blogly maintenance commands.")
+
+
+@cli.command("repair-counts")
+def repair_counts():
+    """Recompute users.post_count and tags.post_count from the data."""
+
+    users, tags = repair_post_counts()
+    db.session.commit()
+
+    click.echo(f"Fixed post counts on {users} users and {tags} tags.")
+
+
+@cli.command("purge")
+@click.option("--batch-size", type=int,
+              help="Rows per batch [PURGE_BATCH_SIZE].")
+@click.option("--rows-per-second", type=int,
+              help="Rate limit, 0 for none [PURGE_ROWS_PER_SECOND].")
+@click.option("--verbose", is_flag=True, help="Report every batch.")
+def purge(batch_size, rows_per_second, verbose):
+    """Hard-delete soft-deleted users, posts and tags, in batches."""
+
+    config = current_app.config
+    if batch_size is None:
+        batch_size = config['PURGE_BATCH_SIZE']
+    if rows_per_second is None:
+        rows_per_second = config['PURGE_ROWS_PER_SECOND']
+
+    def progress(table, rows):
+        click.echo(f"{table}: {rows} rows")
+
+    counts = purge_deleted(batch_size, rows_per_second,
+                           progress if verbose else None)
+    click.echo("Purged " + ", ".join(
+        f"{counts[table]} {table}"
+        for table in ("posts_tags", "related_posts", "tag_pairs", "posts",
+                      "tags", "users")) + ".")
+
+
+@cli.command("rebuild-related")
+def rebuild_related_command():
+    """Recompute tag_pairs and related_posts from posts_tags, e.g. after a
+    bulk import or generate."""
+
+    start = time.perf_counter()
+    counts = rebuild_related()
+    click.echo(f"Wrote {counts['tag_pairs']} tag pairs and "
+               f"{counts['related_posts']} related posts in "
+               f"{time.perf_counter() - start:.1f}s.")
+
+
+@cli.command("generate")
+@click.option("--users", default=1000, show_default=True)
+@click.option("--tags", default=100, show_default=True)
+@click.option("--posts", default=10000, show_default=True)
+@click.option("--max-tags-per-post", default=5, show_default=True)
+@click.option("--zipf", "zipf_s", default=1.1, show_default=True,
+              help="Zipf exponent for tag popularity.")
+@click.option("--content-words", default=200, show_default=True)
+@click.option("--batch-size", default=10000, show_default=True)
+@click.option("--seed", default=0, show_default=True)
+def generate_data(users, tags, posts, max_tags_per_post, zipf_s,
+                  content_words, batch_size, seed):
+    """Append a synthetic dataset, e.g. --posts 1000000 --users 100000;
+    follow it with rebuild-related."""
+
+    def progress(table, rows, seconds):
+        rate = rows / seconds if seconds else 0
+        click.echo(f"{table}: {rows} rows in {seconds:.1f}s ({rate:.0f}/s)")
+
+    generate(users=users, tags=tags, posts=posts,
+             max_tags_per_post=max_tags_per_post, zipf_s=zipf_s,
+             content_words=content_words, batch_size=batch_size, seed=seed,
+             progress=progress)
+
+
+@cli.command("compile-templates")
+@click.option("--cache-dir", help="Write bytecode here [TEMPLATE_CACHE_DIR].")
+def compile_templates(cache_dir):
+    """Compile every template, e.g. at build time to fill the bytecode
+    cache; exits with an error if any template is broken."""
+
+    if cache_dir:
+        current_app.config['TEMPLATE_CACHE_DIR'] = cache_dir
+    if current_app.jinja_env.cache is not None:
+        current_app.jinja_env.cache.clear()
+
+    count = precompile_templates(current_app)
+    where = current_app.config['TEMPLATE_CACHE_DIR']
+    click.echo(f"Compiled {count} templates"
+               + (f" into {where}." if where else "."))
+
+
+@cli.command("worker")
+@click.option("--batch-size", default=10, show_default=True,
+              help="Jobs claimed at a time.")
+@click.option("--poll-seconds", default=1.0, show_default=True,
+              help="Wait between polls when no job is due.")
+@click.option("--burst", is_flag=True,
+              help="Exit once no job is due instead of waiting for more.")
+def worker(batch_size, poll_seconds, burst):
+    """Run jobs from the jobs table (JOB_QUEUE=database); run as many
+    workers as you like."""
+
+    if current_app.config['JOB_QUEUE'] != "database":
+        raise click.ClickException(
+            "the worker runs jobs from the database queue; "
+            "set JOB_QUEUE=database")
+
+    runner = Worker(current_app._get_current_object(), batch_size,
+                    poll_seconds)
+    try:
+        count = runner.work(burst=burst)
+    except KeyboardInterrupt:
+        return
+    click.echo(f"Ran {count} jobs.")
+
+
+FORMAT = click.option(
+    "--format", "fmt", type=click.Choice(["ndjson", "csv"]), default="ndjson",
+    show_default=True,
+    help="ndjson: one file (- for stdin/stdout); csv: a directory of files.")
+
+
+@cli.command("export")
+@click.argument("path")
+@FORMAT
+@click.option("--batch-size", default=1000, show_default=True)
+def export_data(path, fmt, batch_size):
+    """Export all users, tags and posts to PATH."""
+
+    start = time.perf_counter()
+
+    if fmt == "csv":
+        counts = export_csv(path, batch_size)
+    elif path == "-":
+        counts = export_ndjson(sys.stdout, batch_size)
+    else:
+        with open(path, "w") as out:
+            counts = export_ndjson(out, batch_size)
+
+    seconds = time.perf_counter() - start
+    rows = sum(counts.values())
+    click.echo(f"Exported {dict(counts)} in {seconds:.1f}s "
+               f"({rows / seconds if seconds else 0:.0f} rows/s)", err=True)
+
+
+@cli.command("import")
+@click.argument("path")
+@FORMAT
+@click.option("--batch-size", default=10000, show_default=True)
+def import_data(path, fmt, batch_size):
+    """Append the users, tags and posts exported to PATH; follow it with
+    rebuild-related."""
+
+    if fmt == "csv":
+        report = import_records(read_csv(path), batch_size)
+    elif path == "-":
+        report = import_records(read_ndjson(sys.stdin), batch_size)
+    else:
+        with open(path) as lines:
+            report = import_records(read_ndjson(lines), batch_size)
+
+    # COPY doesn't go through the ORM, so nothing expired the cached pages
+    current_app.extensions['page_cache'].clear()
+
+    for kind, stats in report.items():
+        rate = stats["rows"] / stats["seconds"] if stats["seconds"] else 0
+        click.echo(f"{kind}: {stats['rows']} rows in {stats['seconds']:.1f}s "
+                   f"({rate:.0f}/s)")
+    click.echo(f"{report['tag']['new']} new tags.")
@@ -0,0 +1,136 @@
+"""Configuration profiles for Blogly.
+
+Pick one with the BLOGLY_CONFIG environment variable (development, testing
+or production), or pass its name to create_app().
+"""
+
+import os
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "DATABASE_URL", 'postgresql:///flask_blog')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    # per-statement limit in milliseconds, Postgres only; None for no limit
+    STATEMENT_TIMEOUT_MS = None
+
+    # read replicas, comma separated; GET requests read from them
+    REPLICA_URLS = [url for url in
+                    os.environ.get("DATABASE_REPLICA_URLS", "").split(",")
+                    if url]
+    REPLICA_CHECK_SECONDS = 10
+    # after a write, read the client's requests from the primary this long
+    # (longer than replication usually lags)
+    READ_YOUR_WRITES_SECONDS = 5
+
+    SECRET_KEY = os.environ.get("SECRET_KEY", "SECRET!")
+    DEBUG_TOOLBAR = False
+
+    PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 20))
+    MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 100))
+    # rows fetched per round trip when a list page is streamed
+    STREAM_BATCH_SIZE = 100
+
+    # compile every template at startup and never check them for changes;
+    # TEMPLATE_CACHE_DIR keeps the compiled bytecode across restarts
+    TEMPLATE_PRECOMPILE = os.environ.get("TEMPLATE_PRECOMPILE", "off") != "off"
+    TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR")
+
+    # where post-write jobs run: "thread", or "database" with `flask blog
+    # worker` running; see jobs.py
+    JOB_QUEUE = os.environ.get("JOB_QUEUE", "thread")
+    JOB_THREADS = 2
+    JOB_MAX_ATTEMPTS = 5
+    JOB_RETRY_SECONDS = 10
+    # a running job not finished by then is assumed lost and run again
+    JOB_TIMEOUT_SECONDS = 300
+
+    # `flask blog purge`: rows per batch, and a cap on rows deleted per
+    # second (0 for none) so a big purge doesn't swamp the database
+    PURGE_BATCH_SIZE = 1000
+    PURGE_ROWS_PER_SECOND = int(os.environ.get("PURGE_ROWS_PER_SECOND", 5000))
+
+    # how stale another process' tag changes may be on the post forms
+    TAG_CACHE_CHECK_SECONDS = 5
+
+    # related posts and tags shown per page, and how many of each tag's
+    # newest posts are compared when picking related posts; see related.py
+    RELATED_POSTS_LIMIT = 5
+    RELATED_TAGS_LIMIT = 5
+    RELATED_CANDIDATES = 100
+
+    # entries per Atom feed
+    FEED_SIZE = 20
+
+    PAGE_CACHE = os.environ.get("PAGE_CACHE", "lru")
+    PAGE_CACHE_URL = os.environ.get("PAGE_CACHE_URL")
+    PAGE_CACHE_TTL = 300
+
+    # request/SQL/template instrumentation and the /metrics endpoint
+    METRICS = os.environ.get("METRICS", "on") != "off"
+
+    # N+1 and slow-query detection: "log", "raise" or "off"
+    QUERY_CHECK = os.environ.get("QUERY_CHECK", "log")
+    # the same statement shape more often than this in one request is a loop
+    QUERY_REPEAT_LIMIT = 3
+    SLOW_QUERY_MS = 100
+
+
+class DevelopmentConfig(Config):
+    """Local development: log every statement and show the debug toolbar."""
+
+    SQLALCHEMY_ECHO = True
+    DEBUG_TOOLBAR = True
+
+
+class TestingConfig(Config):
+    """The test suite, against its own database."""
+
+    TESTING = True
+    # fail the tests on N+1 queries and blown query budgets
+    QUERY_CHECK = "raise"
+    # jobs wait for the test to run them
+    JOB_QUEUE = "manual"
+    JOB_RETRY_SECONDS = 0
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "TEST_DATABASE_URL", 'postgresql:///blogly_test')
+
+
+class ProductionConfig(Config):
+    """Serving real traffic, usually as several gunicorn workers.
+
+    Each worker gets its own pool of `pool_size` connections (plus up to
+    `max_overflow` under bursts), so size these against Postgres'
+    max_connections divided by the number of workers.
+    """
+
+    SECRET_KEY = os.environ.get("SECRET_KEY")
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": 10,
+        # replace connections the server or a proxy has silently dropped
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+    STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 5000))
+
+    # set PAGE_CACHE_URL to share one Redis cache between workers; with
+    # "lru" each worker only drops its own copy of a page after a write and
+    # the others serve it stale until PAGE_CACHE_TTL
+    PAGE_CACHE_URL = os.environ.get("PAGE_CACHE_URL")
+    PAGE_CACHE = os.environ.get("PAGE_CACHE",
+                                "redis" if PAGE_CACHE_URL else "lru")
+
+    TEMPLATE_PRECOMPILE = os.environ.get("TEMPLATE_PRECOMPILE", "on") != "off"
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+}
@@ -0,0 +1,104 @@
+"""Synthetic Blogly datasets for load testing.
+
+Rows are written in batches: with COPY on Postgres, with executemany
+elsewhere. Tag popularity follows a Zipf distribution, so a handful of tags
+carry most posts, as on a real blog.
+"""
+
+import itertools
+import random
+import time
+from datetime import timedelta
+
+from bulk import next_id, reset_sequence, write_rows
+from models import (utcnow, summarize, DEFAULT_IMAGE_URL, User, Post, Tag,
+                    PostTag)
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua ut enim "
+         "ad minim veniam quis nostrud exercitation ullamco laboris nisi "
+         "aliquip ex ea commodo consequat duis aute irure in reprehenderit "
+         "voluptate velit esse cillum fugiat nulla pariatur").split()
+
+
+def zipf_weights(n, s):
+    """Cumulative weights for ranks 1..n under Zipf's law with exponent s."""
+
+    return list(itertools.accumulate(1 / rank ** s for rank in range(1, n + 1)))
+
+
+def generate(users, tags, posts, max_tags_per_post=5, zipf_s=1.1,
+             content_words=200, days=365, batch_size=10000, seed=0,
+             progress=None):
+    """Append a synthetic dataset to the database.
+
+    Returns a dict of rows written per table plus elapsed seconds.
+    `progress`, if given, is called with (table, rows, seconds) per table.
+    """
+
+    if posts and not users:
+        raise ValueError("posts need at least one user to belong to")
+
+    rng = random.Random(seed)
+    report = {}
+
+    def timed(name, model, rows):
+        start = time.perf_counter()
+        count = write_rows(model, rows, batch_size)
+        if model is not PostTag:
+            reset_sequence(model)
+        elapsed = time.perf_counter() - start
+        report[name] = {"rows": count, "seconds": round(elapsed, 3)}
+        if progress:
+            progress(name, count, elapsed)
+
+    first_user = next_id(User)
+    first_tag = next_id(Tag)
+    first_post = next_id(Post)
+
+    timed("users", User, (
+        {"id": first_user + i,
+         "first_name": f"First{first_user + i}",
+         "last_name": f"Last{rng.randrange(users)}",
+         "image_url": DEFAULT_IMAGE_URL,
+         "updated_at": utcnow(),
+         "post_count": 0}
+        for i in range(users)))
+
+    timed("tags", Tag, (
+        {"id": first_tag + i,
+         "name": f"tag{first_tag + i}",
+         "updated_at": utcnow(),
+         "post_count": 0}
+        for i in range(tags)))
+
+    start = utcnow() - timedelta(days=days)
+    step = timedelta(days=days) / max(posts, 1)
+
+    def post_rows():
+        for i in range(posts):
+            content = " ".join(rng.choices(WORDS, k=content_words))
+            yield {"id": first_post + i,
+                   "title": " ".join(rng.choices(WORDS, k=5))[:50],
+                   "content": content,
+                   **summarize(content),
+                   "created_at": start + step * i,
+                   "updated_at": start + step * i,
+                   "user_id": first_user + rng.randrange(users)}
+
+    timed("posts", Post, post_rows())
+
+    cum_weights = zipf_weights(tags, zipf_s)
+    tag_ids = range(first_tag, first_tag + tags)
+
+    def post_tags():
+        for i in range(posts):
+            k = rng.randint(1, min(max_tags_per_post, tags))
+            chosen = set(rng.choices(tag_ids, cum_weights=cum_weights, k=k))
+            for tag_id in chosen:
+                yield {"post_id": first_post + i, "tag_id": tag_id}
+
+    if tags:
+        timed("posts_tags", PostTag, post_tags())
+
+    return report
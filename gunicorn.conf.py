@@ -0,0 +1,28 @@
+"""Gunicorn settings for serving Blogly in production."""
+
+import multiprocessing
+import os
+
+raw_env = ["BLOGLY_CONFIG=production"]
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY",
+                             multiprocessing.cpu_count() * 2 + 1))
+# import the app once in the master so workers fork with it ready
+preload_app = True
+
+
+def post_fork(server, worker):
+    """Give each worker its own connection pool.
+
+    With preload_app, anything the master opened while importing the app
+    would be inherited by every worker; sockets shared across processes
+    corrupt each other's conversations with Postgres. close=False drops the
+    inherited pool without closing connections that belong to the master.
+    """
+
+    from models import db
+
+    app = server.app.wsgi()
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
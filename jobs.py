@@ -0,0 +1,330 @@
+"""Background jobs for work that can wait until after a write commits.
+
+A job is a function registered with @job. Code that writes calls
+enqueue(session, "name", **kwargs) during its transaction, and the job is
+queued only if that transaction commits. JOB_QUEUE picks where jobs run:
+
+- "thread" (the default): a small thread pool in each web process. There
+  is nothing else to run, but jobs still queued when the process exits are
+  lost.
+- "database": rows in the jobs table, inserted in the writer's own
+  transaction and run by `flask blog worker` processes. Workers claim rows
+  with SELECT .. FOR UPDATE SKIP LOCKED, so any number of them can share
+  the queue, and jobs survive restarts.
+- "manual": held until run_pending() is called, for tests.
+
+A job that raises is tried JOB_MAX_ATTEMPTS times in all, waiting
+JOB_RETRY_SECONDS before the first retry and twice as long before each one
+after that. Jobs run in their own app context and session, so they commit
+their own writes. They should also be safe to run twice: a job whose worker
+died is run again after JOB_TIMEOUT_SECONDS.
+"""
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import delete, event, func, insert, select, update
+
+from models import db, utcnow, Job
+
+log = logging.getLogger("blogly.jobs")
+
+JOBS = {}
+
+
+def job(func):
+    """Register `func` as a job; it's queued and run by its name."""
+
+    JOBS[func.__name__] = func
+    return func
+
+
+def enqueue(session, name, **kwargs):
+    """Run job `name` with `kwargs` once `session` commits.
+
+    Queuing the same job with the same arguments more than once in a
+    transaction queues it once. `kwargs` must be JSON serializable.
+    """
+
+    if name not in JOBS:
+        raise KeyError(f"Unknown job: {name!r}")
+
+    queued = session.info.setdefault('queued_jobs', {})
+    key = (name, json.dumps(kwargs, sort_keys=True))
+    if key not in queued:
+        queue = current_app.extensions['jobs']
+        queued[key] = (queue, name, kwargs)
+        queue.add(session, name, kwargs)
+
+
+def _submit_queued(session):
+    for queue, name, kwargs in session.info.pop('queued_jobs', {}).values():
+        queue.committed(name, kwargs)
+
+
+def _forget_queued(session):
+    session.info.pop('queued_jobs', None)
+
+
+def watch_jobs(session):
+    """Install the commit/rollback hooks enqueue relies on."""
+
+    event.listen(session, 'after_commit', _submit_queued)
+    event.listen(session, 'after_rollback', _forget_queued)
+
+
+def run_job(app, name, kwargs):
+    """Run one job in a fresh app context; exceptions propagate."""
+
+    with app.app_context():
+        JOBS[name](**kwargs)
+
+
+def retry_delay(config, attempts):
+    """Seconds to wait after a job's `attempts`-th failed attempt."""
+
+    return config['JOB_RETRY_SECONDS'] * 2 ** (attempts - 1)
+
+
+############################# Queues ############################################
+
+class ThreadQueue:
+    """Runs jobs on a thread pool in this process."""
+
+    def __init__(self, app):
+        self.app = app
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._failed = 0
+
+    def add(self, session, name, kwargs):
+        pass
+
+    def committed(self, name, kwargs):
+        with self._lock:
+            if self._executor is None:
+                # started on first use, so forked web workers get their own
+                self._executor = ThreadPoolExecutor(
+                    self.app.config['JOB_THREADS'],
+                    thread_name_prefix="blogly-job")
+            self._pending += 1
+        self._executor.submit(self.run, name, kwargs)
+
+    def run(self, name, kwargs):
+        """Run a job, retrying it until it succeeds or runs out of tries."""
+
+        config = self.app.config
+        try:
+            for attempt in range(1, config['JOB_MAX_ATTEMPTS'] + 1):
+                try:
+                    run_job(self.app, name, kwargs)
+                    return
+                except Exception:
+                    log.exception("job %s%r failed (attempt %d)",
+                                  name, kwargs, attempt)
+                    if attempt < config['JOB_MAX_ATTEMPTS']:
+                        time.sleep(retry_delay(config, attempt))
+
+            with self._lock:
+                self._failed += 1
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def depth(self):
+        """Jobs submitted and not yet finished."""
+
+        return self._pending
+
+    def failed(self):
+        """Jobs that ran out of attempts since this process started."""
+
+        return self._failed
+
+    def shutdown(self):
+        """Wait for the running and queued jobs, then stop the threads."""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class ManualQueue(ThreadQueue):
+    """Holds committed jobs until run_pending() runs them, in the calling
+    thread; for tests."""
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.pending = []
+
+    def committed(self, name, kwargs):
+        with self._lock:
+            self._pending += 1
+        self.pending.append((name, kwargs))
+
+    def run_pending(self):
+        """Run the held jobs, and any they queue; returns how many ran."""
+
+        count = 0
+        while self.pending:
+            self.run(*self.pending.pop(0))
+            count += 1
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._pending -= len(self.pending)
+        self.pending.clear()
+
+
+class DatabaseQueue:
+    """Keeps jobs in the jobs table for `flask blog worker` to run."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def add(self, session, name, kwargs):
+        # in the writer's transaction, which may be mid-flush: a plain
+        # INSERT on its connection rather than session.add()
+        session.connection().execute(insert(Job.__table__), {
+            "name": name, "args": kwargs, "status": "queued",
+            "attempts": 0, "run_at": utcnow()})
+
+    def committed(self, name, kwargs):
+        pass
+
+    def depth(self):
+        return db.session.execute(
+            select(func.count()).where(Job.status == "queued")).scalar()
+
+    def failed(self):
+        return db.session.execute(
+            select(func.count()).where(Job.status == "failed")).scalar()
+
+
+QUEUES = {
+    "thread": ThreadQueue,
+    "manual": ManualQueue,
+    "database": DatabaseQueue,
+}
+
+
+def init_jobs(app):
+    """Set up the JOB_QUEUE backend and its queue-depth metrics."""
+
+    backend = app.config['JOB_QUEUE']
+    if backend not in QUEUES:
+        raise ValueError(f"Unknown JOB_QUEUE backend: {backend}")
+
+    queue = app.extensions['jobs'] = QUEUES[backend](app)
+
+    metrics = app.extensions.get('metrics')
+    if metrics is not None:
+        metrics.gauge("blogly_jobs_queued", "Jobs waiting to run.",
+                      queue.depth)
+        metrics.gauge("blogly_jobs_failed",
+                      "Jobs that failed every attempt.", queue.failed)
+
+    return queue
+
+
+############################# Worker ############################################
+
+class Worker:
+    """Runs jobs from the jobs table; see `flask blog worker`."""
+
+    def __init__(self, app, batch_size=10, poll_seconds=1.0):
+        self.app = app
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+
+    def requeue_stale(self):
+        """Put back jobs claimed by a worker that never finished them."""
+
+        timeout = self.app.config['JOB_TIMEOUT_SECONDS']
+        result = db.session.execute(
+            update(Job)
+            .where(Job.status == "running",
+                   Job.locked_at < utcnow() - timedelta(seconds=timeout))
+            .values(status="queued", locked_at=None))
+        db.session.commit()
+        return result.rowcount
+
+    def claim(self):
+        """Mark a batch of due jobs as running; returns them."""
+
+        jobs = db.session.execute(
+            select(Job)
+            .where(Job.status == "queued", Job.run_at <= utcnow())
+            .order_by(Job.run_at, Job.id)
+            .limit(self.batch_size)
+            # other workers skip the rows we lock instead of waiting
+            .with_for_update(skip_locked=True)).scalars().all()
+
+        now = utcnow()
+        claimed = []
+        for row in jobs:
+            row.status = "running"
+            row.locked_at = now
+            row.attempts += 1
+            claimed.append((row.id, row.name, row.args, row.attempts))
+        db.session.commit()
+
+        return claimed
+
+    def finish(self, job_id, attempts, error=None):
+        """Delete a job that ran; reschedule or give up on one that failed."""
+
+        if error is None:
+            db.session.execute(delete(Job).where(Job.id == job_id))
+        elif attempts >= self.app.config['JOB_MAX_ATTEMPTS']:
+            db.session.execute(
+                update(Job).where(Job.id == job_id)
+                .values(status="failed", locked_at=None,
+                        last_error=repr(error)))
+        else:
+            delay = retry_delay(self.app.config, attempts)
+            db.session.execute(
+                update(Job).where(Job.id == job_id)
+                .values(status="queued", locked_at=None,
+                        last_error=repr(error),
+                        run_at=utcnow() + timedelta(seconds=delay)))
+        db.session.commit()
+
+    def run_once(self):
+        """Claim and run one batch of jobs; returns how many ran."""
+
+        claimed = self.claim()
+        for job_id, name, kwargs, attempts in claimed:
+            try:
+                if name not in JOBS:
+                    raise KeyError(f"Unknown job: {name!r}")
+                run_job(self.app, name, kwargs)
+            except Exception as exc:
+                log.exception("job %s%r failed (attempt %d)",
+                              name, kwargs, attempts)
+                self.finish(job_id, attempts, exc)
+            else:
+                self.finish(job_id, attempts)
+
+        return len(claimed)
+
+    def work(self, burst=False):
+        """Run jobs as they come due. With `burst`, return once none are
+        due; returns the number of jobs run."""
+
+        count = 0
+        while True:
+            self.requeue_stale()
+            ran = self.run_once()
+            count += ran
+            if not ran:
+                if burst:
+                    return count
+                time.sleep(self.poll_seconds)
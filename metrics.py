@@ -0,0 +1,243 @@
+"""Request, SQL and template instrumentation for Blogly.
+
+When METRICS is on, every request records its latency, the number of SQL
+statements it ran and the time they took, and how long each template took
+to render. Totals are served in the Prometheus text format at /metrics and
+each request is logged as one JSON line on the "blogly.requests" logger.
+When it is off, none of the hooks are installed at all.
+
+Numbers are kept per process, so with several gunicorn workers each scrape
+sees the worker that answered it.
+"""
+
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import (Response, before_render_template, current_app, g,
+                   has_request_context, request, template_rendered)
+from sqlalchemy import event
+
+from models import db
+
+log = logging.getLogger("blogly.requests")
+
+# Prometheus' default histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+class Counter:
+    """A monotonically increasing value per label set."""
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum, per label set."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(
+                labels, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self._values[labels] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {k: (list(c), s) for k, (c, s) in self._values.items()}
+
+        names = self.labels + ("le",)
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield (f"{self.name}_bucket",
+                       _labels(names, labels + (bound,)), cumulative)
+            yield f"{self.name}_sum", _labels(self.labels, labels), total
+            yield f"{self.name}_count", _labels(self.labels, labels), cumulative
+
+
+class Gauge:
+    """A value read from a callback each time metrics are collected."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.func = func
+
+    def samples(self):
+        yield self.name, "", self.func()
+
+
+class Metrics:
+    """The set of metrics one app exposes."""
+
+    def __init__(self):
+        self.metrics = []
+
+        self.requests = self.add(Counter(
+            "blogly_http_requests_total", "Requests answered.",
+            ("endpoint", "method", "status")))
+        self.latency = self.add(Histogram(
+            "blogly_http_request_duration_seconds", "Time to answer a request.",
+            ("endpoint",)))
+        self.queries = self.add(Counter(
+            "blogly_db_queries_total", "SQL statements run by requests.",
+            ("endpoint",)))
+        self.db_time = self.add(Counter(
+            "blogly_db_seconds_total", "Time spent in SQL by requests.",
+            ("endpoint",)))
+        self.render_time = self.add(Histogram(
+            "blogly_template_render_seconds", "Time to render a template.",
+            ("template",)))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, func):
+        """Expose `func()` as a gauge, read on every scrape."""
+
+        return self.add(Gauge(name, help, func))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def get_metrics():
+    """The current app's metrics, or None when they are switched off."""
+
+    return current_app.extensions.get('metrics')
+
+
+def init_metrics(app):
+    """Install the instrumentation hooks and /metrics, if METRICS is on."""
+
+    if not app.config['METRICS']:
+        return None
+
+    metrics = app.extensions['metrics'] = Metrics()
+
+    def start_query(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def end_query(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        if has_request_context():
+            g.db_queries = g.get("db_queries", 0) + 1
+            g.db_seconds = g.get("db_seconds", 0) + elapsed
+
+    # the primary and any read replicas
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, "before_cursor_execute", start_query)
+            event.listen(engine, "after_cursor_execute", end_query)
+
+    def start_render(sender, template, context, **extra):
+        g.setdefault("render_start", []).append(time.perf_counter())
+
+    def end_render(sender, template, context, **extra):
+        elapsed = time.perf_counter() - g.render_start.pop()
+        metrics.render_time.observe(elapsed, template.name)
+        g.render_seconds = g.get("render_seconds", 0) + elapsed
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(end_render, app, weak=False)
+
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        g.db_queries = 0
+        g.db_seconds = 0
+        g.render_seconds = 0
+
+    @app.after_request
+    def record_request(response):
+        if "request_start" not in g:
+            return response
+
+        elapsed = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or "none"
+        queries = g.get("db_queries", 0)
+        db_seconds = g.get("db_seconds", 0)
+
+        metrics.requests.inc(endpoint, request.method, response.status_code)
+        metrics.latency.observe(elapsed, endpoint)
+        metrics.queries.inc(endpoint, amount=queries)
+        metrics.db_time.inc(endpoint, amount=db_seconds)
+
+        if log.isEnabledFor(logging.INFO):
+            log.info(json.dumps({
+                "method": request.method,
+                "path": request.path,
+                "endpoint": endpoint,
+                "status": response.status_code,
+                "ms": round(elapsed * 1000, 2),
+                "queries": queries,
+                "db_ms": round(db_seconds * 1000, 2),
+                "render_ms": round(g.get("render_seconds", 0) * 1000, 2),
+            }))
+
+        return response
+
+    @app.get("/metrics")
+    def show_metrics():
+        """Metrics in the Prometheus text format."""
+
+        return Response(metrics.render(),
+                        mimetype="text/plain; version=0.0.4")
+
+    return metrics
@@ -0,0 +1,42 @@
+"""indexes for hot query shapes
+
+Revision ID: 1430505a421e
+Revises: 5b38ff519a3c
+Create Date: 2026-10-18 18:45:33.850798
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1430505a421e'
+down_revision = '5b38ff519a3c'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_users_name', 'users', ['last_name', 'first_name', 'id']),
+    ('ix_posts_created_at', 'posts', ['created_at', 'id']),
+    ('ix_posts_user_id_created_at', 'posts', ['user_id', 'created_at', 'id']),
+    ('ix_posts_tags_tag_id', 'posts_tags', ['tag_id', 'post_id']),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, and doesn't
+    # block writes to the table while the index builds.
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns,
+                            postgresql_concurrently=True,
+                            if_not_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True,
+                          if_exists=True)
@@ -0,0 +1,66 @@
+"""post excerpts
+
+Revision ID: 3e8a6c0f4d21
+Revises: b7d3f1a9c2e6
+Create Date: 2026-10-18 21:40:07.913254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8a6c0f4d21'
+down_revision = 'b7d3f1a9c2e6'
+branch_labels = None
+depends_on = None
+
+# as models.EXCERPT_LENGTH and models.summarize when this was written
+EXCERPT_LENGTH = 280
+BATCH_SIZE = 1000
+
+posts = sa.table('posts', sa.column('id', sa.Integer),
+                 sa.column('content', sa.Text),
+                 sa.column('excerpt', sa.String),
+                 sa.column('word_count', sa.Integer))
+
+
+def summarize(content):
+    words = content.split()
+    excerpt = " ".join(words)
+    if len(excerpt) > EXCERPT_LENGTH:
+        head = excerpt[:EXCERPT_LENGTH]
+        cut = head.rsplit(" ", 1)[0] if " " in head else head[:-1]
+        excerpt = cut + "…"
+
+    return {"excerpt": excerpt, "word_count": len(words)}
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('excerpt',
+                                     sa.String(length=EXCERPT_LENGTH),
+                                     server_default='', nullable=False))
+    op.add_column('posts', sa.Column('word_count', sa.Integer(),
+                                     server_default='0', nullable=False))
+
+    # backfill in id order, a batch of rows in memory at a time
+    conn = op.get_bind()
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select(posts.c.id, posts.c.content)
+            .where(posts.c.id > last_id)
+            .order_by(posts.c.id)
+            .limit(BATCH_SIZE)).all()
+        if not rows:
+            break
+
+        conn.execute(
+            posts.update().where(posts.c.id == sa.bindparam('post_id')),
+            [{"post_id": row.id, **summarize(row.content)} for row in rows])
+        last_id = rows[-1].id
+
+
+def downgrade():
+    op.drop_column('posts', 'word_count')
+    op.drop_column('posts', 'excerpt')
@@ -0,0 +1,31 @@
+"""updated_at versions
+
+Revision ID: 423cd6d402fe
+Revises: 1430505a421e
+Create Date: 2026-10-18 18:48:15.382841
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '423cd6d402fe'
+down_revision = '1430505a421e'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ['users', 'posts', 'tags']
+
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(),
+                                       server_default=sa.func.now(),
+                                       nullable=False))
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_column(table, 'updated_at')
@@ -0,0 +1,117 @@
+"""post counters
+
+Revision ID: 640205ad5eab
+Revises: 6f7fd7ac87d4
+Create Date: 2026-10-18 18:55:33.165017
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '640205ad5eab'
+down_revision = '6f7fd7ac87d4'
+branch_labels = None
+depends_on = None
+
+
+POSTGRES_FUNCTION = """
+    CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            UPDATE {counted} SET post_count = post_count - 1
+            WHERE id = OLD.{column};
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            UPDATE {counted} SET post_count = post_count + 1
+            WHERE id = NEW.{column};
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+POSTGRES_TRIGGER = """
+    CREATE TRIGGER {name}
+    AFTER INSERT OR DELETE OR UPDATE OF {column} ON {table}
+    FOR EACH ROW EXECUTE FUNCTION {name}()
+"""
+
+SQLITE_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS {table}_count_insert
+    AFTER INSERT ON {table}
+    BEGIN
+        UPDATE {counted} SET post_count = post_count + 1
+        WHERE id = new.{column};
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_count_delete
+    AFTER DELETE ON {table}
+    BEGIN
+        UPDATE {counted} SET post_count = post_count - 1
+        WHERE id = old.{column};
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS {table}_count_update
+    AFTER UPDATE OF {column} ON {table}
+    BEGIN
+        UPDATE {counted} SET post_count = post_count - 1
+        WHERE id = old.{column};
+        UPDATE {counted} SET post_count = post_count + 1
+        WHERE id = new.{column};
+    END""",
+]
+
+# (trigger function, counted table, table whose rows are counted, its FK)
+COUNTERS = [
+    ('count_user_posts', 'users', 'posts', 'user_id'),
+    ('count_tag_posts', 'tags', 'posts_tags', 'tag_id'),
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    for _, counted, table, column in COUNTERS:
+        op.add_column(counted, sa.Column('post_count', sa.Integer(),
+                                         server_default='0', nullable=False))
+
+    # create the triggers before backfilling so no write slips between
+    for name, counted, table, column in COUNTERS:
+        fmt = dict(name=name, counted=counted, table=table, column=column)
+        if dialect == 'postgresql':
+            op.execute(POSTGRES_FUNCTION.format(**fmt))
+            op.execute(POSTGRES_TRIGGER.format(**fmt))
+        elif dialect == 'sqlite':
+            for trigger in SQLITE_TRIGGERS:
+                op.execute(trigger.format(**fmt))
+
+    for _, counted, table, column in COUNTERS:
+        op.execute(f"""
+            UPDATE {counted} SET post_count = (
+                SELECT count(*) FROM {table}
+                WHERE {table}.{column} = {counted}.id)
+        """)
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_post_count', 'users', ['post_count', 'id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_tags_post_count', 'tags', ['post_count', 'id'],
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    op.drop_index('ix_tags_post_count', table_name='tags')
+    op.drop_index('ix_users_post_count', table_name='users')
+
+    for name, counted, table, column in COUNTERS:
+        if dialect == 'postgresql':
+            op.execute(f"DROP TRIGGER IF EXISTS {name} ON {table}")
+            op.execute(f"DROP FUNCTION IF EXISTS {name}()")
+        elif dialect == 'sqlite':
+            for event in ('insert', 'delete', 'update'):
+                op.execute(f"DROP TRIGGER IF EXISTS {table}_count_{event}")
+
+        with op.batch_alter_table(counted) as batch_op:
+            batch_op.drop_column('post_count')
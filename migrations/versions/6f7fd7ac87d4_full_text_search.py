@@ -0,0 +1,83 @@
+"""full-text search
+
+Revision ID: 6f7fd7ac87d4
+Revises: 423cd6d402fe
+Create Date: 2026-10-18 18:53:53.818198
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f7fd7ac87d4'
+down_revision = '423cd6d402fe'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        # adding a stored generated column rewrites the table under an
+        # exclusive lock; run this one in a maintenance window
+        op.execute("""
+            ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(title, '')), 'A')
+                || setweight(to_tsvector('english', coalesce(content, '')), 'B')
+            ) STORED
+        """)
+        with op.get_context().autocommit_block():
+            op.execute("""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_search_vector
+                ON posts USING gin (search_vector)
+            """)
+
+    elif dialect == 'sqlite':
+        op.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+                title, content, content='posts', content_rowid='id',
+                tokenize='porter unicode61')
+        """)
+        op.execute("""
+            CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts
+            BEGIN
+                INSERT INTO posts_fts (rowid, title, content)
+                VALUES (new.id, new.title, new.content);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts
+            BEGIN
+                INSERT INTO posts_fts (posts_fts, rowid, title, content)
+                VALUES ('delete', old.id, old.title, old.content);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER IF NOT EXISTS posts_fts_update
+            AFTER UPDATE OF title, content ON posts
+            BEGIN
+                INSERT INTO posts_fts (posts_fts, rowid, title, content)
+                VALUES ('delete', old.id, old.title, old.content);
+                INSERT INTO posts_fts (rowid, title, content)
+                VALUES (new.id, new.title, new.content);
+            END
+        """)
+        op.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_posts_search_vector")
+        op.execute("ALTER TABLE posts DROP COLUMN IF EXISTS search_vector")
+
+    elif dialect == 'sqlite':
+        for trigger in ('posts_fts_insert', 'posts_fts_delete',
+                        'posts_fts_update'):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS posts_fts")
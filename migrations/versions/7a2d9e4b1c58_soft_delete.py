@@ -0,0 +1,350 @@
+"""soft delete
+
+Revision ID: 7a2d9e4b1c58
+Revises: 3e8a6c0f4d21
+Create Date: 2026-10-18 22:05:51.274630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a2d9e4b1c58'
+down_revision = '3e8a6c0f4d21'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ['users', 'posts', 'tags']
+
+LIVE = sa.text("deleted_at IS NULL")
+DELETED = sa.text("deleted_at IS NOT NULL")
+
+# (index, table, columns) to rebuild over live rows only
+LIVE_INDEXES = [
+    ('ix_users_name', 'users', ['last_name', 'first_name', 'id']),
+    ('ix_users_post_count', 'users', ['post_count', 'id']),
+    ('ix_posts_created_at', 'posts', ['created_at', 'id']),
+    ('ix_posts_user_id_created_at', 'posts', ['user_id', 'created_at', 'id']),
+    ('ix_tags_post_count', 'tags', ['post_count', 'id']),
+]
+
+POSTGRES_FUNCTIONS = [
+    """CREATE OR REPLACE FUNCTION count_user_posts() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' AND OLD.deleted_at IS NULL THEN
+            UPDATE users SET post_count = post_count - 1
+            WHERE id = OLD.user_id;
+        END IF;
+        IF TG_OP <> 'DELETE' AND NEW.deleted_at IS NULL THEN
+            UPDATE users SET post_count = post_count + 1
+            WHERE id = NEW.user_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION count_tag_posts() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            UPDATE tags SET post_count = post_count - 1
+            WHERE id = OLD.tag_id AND EXISTS (
+                SELECT 1 FROM posts
+                WHERE id = OLD.post_id AND deleted_at IS NULL);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            UPDATE tags SET post_count = post_count + 1
+            WHERE id = NEW.tag_id AND EXISTS (
+                SELECT 1 FROM posts
+                WHERE id = NEW.post_id AND deleted_at IS NULL);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION count_deleted_post_tags() RETURNS trigger
+    AS $$
+    BEGIN
+        IF (OLD.deleted_at IS NULL) <> (NEW.deleted_at IS NULL) THEN
+            UPDATE tags SET post_count = post_count
+                + CASE WHEN NEW.deleted_at IS NULL THEN 1 ELSE -1 END
+            WHERE id IN (
+                SELECT tag_id FROM posts_tags WHERE post_id = NEW.id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+]
+
+POSTGRES_TRIGGERS = [
+    """CREATE TRIGGER count_user_posts
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, deleted_at ON posts
+    FOR EACH ROW EXECUTE FUNCTION count_user_posts()""",
+    """CREATE TRIGGER count_deleted_post_tags
+    AFTER UPDATE OF deleted_at ON posts
+    FOR EACH ROW EXECUTE FUNCTION count_deleted_post_tags()""",
+    """CREATE TRIGGER bump_tags_version
+    AFTER INSERT OR DELETE OR UPDATE OF name, deleted_at ON tags
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_tags_version()""",
+]
+
+SQLITE_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS posts_count_insert
+    AFTER INSERT ON posts WHEN new.deleted_at IS NULL
+    BEGIN
+        UPDATE users SET post_count = post_count + 1 WHERE id = new.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_count_delete
+    AFTER DELETE ON posts WHEN old.deleted_at IS NULL
+    BEGIN
+        UPDATE users SET post_count = post_count - 1 WHERE id = old.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_count_update
+    AFTER UPDATE OF user_id, deleted_at ON posts
+    BEGIN
+        UPDATE users SET post_count = post_count - 1
+        WHERE id = old.user_id AND old.deleted_at IS NULL;
+        UPDATE users SET post_count = post_count + 1
+        WHERE id = new.user_id AND new.deleted_at IS NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_count_tags
+    AFTER UPDATE OF deleted_at ON posts
+    WHEN (old.deleted_at IS NULL) <> (new.deleted_at IS NULL)
+    BEGIN
+        UPDATE tags SET post_count = post_count
+            + CASE WHEN new.deleted_at IS NULL THEN 1 ELSE -1 END
+        WHERE id IN (SELECT tag_id FROM posts_tags WHERE post_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_tags_count_insert
+    AFTER INSERT ON posts_tags
+    BEGIN
+        UPDATE tags SET post_count = post_count + 1
+        WHERE id = new.tag_id AND EXISTS (
+            SELECT 1 FROM posts
+            WHERE id = new.post_id AND deleted_at IS NULL);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_tags_count_delete
+    AFTER DELETE ON posts_tags
+    BEGIN
+        UPDATE tags SET post_count = post_count - 1
+        WHERE id = old.tag_id AND EXISTS (
+            SELECT 1 FROM posts
+            WHERE id = old.post_id AND deleted_at IS NULL);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_tags_count_update
+    AFTER UPDATE OF tag_id ON posts_tags
+    BEGIN
+        UPDATE tags SET post_count = post_count - 1
+        WHERE id = old.tag_id AND EXISTS (
+            SELECT 1 FROM posts
+            WHERE id = old.post_id AND deleted_at IS NULL);
+        UPDATE tags SET post_count = post_count + 1
+        WHERE id = new.tag_id AND EXISTS (
+            SELECT 1 FROM posts
+            WHERE id = new.post_id AND deleted_at IS NULL);
+    END""",
+]
+
+SQLITE_COUNT_TRIGGERS = [
+    'posts_count_insert', 'posts_count_delete', 'posts_count_update',
+    'posts_count_tags', 'posts_tags_count_insert', 'posts_tags_count_delete',
+    'posts_tags_count_update',
+]
+
+SQLITE_TAGS_VERSION_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS tags_version_{event}
+    AFTER {operation} ON tags
+    BEGIN
+        UPDATE cache_versions SET version = version + 1 WHERE key = 'tags';
+    END
+"""
+
+# as in 640205ad5eab and b7d3f1a9c2e6, for the downgrade
+OLD_POSTGRES_FUNCTIONS = [
+    """CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            UPDATE {counted} SET post_count = post_count - 1
+            WHERE id = OLD.{column};
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            UPDATE {counted} SET post_count = post_count + 1
+            WHERE id = NEW.{column};
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""".format(name=name, counted=counted, column=column)
+    for name, counted, column in [('count_user_posts', 'users', 'user_id'),
+                                  ('count_tag_posts', 'tags', 'tag_id')]
+]
+
+OLD_POSTGRES_TRIGGERS = [
+    """CREATE TRIGGER count_user_posts
+    AFTER INSERT OR DELETE OR UPDATE OF user_id ON posts
+    FOR EACH ROW EXECUTE FUNCTION count_user_posts()""",
+    """CREATE TRIGGER bump_tags_version
+    AFTER INSERT OR DELETE OR UPDATE OF name ON tags
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_tags_version()""",
+]
+
+OLD_SQLITE_TRIGGERS = [
+    trigger.format(table=table, counted=counted, column=column)
+    for table, counted, column in [('posts', 'users', 'user_id'),
+                                   ('posts_tags', 'tags', 'tag_id')]
+    for trigger in [
+        """CREATE TRIGGER IF NOT EXISTS {table}_count_insert
+        AFTER INSERT ON {table}
+        BEGIN
+            UPDATE {counted} SET post_count = post_count + 1
+            WHERE id = new.{column};
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS {table}_count_delete
+        AFTER DELETE ON {table}
+        BEGIN
+            UPDATE {counted} SET post_count = post_count - 1
+            WHERE id = old.{column};
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS {table}_count_update
+        AFTER UPDATE OF {column} ON {table}
+        BEGIN
+            UPDATE {counted} SET post_count = post_count - 1
+            WHERE id = old.{column};
+            UPDATE {counted} SET post_count = post_count + 1
+            WHERE id = new.{column};
+        END""",
+    ]
+]
+
+# names the unnamed UNIQUE (name) that 5b38ff519a3c gave tags on SQLite
+SQLITE_NAMING = {"uq": "uq_%(table_name)s_%(column_0_name)s"}
+
+
+def sqlite_tags_version_triggers(update_columns):
+    for event, operation in [('insert', 'INSERT'), ('delete', 'DELETE'),
+                             ('update', f'UPDATE OF {update_columns}')]:
+        op.execute(f"DROP TRIGGER IF EXISTS tags_version_{event}")
+        op.execute(SQLITE_TAGS_VERSION_TRIGGER.format(event=event,
+                                                      operation=operation))
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    for table in TABLES:
+        op.add_column(table, sa.Column('deleted_at', sa.DateTime(),
+                                       nullable=True))
+
+    if dialect == 'postgresql':
+        for function in POSTGRES_FUNCTIONS:
+            op.execute(function)
+        op.execute("DROP TRIGGER IF EXISTS count_user_posts ON posts")
+        op.execute("DROP TRIGGER IF EXISTS bump_tags_version ON tags")
+        for trigger in POSTGRES_TRIGGERS:
+            op.execute(trigger)
+
+        # build each partial index next to the full one, then swap them, so
+        # no query goes without an index in between
+        with op.get_context().autocommit_block():
+            op.create_index('ix_tags_name', 'tags', ['name'], unique=True,
+                            postgresql_where=LIVE,
+                            postgresql_concurrently=True)
+            for name, table, columns in LIVE_INDEXES:
+                op.create_index(f'{name}_live', table, columns,
+                                postgresql_where=LIVE,
+                                postgresql_concurrently=True)
+                op.drop_index(name, table_name=table,
+                              postgresql_concurrently=True)
+                op.execute(f"ALTER INDEX {name}_live RENAME TO {name}")
+            for table in TABLES:
+                op.create_index(f'ix_{table}_deleted_at', table,
+                                ['deleted_at'], postgresql_where=DELETED,
+                                postgresql_concurrently=True)
+
+        op.drop_constraint('tags_name_key', 'tags', type_='unique')
+
+    elif dialect == 'sqlite':
+        # SQLite can't drop a constraint in place, so tags is copied; the
+        # copy loses its own triggers, and the rename fails while other
+        # tables' triggers refer to tags, so all of them are made again
+        for trigger in SQLITE_COUNT_TRIGGERS:
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        with op.batch_alter_table('tags', recreate='always',
+                                  naming_convention=SQLITE_NAMING) as batch_op:
+            batch_op.drop_constraint('uq_tags_name', type_='unique')
+        for trigger in SQLITE_TRIGGERS:
+            op.execute(trigger)
+        sqlite_tags_version_triggers('name, deleted_at')
+
+        op.create_index('ix_tags_name', 'tags', ['name'], unique=True,
+                        sqlite_where=LIVE)
+        for name, table, columns in LIVE_INDEXES:
+            op.drop_index(name, table_name=table)
+            op.create_index(name, table, columns, sqlite_where=LIVE)
+        for table in TABLES:
+            op.create_index(f'ix_{table}_deleted_at', table, ['deleted_at'],
+                            sqlite_where=DELETED)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    # the old schema can't hide deleted rows, so they go now, while the
+    # counters still know to skip them
+    op.execute("""
+        DELETE FROM posts_tags
+        WHERE post_id IN (SELECT id FROM posts WHERE deleted_at IS NOT NULL)
+        OR tag_id IN (SELECT id FROM tags WHERE deleted_at IS NOT NULL)
+    """)
+    op.execute("DELETE FROM posts WHERE deleted_at IS NOT NULL")
+    op.execute("DELETE FROM tags WHERE deleted_at IS NOT NULL")
+    op.execute("""
+        UPDATE posts SET user_id = NULL
+        WHERE user_id IN (SELECT id FROM users WHERE deleted_at IS NOT NULL)
+    """)
+    op.execute("DELETE FROM users WHERE deleted_at IS NOT NULL")
+
+    if dialect == 'postgresql':
+        op.execute("DROP TRIGGER IF EXISTS count_user_posts ON posts")
+        op.execute("DROP TRIGGER IF EXISTS count_deleted_post_tags ON posts")
+        op.execute("DROP TRIGGER IF EXISTS bump_tags_version ON tags")
+        op.execute("DROP FUNCTION IF EXISTS count_deleted_post_tags()")
+        for function in OLD_POSTGRES_FUNCTIONS:
+            op.execute(function)
+        for trigger in OLD_POSTGRES_TRIGGERS:
+            op.execute(trigger)
+
+        op.create_unique_constraint('tags_name_key', 'tags', ['name'])
+        with op.get_context().autocommit_block():
+            for table in TABLES:
+                op.drop_index(f'ix_{table}_deleted_at', table_name=table,
+                              postgresql_concurrently=True)
+            op.drop_index('ix_tags_name', table_name='tags',
+                          postgresql_concurrently=True)
+            for name, table, columns in LIVE_INDEXES:
+                op.create_index(f'{name}_all', table, columns,
+                                postgresql_concurrently=True)
+                op.drop_index(name, table_name=table,
+                              postgresql_concurrently=True)
+                op.execute(f"ALTER INDEX {name}_all RENAME TO {name}")
+
+        for table in TABLES:
+            op.drop_column(table, 'deleted_at')
+
+    elif dialect == 'sqlite':
+        for table in TABLES:
+            op.drop_index(f'ix_{table}_deleted_at', table_name=table)
+        op.drop_index('ix_tags_name', table_name='tags')
+        for name, table, columns in LIVE_INDEXES:
+            op.drop_index(name, table_name=table)
+            op.create_index(name, table, columns)
+
+        for trigger in SQLITE_COUNT_TRIGGERS:
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        with op.batch_alter_table('tags', recreate='always') as batch_op:
+            batch_op.create_unique_constraint('uq_tags_name', ['name'])
+            batch_op.drop_column('deleted_at')
+        for trigger in OLD_SQLITE_TRIGGERS:
+            op.execute(trigger)
+        sqlite_tags_version_triggers('name')
+
+        op.drop_column('posts', 'deleted_at')
+        op.drop_column('users', 'deleted_at')
@@ -0,0 +1,78 @@
+"""tag vocabulary version
+
+Revision ID: b7d3f1a9c2e6
+Revises: 9c1e5a7d2b40
+Create Date: 2026-10-18 21:12:40.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3f1a9c2e6'
+down_revision = '9c1e5a7d2b40'
+branch_labels = None
+depends_on = None
+
+
+POSTGRES_FUNCTION = """
+    CREATE OR REPLACE FUNCTION bump_tags_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE cache_versions SET version = version + 1 WHERE key = 'tags';
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+POSTGRES_TRIGGER = """
+    CREATE TRIGGER bump_tags_version
+    AFTER INSERT OR DELETE OR UPDATE OF name ON tags
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_tags_version()
+"""
+
+SQLITE_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS tags_version_{event}
+    AFTER {operation} ON tags
+    BEGIN
+        UPDATE cache_versions SET version = version + 1 WHERE key = 'tags';
+    END
+"""
+
+SQLITE_EVENTS = {
+    'insert': 'INSERT',
+    'delete': 'DELETE',
+    'update': 'UPDATE OF name',
+}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    op.create_table(
+        'cache_versions',
+        sa.Column('key', sa.String(length=50), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+    )
+    op.execute("INSERT INTO cache_versions (key, version) VALUES ('tags', 0)")
+
+    if dialect == 'postgresql':
+        op.execute(POSTGRES_FUNCTION)
+        op.execute(POSTGRES_TRIGGER)
+    elif dialect == 'sqlite':
+        for event, operation in SQLITE_EVENTS.items():
+            op.execute(SQLITE_TRIGGER.format(event=event, operation=operation))
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.execute("DROP TRIGGER IF EXISTS bump_tags_version ON tags")
+        op.execute("DROP FUNCTION IF EXISTS bump_tags_version()")
+    elif dialect == 'sqlite':
+        for event in SQLITE_EVENTS:
+            op.execute(f"DROP TRIGGER IF EXISTS tags_version_{event}")
+
+    op.drop_table('cache_versions')
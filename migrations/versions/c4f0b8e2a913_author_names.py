@@ -0,0 +1,127 @@
+"""author names
+
+Revision ID: c4f0b8e2a913
+Revises: 7a2d9e4b1c58
+Create Date: 2026-10-18 22:48:30.661904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4f0b8e2a913'
+down_revision = '7a2d9e4b1c58'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+
+POSTGRES_DDL = [
+    """CREATE OR REPLACE FUNCTION set_user_full_name() RETURNS trigger AS $$
+    BEGIN
+        NEW.full_name := NEW.first_name || ' ' || NEW.last_name;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION rename_user_posts() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.full_name IS DISTINCT FROM OLD.full_name THEN
+            UPDATE posts SET author_name = NEW.full_name
+            WHERE user_id = NEW.id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION set_post_author_name() RETURNS trigger AS $$
+    BEGIN
+        NEW.author_name := (SELECT full_name FROM users
+                            WHERE id = NEW.user_id);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER set_user_full_name
+    BEFORE INSERT OR UPDATE OF first_name, last_name ON users
+    FOR EACH ROW EXECUTE FUNCTION set_user_full_name()""",
+    """CREATE TRIGGER rename_user_posts
+    AFTER UPDATE OF first_name, last_name ON users
+    FOR EACH ROW EXECUTE FUNCTION rename_user_posts()""",
+    """CREATE TRIGGER set_post_author_name
+    BEFORE INSERT OR UPDATE OF user_id ON posts
+    FOR EACH ROW EXECUTE FUNCTION set_post_author_name()""",
+]
+
+SQLITE_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS users_full_name_insert
+    AFTER INSERT ON users
+    BEGIN
+        UPDATE users SET full_name = new.first_name || ' ' || new.last_name
+        WHERE id = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_full_name_update
+    AFTER UPDATE OF first_name, last_name ON users
+    BEGIN
+        UPDATE users SET full_name = new.first_name || ' ' || new.last_name
+        WHERE id = new.id;
+        UPDATE posts SET author_name = new.first_name || ' ' || new.last_name
+        WHERE user_id = new.id;
+    END""",
+] + [
+    f"""CREATE TRIGGER IF NOT EXISTS posts_author_name_{event}
+    AFTER {operation} ON posts
+    BEGIN
+        UPDATE posts SET author_name = (
+            SELECT full_name FROM users WHERE id = new.user_id)
+        WHERE id = new.id;
+    END"""
+    for event, operation in (("insert", "INSERT"),
+                             ("update", "UPDATE OF user_id"))
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    op.add_column('users', sa.Column('full_name', sa.String(length=101),
+                                     nullable=True))
+    op.add_column('posts', sa.Column('author_name', sa.String(length=101),
+                                     nullable=True))
+
+    # create the triggers before backfilling so no write slips between
+    if dialect == 'postgresql':
+        for statement in POSTGRES_DDL:
+            op.execute(statement)
+    elif dialect == 'sqlite':
+        for statement in SQLITE_DDL:
+            op.execute(statement)
+
+    op.execute("UPDATE users SET full_name = first_name || ' ' || last_name")
+
+    # posts in id ranges, so no single UPDATE locks the whole table
+    conn = op.get_bind()
+    last_id = conn.execute(sa.text("SELECT max(id) FROM posts")).scalar() or 0
+    for start in range(0, last_id, BATCH_SIZE):
+        conn.execute(sa.text("""
+            UPDATE posts SET author_name = (
+                SELECT full_name FROM users WHERE users.id = posts.user_id)
+            WHERE id > :start AND id <= :end
+        """), {"start": start, "end": start + BATCH_SIZE})
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.execute("DROP TRIGGER IF EXISTS set_post_author_name ON posts")
+        op.execute("DROP TRIGGER IF EXISTS rename_user_posts ON users")
+        op.execute("DROP TRIGGER IF EXISTS set_user_full_name ON users")
+        for function in ('set_post_author_name', 'rename_user_posts',
+                         'set_user_full_name'):
+            op.execute(f"DROP FUNCTION IF EXISTS {function}()")
+    elif dialect == 'sqlite':
+        for trigger in ('posts_author_name_insert', 'posts_author_name_update',
+                        'users_full_name_insert', 'users_full_name_update'):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+    op.drop_column('posts', 'author_name')
+    op.drop_column('users', 'full_name')
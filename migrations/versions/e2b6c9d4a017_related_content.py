@@ -0,0 +1,104 @@
+"""related content
+
+Revision ID: e2b6c9d4a017
+Revises: c4f0b8e2a913
+Create Date: 2026-10-18 23:35:12.204117
+
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b6c9d4a017'
+down_revision = 'c4f0b8e2a913'
+branch_labels = None
+depends_on = None
+
+# the defaults of RELATED_CANDIDATES and RELATED_POSTS_LIMIT
+CANDIDATES = 100
+LIMIT = 5
+
+TAG_PAIRS = """
+    INSERT INTO tag_pairs (tag_id, other_id, post_count)
+    SELECT a.tag_id, b.tag_id, count(*)
+    FROM posts_tags a
+    JOIN posts_tags b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id
+    JOIN posts p ON p.id = a.post_id AND p.deleted_at IS NULL
+    GROUP BY a.tag_id, b.tag_id
+"""
+
+RELATED_POSTS = """
+    INSERT INTO related_posts (post_id, related_id, shared_tags, refreshed_at)
+    SELECT post_id, related_id, shared_tags, :now
+    FROM (
+        SELECT shared.*, row_number() OVER (
+                   PARTITION BY post_id
+                   ORDER BY shared_tags DESC, related_id DESC) AS position
+        FROM (
+            SELECT mine.post_id, newest.post_id AS related_id,
+                   count(*) AS shared_tags
+            FROM (
+                SELECT pt.post_id, pt.tag_id
+                FROM posts_tags pt
+                JOIN posts p ON p.id = pt.post_id AND p.deleted_at IS NULL
+                JOIN tags t ON t.id = pt.tag_id AND t.deleted_at IS NULL
+            ) mine
+            JOIN (
+                SELECT pt.tag_id, pt.post_id, row_number() OVER (
+                           PARTITION BY pt.tag_id
+                           ORDER BY pt.post_id DESC) AS position
+                FROM posts_tags pt
+                JOIN posts p ON p.id = pt.post_id AND p.deleted_at IS NULL
+            ) newest ON newest.tag_id = mine.tag_id
+                    AND newest.post_id <> mine.post_id
+            WHERE newest.position <= :candidates
+            GROUP BY mine.post_id, newest.post_id
+        ) shared
+    ) ranked
+    WHERE position <= :limit
+"""
+
+
+def upgrade():
+    op.create_table(
+        'tag_pairs',
+        sa.Column('tag_id', sa.Integer(), nullable=False),
+        sa.Column('other_id', sa.Integer(), nullable=False),
+        sa.Column('post_count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['tag_id'], ['tags.id']),
+        sa.ForeignKeyConstraint(['other_id'], ['tags.id']),
+        sa.PrimaryKeyConstraint('tag_id', 'other_id'),
+    )
+    op.create_index('ix_tag_pairs_tag_id_post_count', 'tag_pairs',
+                    ['tag_id', 'post_count'])
+
+    op.create_table(
+        'related_posts',
+        sa.Column('post_id', sa.Integer(), nullable=False),
+        sa.Column('related_id', sa.Integer(), nullable=False),
+        sa.Column('shared_tags', sa.Integer(), nullable=False),
+        sa.Column('refreshed_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['post_id'], ['posts.id']),
+        sa.ForeignKeyConstraint(['related_id'], ['posts.id']),
+        sa.PrimaryKeyConstraint('post_id', 'related_id'),
+    )
+    op.create_index('ix_related_posts_related_id', 'related_posts',
+                    ['related_id'])
+
+    # the same set-based statements as `flask blog rebuild-related`
+    op.execute(TAG_PAIRS)
+    op.get_bind().execute(sa.text(RELATED_POSTS), {
+        "now": datetime.now(timezone.utc).replace(tzinfo=None),
+        "candidates": CANDIDATES,
+        "limit": LIMIT,
+    })
+
+
+def downgrade():
+    op.drop_index('ix_related_posts_related_id', table_name='related_posts')
+    op.drop_table('related_posts')
+    op.drop_index('ix_tag_pairs_tag_id_post_count', table_name='tag_pairs')
+    op.drop_table('tag_pairs')
@@ -0,0 +1,123 @@
+"""page versions
+
+Revision ID: f5a3c8e1d290
+Revises: e2b6c9d4a017
+Create Date: 2026-10-19 10:12:41.538016
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5a3c8e1d290'
+down_revision = 'e2b6c9d4a017'
+branch_labels = None
+depends_on = None
+
+POSTGRES_DDL = [
+    """CREATE OR REPLACE FUNCTION bump_post_versions() RETURNS trigger AS $$
+    BEGIN
+        UPDATE users SET posts_updated_at = NEW.updated_at
+        WHERE id = NEW.user_id;
+        IF TG_OP = 'UPDATE' THEN
+            UPDATE users SET posts_updated_at = NEW.updated_at
+            WHERE id = OLD.user_id AND OLD.user_id <> NEW.user_id;
+            UPDATE tags SET posts_updated_at = NEW.updated_at
+            WHERE id IN (
+                SELECT tag_id FROM posts_tags WHERE post_id = NEW.id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION bump_author_tag_versions() RETURNS trigger
+    AS $$
+    BEGIN
+        IF NEW.full_name IS DISTINCT FROM OLD.full_name THEN
+            UPDATE tags SET posts_updated_at = NEW.updated_at
+            WHERE id IN (
+                SELECT posts_tags.tag_id FROM posts_tags
+                JOIN posts ON posts.id = posts_tags.post_id
+                WHERE posts.user_id = NEW.id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER bump_author_tag_versions
+    AFTER UPDATE OF first_name, last_name ON users
+    FOR EACH ROW EXECUTE FUNCTION bump_author_tag_versions()""",
+    """CREATE TRIGGER bump_post_versions
+    AFTER INSERT OR UPDATE OF updated_at, user_id, deleted_at ON posts
+    FOR EACH ROW EXECUTE FUNCTION bump_post_versions()""",
+]
+
+SQLITE_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS users_tag_versions_rename
+    AFTER UPDATE OF first_name, last_name ON users
+    BEGIN
+        UPDATE tags SET posts_updated_at = new.updated_at
+        WHERE id IN (
+            SELECT posts_tags.tag_id FROM posts_tags
+            JOIN posts ON posts.id = posts_tags.post_id
+            WHERE posts.user_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_versions_insert
+    AFTER INSERT ON posts
+    BEGIN
+        UPDATE users SET posts_updated_at = new.updated_at
+        WHERE id = new.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_versions_update
+    AFTER UPDATE OF updated_at, user_id, deleted_at ON posts
+    BEGIN
+        UPDATE users SET posts_updated_at = new.updated_at
+        WHERE id IN (old.user_id, new.user_id);
+        UPDATE tags SET posts_updated_at = new.updated_at
+        WHERE id IN (SELECT tag_id FROM posts_tags WHERE post_id = new.id);
+    END""",
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    op.add_column('users', sa.Column('posts_updated_at', sa.DateTime(),
+                                     nullable=True))
+    op.add_column('tags', sa.Column('posts_updated_at', sa.DateTime(),
+                                    nullable=True))
+
+    if dialect == 'postgresql':
+        for statement in POSTGRES_DDL:
+            op.execute(statement)
+    elif dialect == 'sqlite':
+        for statement in SQLITE_DDL:
+            op.execute(statement)
+
+    # the versions' starting point: the newest write to any post
+    op.execute("""
+        UPDATE users SET posts_updated_at = (
+            SELECT max(updated_at) FROM posts WHERE posts.user_id = users.id)
+    """)
+    op.execute("""
+        UPDATE tags SET posts_updated_at = (
+            SELECT max(posts.updated_at) FROM posts
+            JOIN posts_tags ON posts_tags.post_id = posts.id
+            WHERE posts_tags.tag_id = tags.id)
+    """)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.execute("DROP TRIGGER IF EXISTS bump_post_versions ON posts")
+        op.execute("DROP TRIGGER IF EXISTS bump_author_tag_versions ON users")
+        for function in ('bump_post_versions', 'bump_author_tag_versions'):
+            op.execute(f"DROP FUNCTION IF EXISTS {function}()")
+    elif dialect == 'sqlite':
+        for trigger in ('posts_versions_insert', 'posts_versions_update',
+                        'users_tag_versions_rename'):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+    op.drop_column('tags', 'posts_updated_at')
+    op.drop_column('users', 'posts_updated_at')
@@ -1,25 +1,116 @@
 """Models for Blogly."""
 
+from datetime import datetime, timezone
+
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
+from sqlalchemy import (DDL, FetchedValue, and_, delete, event, func, insert,
+                        or_, select, true, update)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import (Session, aliased, deferred, object_session,
+                            selectinload, undefer, validates,
+                            with_loader_criteria)
+
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 DEFAULT_IMAGE_URL = "https://cdn5.vectorstock.com/i/1000x1000/45/79/male-avatar-profile-picture-silhouette-light-vector-4684579.jpg"
 
+# longest stored excerpt, ellipsis included
+EXCERPT_LENGTH = 280
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
     You should call this in your Flask app.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
 
 
+def utcnow():
+    """Current UTC time (naive, to the microsecond) for row versions."""
+
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def post_count_column():
+    """A denormalized count of posts, kept current by database triggers."""
+
+    return db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0"
+    )
+
+
+def deleted_at_column():
+    """When the row was soft-deleted; NULL while it's live."""
+
+    return db.Column(db.DateTime)
+
+
+LIVE = db.text("deleted_at IS NULL")
+DELETED = db.text("deleted_at IS NOT NULL")
+
+
+def live_index(name, *columns, **kwargs):
+    """An index over only the rows that aren't soft-deleted, which is all
+    any query but the purge ever reads."""
+
+    return db.Index(name, *columns, postgresql_where=LIVE, sqlite_where=LIVE,
+                    **kwargs)
+
+
+def deleted_index(table):
+    """A small index over just the soft-deleted rows, for the purge."""
+
+    return db.Index(f"ix_{table}_deleted_at", "deleted_at",
+                    postgresql_where=DELETED, sqlite_where=DELETED)
+
+
+def summarize(content):
+    """The excerpt and word_count columns for a post body.
+
+    The excerpt is the body with its whitespace collapsed, cut back to a
+    whole word and ended with an ellipsis when it's over EXCERPT_LENGTH.
+    """
+
+    words = content.split()
+    excerpt = " ".join(words)
+    if len(excerpt) > EXCERPT_LENGTH:
+        head = excerpt[:EXCERPT_LENGTH]
+        # drop the word the cut went through, unless it's the only one
+        cut = head.rsplit(" ", 1)[0] if " " in head else head[:-1]
+        excerpt = cut + "\u2026"
+
+    return {"excerpt": excerpt, "word_count": len(words)}
+
+
+def updated_at_column():
+    """A last-modified timestamp, bumped by the ORM on every UPDATE."""
+
+    return db.Column(
+        db.DateTime,
+        nullable=False,
+        default=utcnow,
+        onupdate=utcnow,
+        server_default=db.func.now()
+    )
+
+
 class User(db.Model):
     """User Model"""
 
     __tablename__ = "users"
+    __table_args__ = (
+        # user list, ordered and paged by name
+        live_index("ix_users_name", "last_name", "first_name", "id"),
+        # user list, most prolific first
+        live_index("ix_users_post_count", "post_count", "id"),
+        deleted_index("users"),
+    )
 
     id = db.Column(
         db.Integer,
@@ -41,11 +132,22 @@ class User(db.Model):
         default=DEFAULT_IMAGE_URL
     )
 
-    @property
-    def full_name(self):
-        """get full name. """
+    updated_at = updated_at_column()
+
+    post_count = post_count_column()
+
+    # when one of the user's posts was last written; see Page versions
+    posts_updated_at = db.Column(db.DateTime)
+
+    deleted_at = deleted_at_column()
 
-        return f"{self.first_name} {self.last_name}"
+    # "first last", stored by a trigger so the database can sort and filter
+    # on it; see Author names
+    full_name = db.Column(
+        db.String(101),
+        server_default=FetchedValue(),
+        server_onupdate=FetchedValue()
+    )
 
     posts = db.relationship('Post', backref='user')
 
@@ -54,6 +156,14 @@ class Post(db.Model):
     """Model for blog posts."""
 
     __tablename__ = "posts"
+    __table_args__ = (
+        # homepage and tag detail, newest first
+        live_index("ix_posts_created_at", "created_at", "id"),
+        # user detail, newest first
+        live_index("ix_posts_user_id_created_at", "user_id", "created_at",
+                   "id"),
+        deleted_index("posts"),
+    )
 
     id = db.Column(
         db.Integer,
@@ -66,9 +176,22 @@ class Post(db.Model):
         nullable=False
     )
 
-    content = db.Column(
+    # list pages render the excerpt; load content with undefer()
+    content = deferred(db.Column(
         db.Text,
         nullable=False
+    ))
+
+    excerpt = db.Column(
+        db.String(EXCERPT_LENGTH),
+        nullable=False,
+        server_default=""
+    )
+
+    word_count = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default="0"
     )
 
     created_at = db.Column(
@@ -77,13 +200,33 @@ class Post(db.Model):
         default=db.func.now()
     )
 
+    updated_at = updated_at_column()
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id')
     )
 
+    deleted_at = deleted_at_column()
+
+    # the author's full_name, copied in by triggers so listings never need
+    # users; see Author names
+    author_name = db.Column(
+        db.String(101),
+        server_default=FetchedValue(),
+        server_onupdate=FetchedValue()
+    )
+
     tags = db.relationship('Tag', secondary='posts_tags', backref='posts')
 
+    @validates("content")
+    def summarize_content(self, key, content):
+        """Keep excerpt and word_count in step with every content write."""
+
+        for name, value in summarize(content).items():
+            setattr(self, name, value)
+        return content
+
     @property
     def friendly_date(self):
         """Return nicely-formatted date."""
@@ -95,6 +238,13 @@ class Tag(db.Model):
     """Model for tags."""
 
     __tablename__ = "tags"
+    __table_args__ = (
+        # names only need to be unique among live tags
+        live_index("ix_tags_name", "name", unique=True),
+        # tag list, most used first
+        live_index("ix_tags_post_count", "post_count", "id"),
+        deleted_index("tags"),
+    )
 
     id = db.Column(
         db.Integer,
@@ -104,15 +254,28 @@ class Tag(db.Model):
 
     name = db.Column(
         db.String(25),
-        unique=True,
         nullable=False
     )
 
+    updated_at = updated_at_column()
+
+    post_count = post_count_column()
+
+    # when one of the tag's posts, or its author's name, was last written;
+    # see Page versions
+    posts_updated_at = db.Column(db.DateTime)
+
+    deleted_at = deleted_at_column()
+
 
 class PostTag(db.Model):
     """Model that joins together a Post and a Tag. """
 
     __tablename__ = "posts_tags"
+    __table_args__ = (
+        # tag detail; the primary key only leads with post_id
+        db.Index("ix_posts_tags_tag_id", "tag_id", "post_id"),
+    )
 
     post_id = db.Column(
         db.Integer,
@@ -127,3 +290,1020 @@ class PostTag(db.Model):
         nullable=False,
         primary_key=True
     )
+
+
+class TagPair(db.Model):
+    """How many live posts carry both of two tags; see Related content.
+
+    Every pair is stored in both directions, so a tag's related tags are one
+    index range.
+    """
+
+    __tablename__ = "tag_pairs"
+    __table_args__ = (
+        # tag detail, most shared first
+        db.Index("ix_tag_pairs_tag_id_post_count", "tag_id", "post_count"),
+    )
+
+    tag_id = db.Column(
+        db.Integer,
+        db.ForeignKey("tags.id"),
+        primary_key=True
+    )
+
+    other_id = db.Column(
+        db.Integer,
+        db.ForeignKey("tags.id"),
+        primary_key=True
+    )
+
+    post_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+
+class RelatedPost(db.Model):
+    """One of a post's most related posts; see related.py."""
+
+    __tablename__ = "related_posts"
+    __table_args__ = (
+        # the lists a post appears on, refreshed when it's retagged
+        db.Index("ix_related_posts_related_id", "related_id"),
+    )
+
+    post_id = db.Column(
+        db.Integer,
+        db.ForeignKey("posts.id"),
+        primary_key=True
+    )
+
+    related_id = db.Column(
+        db.Integer,
+        db.ForeignKey("posts.id"),
+        primary_key=True
+    )
+
+    shared_tags = db.Column(
+        db.Integer,
+        nullable=False
+    )
+
+    # when the list was last computed; part of the post page's version
+    refreshed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=utcnow
+    )
+
+
+class Job(db.Model):
+    """A background job waiting to run; see jobs.py."""
+
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # workers claim due jobs in run_at order
+        db.Index("ix_jobs_status_run_at", "status", "run_at"),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+
+    name = db.Column(
+        db.String(100),
+        nullable=False
+    )
+
+    args = db.Column(
+        db.JSON,
+        nullable=False
+    )
+
+    # queued, running or failed; jobs that ran are deleted
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default="queued"
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=utcnow
+    )
+
+    locked_at = db.Column(db.DateTime)
+
+    last_error = db.Column(db.Text)
+
+
+class CacheVersion(db.Model):
+    """A counter bumped whenever the data behind an in-process cache
+    changes, so every process can tell its copy is stale."""
+
+    __tablename__ = "cache_versions"
+
+    key = db.Column(
+        db.String(50),
+        primary_key=True
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0
+    )
+
+
+############################# Search ############################################
+# Full-text search is backed by objects the ORM doesn't map, created next to
+# the posts table: on Postgres a generated tsvector column with a GIN index,
+# on SQLite (tests, local development) an FTS5 table kept in sync by triggers.
+
+SEARCH_VECTOR = """setweight(to_tsvector('english', coalesce(title, '')), 'A')
+    || setweight(to_tsvector('english', coalesce(content, '')), 'B')"""
+
+POSTGRES_SEARCH_DDL = [
+    f"""ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS ({SEARCH_VECTOR}) STORED""",
+    """CREATE INDEX IF NOT EXISTS ix_posts_search_vector
+        ON posts USING gin (search_vector)""",
+]
+
+SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+        title, content, content='posts', content_rowid='id',
+        tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts
+    BEGIN
+        INSERT INTO posts_fts (rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts
+    BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_update
+    AFTER UPDATE OF title, content ON posts
+    BEGIN
+        INSERT INTO posts_fts (posts_fts, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO posts_fts (rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+    END""",
+    "INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')",
+]
+
+for statement in POSTGRES_SEARCH_DDL:
+    event.listen(Post.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in SQLITE_SEARCH_DDL:
+    event.listen(Post.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+
+event.listen(Post.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS posts_fts").execute_if(dialect="sqlite"))
+
+
+def include_in_migrations(obj, name, type_, reflected, compare_to):
+    """Keep autogenerate from dropping the unmapped search objects."""
+
+    if type_ == "column" and name == "search_vector":
+        return False
+    if type_ == "index" and name == "ix_posts_search_vector":
+        return False
+    if type_ == "table" and name.startswith("posts_fts"):
+        return False
+    return True
+
+
+############################# Soft delete #######################################
+# Deleting a user, post or tag only sets its deleted_at; `flask blog purge`
+# removes the rows later, in small batches. Every ORM SELECT, on any session,
+# gets a "deleted_at IS NULL" criterion for each of these models wherever it
+# appears (joins, subqueries and relationship loads included), which the
+# live_index()es match. Pass execution_options(include_deleted=True) to see
+# the deleted rows too.
+
+SOFT_DELETED = (User, Post, Tag)
+
+
+def live_criteria():
+    """Loader options that leave deleted users, posts and tags out."""
+
+    return [with_loader_criteria(model, model.deleted_at.is_(None),
+                                 include_aliases=True)
+            for model in SOFT_DELETED]
+
+
+@event.listens_for(Session, "do_orm_execute")
+def exclude_deleted(orm_execute_state):
+    state = orm_execute_state
+    # relationship and column loads inherit the criteria from their parent
+    if (state.is_select
+            and not state.is_column_load
+            and not state.is_relationship_load
+            and not state.execution_options.get("include_deleted", False)):
+        state.statement = state.statement.options(*live_criteria())
+
+
+def soft_delete(obj):
+    """Mark a user, post or tag deleted; the caller commits.
+
+    A user's posts go with them, in one UPDATE however many there are.
+    """
+
+    now = utcnow()
+    if isinstance(obj, User):
+        post_ids = db.session.execute(
+            select(Post.id).where(Post.user_id == obj.id,
+                                  Post.deleted_at.is_(None))
+        ).scalars().all()
+        count_tag_pairs(post_ids, -1)
+        retagged(post_ids)
+        db.session.execute(
+            update(Post)
+            .where(Post.user_id == obj.id, Post.deleted_at.is_(None))
+            .values(deleted_at=now))
+    elif isinstance(obj, Post):
+        count_tag_pairs([obj.id], -1)
+        retagged([obj.id])
+    elif isinstance(obj, Tag):
+        # the posts keep their posts_tags rows until the purge
+        post_ids = db.session.execute(
+            select(PostTag.post_id).where(PostTag.tag_id == obj.id)
+        ).scalars().all()
+        count_tag_pairs(post_ids, -1, [obj.id])
+        retagged(post_ids)
+    obj.deleted_at = now
+
+
+############################# Counters ##########################################
+# users.post_count and tags.post_count are maintained by row triggers on posts
+# and posts_tags, so every write path (ORM flushes, bulk statements, cascades,
+# imports) keeps them correct inside its own transaction. Soft-deleted posts
+# don't count: soft-deleting (or restoring) a post moves its author's and its
+# tags' counts, and the purge hard-deleting it later moves nothing.
+
+POSTGRES_COUNTER_DDL = [
+    """CREATE OR REPLACE FUNCTION count_user_posts() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' AND OLD.deleted_at IS NULL THEN
+            UPDATE users SET post_count = post_count - 1
+            WHERE id = OLD.user_id;
+        END IF;
+        IF TG_OP <> 'DELETE' AND NEW.deleted_at IS NULL THEN
+            UPDATE users SET post_count = post_count + 1
+            WHERE id = NEW.user_id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION count_tag_posts() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            UPDATE tags SET post_count = post_count - 1
+            WHERE id = OLD.tag_id AND EXISTS (
+                SELECT 1 FROM posts
+                WHERE id = OLD.post_id AND deleted_at IS NULL);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            UPDATE tags SET post_count = post_count + 1
+            WHERE id = NEW.tag_id AND EXISTS (
+                SELECT 1 FROM posts
+                WHERE id = NEW.post_id AND deleted_at IS NULL);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION count_deleted_post_tags() RETURNS trigger
+    AS $$
+    BEGIN
+        IF (OLD.deleted_at IS NULL) <> (NEW.deleted_at IS NULL) THEN
+            UPDATE tags SET post_count = post_count
+                + CASE WHEN NEW.deleted_at IS NULL THEN 1 ELSE -1 END
+            WHERE id IN (
+                SELECT tag_id FROM posts_tags WHERE post_id = NEW.id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+]
+
+POSTGRES_POSTS_COUNTER_DDL = [
+    """CREATE TRIGGER count_user_posts
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, deleted_at ON posts
+    FOR EACH ROW EXECUTE FUNCTION count_user_posts()""",
+    """CREATE TRIGGER count_deleted_post_tags
+    AFTER UPDATE OF deleted_at ON posts
+    FOR EACH ROW EXECUTE FUNCTION count_deleted_post_tags()""",
+]
+
+POSTGRES_POSTS_TAGS_COUNTER_DDL = [
+    """CREATE TRIGGER count_tag_posts
+    AFTER INSERT OR DELETE OR UPDATE OF tag_id ON posts_tags
+    FOR EACH ROW EXECUTE FUNCTION count_tag_posts()""",
+]
+
+SQLITE_POSTS_COUNTER_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS posts_count_insert
+    AFTER INSERT ON posts WHEN new.deleted_at IS NULL
+    BEGIN
+        UPDATE users SET post_count = post_count + 1 WHERE id = new.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_count_delete
+    AFTER DELETE ON posts WHEN old.deleted_at IS NULL
+    BEGIN
+        UPDATE users SET post_count = post_count - 1 WHERE id = old.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_count_update
+    AFTER UPDATE OF user_id, deleted_at ON posts
+    BEGIN
+        UPDATE users SET post_count = post_count - 1
+        WHERE id = old.user_id AND old.deleted_at IS NULL;
+        UPDATE users SET post_count = post_count + 1
+        WHERE id = new.user_id AND new.deleted_at IS NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_count_tags
+    AFTER UPDATE OF deleted_at ON posts
+    WHEN (old.deleted_at IS NULL) <> (new.deleted_at IS NULL)
+    BEGIN
+        UPDATE tags SET post_count = post_count
+            + CASE WHEN new.deleted_at IS NULL THEN 1 ELSE -1 END
+        WHERE id IN (SELECT tag_id FROM posts_tags WHERE post_id = new.id);
+    END""",
+]
+
+SQLITE_POSTS_TAGS_COUNTER_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS posts_tags_count_insert
+    AFTER INSERT ON posts_tags
+    BEGIN
+        UPDATE tags SET post_count = post_count + 1
+        WHERE id = new.tag_id AND EXISTS (
+            SELECT 1 FROM posts
+            WHERE id = new.post_id AND deleted_at IS NULL);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_tags_count_delete
+    AFTER DELETE ON posts_tags
+    BEGIN
+        UPDATE tags SET post_count = post_count - 1
+        WHERE id = old.tag_id AND EXISTS (
+            SELECT 1 FROM posts
+            WHERE id = old.post_id AND deleted_at IS NULL);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_tags_count_update
+    AFTER UPDATE OF tag_id ON posts_tags
+    BEGIN
+        UPDATE tags SET post_count = post_count - 1
+        WHERE id = old.tag_id AND EXISTS (
+            SELECT 1 FROM posts
+            WHERE id = old.post_id AND deleted_at IS NULL);
+        UPDATE tags SET post_count = post_count + 1
+        WHERE id = new.tag_id AND EXISTS (
+            SELECT 1 FROM posts
+            WHERE id = new.post_id AND deleted_at IS NULL);
+    END""",
+]
+
+
+for statement in POSTGRES_COUNTER_DDL + POSTGRES_POSTS_COUNTER_DDL:
+    event.listen(Post.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in POSTGRES_POSTS_TAGS_COUNTER_DDL:
+    event.listen(PostTag.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in SQLITE_POSTS_COUNTER_DDL:
+    event.listen(Post.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+
+for statement in SQLITE_POSTS_TAGS_COUNTER_DDL:
+    event.listen(PostTag.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+
+
+def repair_post_counts():
+    """Recompute every post_count from scratch with two set-based UPDATEs.
+
+    Only rows whose stored count is wrong are written. Returns the number of
+    (users, tags) fixed. The caller commits.
+    """
+
+    user_posts = (select(func.count(Post.id))
+                  .where(Post.user_id == User.id, Post.deleted_at.is_(None))
+                  .scalar_subquery())
+    tag_posts = (select(func.count(PostTag.post_id))
+                 .join(Post, Post.id == PostTag.post_id)
+                 .where(PostTag.tag_id == Tag.id, Post.deleted_at.is_(None))
+                 .scalar_subquery())
+
+    users = db.session.execute(
+        update(User)
+        .where(User.post_count != user_posts)
+        # keep updated_at as is; a recount isn't an edit
+        .values(post_count=user_posts, updated_at=User.updated_at)
+        .execution_options(synchronize_session=False))
+    tags = db.session.execute(
+        update(Tag)
+        .where(Tag.post_count != tag_posts)
+        .values(post_count=tag_posts, updated_at=Tag.updated_at)
+        .execution_options(synchronize_session=False))
+
+    return users.rowcount, tags.rowcount
+
+
+############################# Author names ######################################
+# users.full_name and its copy in posts.author_name are kept by triggers, like
+# the counters: a user's name is stored on every write to it, a post takes its
+# author's name when it's written or moved to another author, and a rename
+# updates all of that user's posts with a single UPDATE.
+
+POSTGRES_AUTHOR_NAME_DDL = [
+    """CREATE OR REPLACE FUNCTION set_user_full_name() RETURNS trigger AS $$
+    BEGIN
+        NEW.full_name := NEW.first_name || ' ' || NEW.last_name;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION rename_user_posts() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.full_name IS DISTINCT FROM OLD.full_name THEN
+            UPDATE posts SET author_name = NEW.full_name
+            WHERE user_id = NEW.id;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION set_post_author_name() RETURNS trigger AS $$
+    BEGIN
+        NEW.author_name := (SELECT full_name FROM users
+                            WHERE id = NEW.user_id);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql""",
+]
+
+POSTGRES_USERS_AUTHOR_NAME_DDL = [
+    """CREATE TRIGGER set_user_full_name
+    BEFORE INSERT OR UPDATE OF first_name, last_name ON users
+    FOR EACH ROW EXECUTE FUNCTION set_user_full_name()""",
+    """CREATE TRIGGER rename_user_posts
+    AFTER UPDATE OF first_name, last_name ON users
+    FOR EACH ROW EXECUTE FUNCTION rename_user_posts()""",
+]
+
+POSTGRES_POSTS_AUTHOR_NAME_DDL = [
+    """CREATE TRIGGER set_post_author_name
+    BEFORE INSERT OR UPDATE OF user_id ON posts
+    FOR EACH ROW EXECUTE FUNCTION set_post_author_name()""",
+]
+
+# SQLite triggers can't assign to NEW, so these UPDATE the row just written
+SQLITE_USERS_AUTHOR_NAME_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS users_full_name_insert
+    AFTER INSERT ON users
+    BEGIN
+        UPDATE users SET full_name = new.first_name || ' ' || new.last_name
+        WHERE id = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_full_name_update
+    AFTER UPDATE OF first_name, last_name ON users
+    BEGIN
+        UPDATE users SET full_name = new.first_name || ' ' || new.last_name
+        WHERE id = new.id;
+        UPDATE posts SET author_name = new.first_name || ' ' || new.last_name
+        WHERE user_id = new.id;
+    END""",
+]
+
+SQLITE_POSTS_AUTHOR_NAME_DDL = [
+    f"""CREATE TRIGGER IF NOT EXISTS posts_author_name_{event}
+    AFTER {operation} ON posts
+    BEGIN
+        UPDATE posts SET author_name = (
+            SELECT full_name FROM users WHERE id = new.user_id)
+        WHERE id = new.id;
+    END"""
+    for event, operation in (("insert", "INSERT"),
+                             ("update", "UPDATE OF user_id"))
+]
+
+for statement in POSTGRES_AUTHOR_NAME_DDL + POSTGRES_USERS_AUTHOR_NAME_DDL:
+    event.listen(User.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in POSTGRES_POSTS_AUTHOR_NAME_DDL:
+    event.listen(Post.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in SQLITE_USERS_AUTHOR_NAME_DDL:
+    event.listen(User.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+
+for statement in SQLITE_POSTS_AUTHOR_NAME_DDL:
+    event.listen(Post.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+
+# The INSERT's RETURNING reads a new row's name before SQLite's AFTER triggers
+# fill it in, so there the names are expired after the flush instead and load
+# when first used. (Postgres' BEFORE triggers set them in time; an UPDATE's
+# server_onupdate already expires them.)
+STORED_NAMES = {User: "full_name", Post: "author_name"}
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(Post, "after_insert")
+def note_stored_name(mapper, connection, target):
+    if connection.dialect.name == "sqlite":
+        session = object_session(target)
+        session.info.setdefault('unnamed', []).append(target)
+
+
+@event.listens_for(Session, "after_flush_postexec")
+def expire_stored_names(session, flush_context):
+    for obj in session.info.pop('unnamed', ()):
+        session.expire(obj, [STORED_NAMES[type(obj)]])
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_unnamed(session):
+    session.info.pop('unnamed', None)
+
+
+############################# Page versions #####################################
+# users.posts_updated_at and tags.posts_updated_at let the user and tag pages
+# get their version from one row instead of aggregating over every post. Any
+# write of a post that bumps its updated_at copies it to its author (old and
+# new, for a move) and its tags, and renaming a user copies the user's
+# updated_at to the tags of their posts, whose feeds show the name. Adding or
+# removing posts moves post_count, which is part of the versions too.
+
+POSTGRES_PAGE_VERSION_DDL = [
+    """CREATE OR REPLACE FUNCTION bump_post_versions() RETURNS trigger AS $$
+    BEGIN
+        UPDATE users SET posts_updated_at = NEW.updated_at
+        WHERE id = NEW.user_id;
+        IF TG_OP = 'UPDATE' THEN
+            UPDATE users SET posts_updated_at = NEW.updated_at
+            WHERE id = OLD.user_id AND OLD.user_id <> NEW.user_id;
+            UPDATE tags SET posts_updated_at = NEW.updated_at
+            WHERE id IN (
+                SELECT tag_id FROM posts_tags WHERE post_id = NEW.id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION bump_author_tag_versions() RETURNS trigger
+    AS $$
+    BEGIN
+        IF NEW.full_name IS DISTINCT FROM OLD.full_name THEN
+            UPDATE tags SET posts_updated_at = NEW.updated_at
+            WHERE id IN (
+                SELECT posts_tags.tag_id FROM posts_tags
+                JOIN posts ON posts.id = posts_tags.post_id
+                WHERE posts.user_id = NEW.id);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+]
+
+POSTGRES_USERS_PAGE_VERSION_DDL = [
+    """CREATE TRIGGER bump_author_tag_versions
+    AFTER UPDATE OF first_name, last_name ON users
+    FOR EACH ROW EXECUTE FUNCTION bump_author_tag_versions()""",
+]
+
+POSTGRES_POSTS_PAGE_VERSION_DDL = [
+    """CREATE TRIGGER bump_post_versions
+    AFTER INSERT OR UPDATE OF updated_at, user_id, deleted_at ON posts
+    FOR EACH ROW EXECUTE FUNCTION bump_post_versions()""",
+]
+
+SQLITE_USERS_PAGE_VERSION_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS users_tag_versions_rename
+    AFTER UPDATE OF first_name, last_name ON users
+    BEGIN
+        UPDATE tags SET posts_updated_at = new.updated_at
+        WHERE id IN (
+            SELECT posts_tags.tag_id FROM posts_tags
+            JOIN posts ON posts.id = posts_tags.post_id
+            WHERE posts.user_id = new.id);
+    END""",
+]
+
+SQLITE_POSTS_PAGE_VERSION_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS posts_versions_insert
+    AFTER INSERT ON posts
+    BEGIN
+        UPDATE users SET posts_updated_at = new.updated_at
+        WHERE id = new.user_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_versions_update
+    AFTER UPDATE OF updated_at, user_id, deleted_at ON posts
+    BEGIN
+        UPDATE users SET posts_updated_at = new.updated_at
+        WHERE id IN (old.user_id, new.user_id);
+        UPDATE tags SET posts_updated_at = new.updated_at
+        WHERE id IN (SELECT tag_id FROM posts_tags WHERE post_id = new.id);
+    END""",
+]
+
+for statement in POSTGRES_PAGE_VERSION_DDL + POSTGRES_USERS_PAGE_VERSION_DDL:
+    event.listen(User.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in POSTGRES_POSTS_PAGE_VERSION_DDL:
+    event.listen(Post.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in SQLITE_USERS_PAGE_VERSION_DDL:
+    event.listen(User.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+
+for statement in SQLITE_POSTS_PAGE_VERSION_DDL:
+    event.listen(Post.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+
+
+############################# Tag vocabulary version ############################
+# cache_versions' "tags" row counts changes to the set of tag names: triggers
+# bump it on every INSERT, DELETE, rename and soft delete in tags, whatever
+# made it.
+
+POSTGRES_TAGS_VERSION_DDL = [
+    """CREATE OR REPLACE FUNCTION bump_tags_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE cache_versions SET version = version + 1 WHERE key = 'tags';
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER bump_tags_version
+    AFTER INSERT OR DELETE OR UPDATE OF name, deleted_at ON tags
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_tags_version()""",
+]
+
+SQLITE_TAGS_VERSION_DDL = [
+    f"""CREATE TRIGGER IF NOT EXISTS tags_version_{event}
+    AFTER {operation} ON tags
+    BEGIN
+        UPDATE cache_versions SET version = version + 1 WHERE key = 'tags';
+    END"""
+    for event, operation in (("insert", "INSERT"), ("delete", "DELETE"),
+                             ("update", "UPDATE OF name, deleted_at"))
+]
+
+event.listen(CacheVersion.__table__, "after_create",
+             DDL("INSERT INTO cache_versions (key, version) VALUES ('tags', 0)"))
+
+for statement in POSTGRES_TAGS_VERSION_DDL:
+    event.listen(Tag.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in SQLITE_TAGS_VERSION_DDL:
+    event.listen(Tag.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+
+
+############################# Queries ###########################################
+# One query builder per view, each carrying the loader options for exactly the
+# relationships its template touches, so a page never falls back to 1+N lazy
+# loads.
+
+def recent_posts_query(limit=5):
+    """Most recent posts; they carry their author's name, so no join."""
+
+    return (Post.query
+            .order_by(Post.created_at.desc())
+            .limit(limit))
+
+
+def users_query():
+    """All users, ordered by name."""
+
+    return User.query.order_by(User.last_name, User.first_name)
+
+
+def user_detail_query(user_id):
+    """A single user; their posts are paged separately."""
+
+    return User.query.filter(User.id == user_id)
+
+
+def user_posts_query(user_id):
+    """Posts written by a user."""
+
+    return Post.query.filter(Post.user_id == user_id)
+
+
+def post_detail_query(post_id):
+    """A single post, content included, with its tags."""
+
+    return (Post.query
+            .options(undefer(Post.content), selectinload(Post.tags))
+            .filter(Post.id == post_id))
+
+
+def latest_posts_query(query, limit):
+    """The newest `limit` posts of a posts query, with their content."""
+
+    return (query
+            .options(undefer(Post.content))
+            .order_by(Post.created_at.desc(), Post.id.desc())
+            .limit(limit))
+
+
+def tags_query():
+    """All tags, ordered by name."""
+
+    return Tag.query.order_by(Tag.name)
+
+
+def tag_detail_query(tag_id):
+    """A single tag; its posts are paged separately."""
+
+    return Tag.query.filter(Tag.id == tag_id)
+
+
+def tag_posts_query(tag_id):
+    """Posts carrying a tag."""
+
+    return (Post.query
+            .join(PostTag, PostTag.post_id == Post.id)
+            .filter(PostTag.tag_id == tag_id))
+
+
+def related_posts_query(post_id, limit):
+    """A post's related posts, most shared tags first, from related_posts."""
+
+    return (Post.query
+            .join(RelatedPost, RelatedPost.related_id == Post.id)
+            .filter(RelatedPost.post_id == post_id)
+            .order_by(RelatedPost.shared_tags.desc(),
+                      RelatedPost.related_id.desc())
+            .limit(limit))
+
+
+def related_tags_query(tag_id, limit):
+    """The tags most often used alongside a tag, from tag_pairs."""
+
+    return (Tag.query
+            .join(TagPair, TagPair.other_id == Tag.id)
+            .filter(TagPair.tag_id == tag_id, TagPair.post_count > 0)
+            .order_by(TagPair.post_count.desc(), Tag.name)
+            .limit(limit))
+
+
+# sort keys for keyset pagination; each ends in a unique column
+USER_ORDER = (User.last_name, User.first_name, User.id)
+USER_POPULAR_ORDER = (User.post_count, User.id)
+TAG_ORDER = (Tag.name, Tag.id)
+TAG_POPULAR_ORDER = (Tag.post_count, Tag.id)
+POST_ORDER = (Post.created_at, Post.id)
+
+
+############################# Versions ##########################################
+# Each *_version_query selects a row that changes whenever the matching page
+# would render differently (and no row if the resource doesn't exist), from
+# stored counters and timestamps or aggregates that never load the rows
+# themselves. The aggregate subqueries always return one row, so joining them
+# ON true just appends their columns. The *_version functions run them on
+# db.session; the async read path runs them on its own session.
+
+def homepage_version_query():
+    """Version of the homepage."""
+
+    return select(func.max(Post.updated_at), func.count(Post.id),
+                  select(func.max(User.updated_at)).scalar_subquery())
+
+
+def user_version_query(user_id):
+    """Version of a user's detail page, read from the user's row alone."""
+
+    return (select(User.updated_at, User.post_count, User.posts_updated_at)
+            .where(User.id == user_id))
+
+
+def post_version_query(post_id):
+    """Version of a post's detail page, including its author, tags and
+    related posts."""
+
+    tags = (select(func.max(Tag.updated_at), func.count(Tag.id))
+            .join(PostTag, PostTag.tag_id == Tag.id)
+            .where(PostTag.post_id == post_id)).subquery()
+
+    # related posts show their author's name, which a rename changes
+    related = (select(func.max(RelatedPost.refreshed_at),
+                      func.max(Post.updated_at), func.count(Post.id),
+                      func.max(User.updated_at))
+               .select_from(RelatedPost)
+               .join(Post, Post.id == RelatedPost.related_id)
+               .join(User, User.id == Post.user_id)
+               .where(RelatedPost.post_id == post_id)).subquery()
+
+    return (select(Post.updated_at, User.updated_at, tags, related)
+            .select_from(Post)
+            .outerjoin(User, User.id == Post.user_id)
+            .join(tags, true())
+            .join(related, true())
+            .where(Post.id == post_id))
+
+
+def tag_version_query(tag_id):
+    """Version of a tag's detail page and feed, including its related tags;
+    its posts and their authors' names are covered by the tag's row."""
+
+    related = (select(func.max(Tag.updated_at))
+               .select_from(Tag)
+               .join(TagPair, TagPair.other_id == Tag.id)
+               .where(TagPair.tag_id == tag_id,
+                      TagPair.post_count > 0)).subquery()
+
+    return (select(Tag.updated_at, Tag.post_count, Tag.posts_updated_at,
+                   related)
+            .select_from(Tag)
+            .join(related, true())
+            .where(Tag.id == tag_id))
+
+
+def homepage_version():
+    return db.session.execute(homepage_version_query()).one()
+
+
+def user_version(user_id):
+    return db.session.execute(user_version_query(user_id)).one_or_none()
+
+
+def post_version(post_id):
+    return db.session.execute(post_version_query(post_id)).one_or_none()
+
+
+def tag_version(tag_id):
+    return db.session.execute(tag_version_query(tag_id)).one_or_none()
+
+
+############################# Tag assignment ####################################
+# posts_tags rows are written with bulk statements rather than one ORM object
+# per tag, so tagging a post costs a fixed number of round trips.
+
+def tag_ids_by_name(names):
+    """Map tag names to ids with a single IN query; unknown names are dropped."""
+
+    names = set(names)
+    if not names:
+        return {}
+
+    return dict(db.session.execute(
+        select(Tag.name, Tag.id).where(Tag.name.in_(names))).all())
+
+
+def _insert_post_tags(post_id, tag_ids):
+    if tag_ids:
+        db.session.execute(insert(PostTag), [
+            {"post_id": post_id, "tag_id": tag_id} for tag_id in tag_ids])
+
+
+def _delete_post_tags(post_id, tag_ids):
+    if tag_ids:
+        db.session.execute(
+            delete(PostTag)
+            .where(PostTag.post_id == post_id, PostTag.tag_id.in_(tag_ids)))
+
+
+def add_post_tags(post_id, tag_ids):
+    """Attach tags to a post in one multi-row INSERT."""
+
+    if tag_ids:
+        _insert_post_tags(post_id, tag_ids)
+        count_tag_pairs([post_id], 1, tag_ids)
+        retagged([post_id])
+
+
+def remove_post_tags(post_id, tag_ids):
+    """Detach tags from a post in one DELETE."""
+
+    if tag_ids:
+        count_tag_pairs([post_id], -1, tag_ids)
+        _delete_post_tags(post_id, tag_ids)
+        retagged([post_id])
+
+
+def set_post_tags(post_id, tag_ids):
+    """Make a post's tags exactly `tag_ids`, writing only the rows that
+    change."""
+
+    wanted = set(tag_ids)
+    # deleted tags stay attached until the purge; their pairs are already gone
+    current = set(db.session.execute(
+        select(PostTag.tag_id).join(Tag)
+        .where(PostTag.post_id == post_id)).scalars())
+
+    if wanted != current:
+        _insert_post_tags(post_id, wanted - current)
+        _delete_post_tags(post_id, current - wanted)
+        # both tag sets are known here, so the pair counts move in one upsert
+        move_tag_pairs(current, wanted)
+        retagged([post_id])
+
+
+############################# Related content ###################################
+# tag_pairs is the tag co-occurrence matrix. Unlike the counters it isn't kept
+# by triggers: Postgres runs row triggers once the whole statement is done, so
+# a trigger on a multi-row posts_tags INSERT would count each new pair twice.
+# Instead the tag assignment helpers above and soft_delete() adjust it with
+# one upsert per change, in the writer's transaction. Paths that write
+# posts_tags directly (bulk imports, the data generator) are followed by
+# `flask blog rebuild-related`. Pairs that drop to 0 keep their row until the
+# next rebuild; readers skip them. The related_posts lists are recomputed by a
+# job for every post retagged(); see related.py.
+
+def tag_pairs_select(post_ids=None, tag_ids=None):
+    """(tag_id, other_id, post_count) for every two live tags sharing a live
+    post, counting only `post_ids` and pairs involving `tag_ids` if given."""
+
+    other = aliased(PostTag)
+    live_tags = select(Tag.id).where(Tag.deleted_at.is_(None))
+    pairs = (select(PostTag.tag_id, other.tag_id.label("other_id"),
+                    func.count().label("post_count"))
+             .join(other, and_(other.post_id == PostTag.post_id,
+                               other.tag_id != PostTag.tag_id))
+             .join(Post, and_(Post.id == PostTag.post_id,
+                              Post.deleted_at.is_(None)))
+             .where(PostTag.tag_id.in_(live_tags),
+                    other.tag_id.in_(live_tags))
+             .group_by(PostTag.tag_id, other.tag_id))
+
+    if post_ids is not None:
+        pairs = pairs.where(PostTag.post_id.in_(post_ids))
+    if tag_ids is not None:
+        pairs = pairs.where(or_(PostTag.tag_id.in_(tag_ids),
+                                other.tag_id.in_(tag_ids)))
+    return pairs
+
+
+def count_tag_pairs(post_ids, sign, tag_ids=None):
+    """Add (`sign` 1) or take away (`sign` -1) the pairs of tags on
+    `post_ids`, only those involving `tag_ids` if given, in one INSERT ..
+    ON CONFLICT.
+
+    Call it after attaching tags and before detaching them, while the posts
+    are live.
+    """
+
+    pairs = tag_pairs_select(post_ids, tag_ids).subquery()
+    upsert = _insert_tag_pairs().from_select(
+        ["tag_id", "other_id", "post_count"],
+        # a WHERE keeps SQLite from reading ON CONFLICT as a join condition
+        select(pairs.c.tag_id, pairs.c.other_id, pairs.c.post_count * sign)
+        .where(true()))
+
+    db.session.execute(_add_to_tag_pairs(upsert))
+
+
+def move_tag_pairs(before, after):
+    """Count one post moving from tags `before` to tags `after`, with one
+    multi-row INSERT .. ON CONFLICT of the pairs that change."""
+
+    def pairs(tags):
+        return {(a, b) for a in tags for b in tags if a != b}
+
+    old, new = pairs(before), pairs(after)
+    rows = ([{"tag_id": a, "other_id": b, "post_count": 1}
+             for a, b in sorted(new - old)]
+            + [{"tag_id": a, "other_id": b, "post_count": -1}
+               for a, b in sorted(old - new)])
+    if rows:
+        upsert = _insert_tag_pairs().values(rows)
+        db.session.execute(_add_to_tag_pairs(upsert))
+
+
+def _insert_tag_pairs():
+    dialect = db.session.get_bind(mapper=TagPair.__mapper__).dialect.name
+    return (postgresql if dialect == "postgresql" else sqlite).insert(TagPair)
+
+
+def _add_to_tag_pairs(upsert):
+    return upsert.on_conflict_do_update(
+        index_elements=[TagPair.tag_id, TagPair.other_id],
+        set_={"post_count": TagPair.post_count + upsert.excluded.post_count})
+
+
+def retagged(post_ids):
+    """Note posts whose tags changed, so their related posts are refreshed
+    once the transaction commits."""
+
+    db.session.info.setdefault('retagged_posts', set()).update(post_ids)
+
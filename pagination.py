@@ -0,0 +1,239 @@
+"""Keyset (cursor) pagination for Blogly list pages."""
+
+import base64
+import json
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import literal, tuple_
+
+from models import db
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination token can't be decoded."""
+
+
+class Page:
+    """One page of results, with opaque tokens for its neighbours."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class StreamingPage(Page):
+    """A page whose rows are fetched from a server-side cursor as it is
+    iterated, so a streamed template holds one batch of rows at a time.
+
+    It can be iterated once, and its cursors are only known afterwards;
+    templates render the page links below the list, which is in time.
+
+    stream_template pushes the view's contexts again while the response is
+    sent, and the session teardown that follows returns the connection to
+    the pool. The view's own session was torn down when the view returned,
+    so the query runs on the session current while the page is iterated.
+    """
+
+    def __init__(self, query, columns, values, per_page):
+        super().__init__(None)
+        self._query = query
+        self._columns = columns
+        self._values = values
+        self._per_page = per_page
+
+    def _key(self, row):
+        return [getattr(row, col.key) for col in self._columns]
+
+    def __iter__(self):
+        rows = iter(self._query.with_session(db.session()))
+        last = None
+        try:
+            for count, row in enumerate(rows):
+                if count == self._per_page:
+                    # the extra row only tells us there is a next page
+                    self.next_cursor = encode_cursor(self._key(last), "n")
+                    break
+                if count == 0 and self._values is not None:
+                    self.prev_cursor = encode_cursor(self._key(row), "p")
+                last = row
+                yield row
+        finally:
+            rows.close()
+
+    def __len__(self):
+        raise TypeError("a StreamingPage has no length until iterated")
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and "dt" in value:
+        return datetime.fromisoformat(value["dt"])
+    return value
+
+
+def _check_value(value, column):
+    """`value` if it fits `column`'s type (an int will do for a float)."""
+
+    try:
+        expected = column.type.python_type
+    except NotImplementedError:
+        return value
+
+    if isinstance(value, bool) and expected is not bool:
+        raise InvalidCursor(value)
+    if expected is float and isinstance(value, int):
+        return float(value)
+    if not isinstance(value, expected):
+        raise InvalidCursor(value)
+    return value
+
+
+def encode_cursor(values, direction):
+    """Turn a row's sort key and a direction ("n" or "p") into a token."""
+
+    payload = {"k": [_encode_value(v) for v in values], "d": direction}
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor; returns (values, direction)."""
+
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        payload = json.loads(raw)
+        values = [_decode_value(v) for v in payload["k"]]
+        direction = payload["d"]
+    except (ValueError, KeyError, TypeError) as exc:
+        raise InvalidCursor(token) from exc
+
+    if direction not in ("n", "p"):
+        raise InvalidCursor(token)
+
+    return values, direction
+
+
+def keyset_query(query, columns, values=None, reverse=False, limit=None):
+    """Order `query` by `columns` and seek past the sort key `values`."""
+
+    if values is not None:
+        key = tuple_(*columns)
+        bound = tuple_(*[literal(v, col.type)
+                         for v, col in zip(values, columns)])
+        query = query.filter(key < bound if reverse else key > bound)
+
+    order = [col.desc() if reverse else col.asc() for col in columns]
+    return query.order_by(None).order_by(*order).limit(limit)
+
+
+def _seek(query, columns, cursor, per_page, descending):
+    """The query for one page plus what's needed to build it from the rows."""
+
+    values, direction = decode_cursor(cursor) if cursor else (None, "n")
+
+    if values is not None:
+        if len(values) != len(columns):
+            raise InvalidCursor(cursor)
+        # tokens come from clients; don't let e.g. a string reach the
+        # database as an id
+        values = [_check_value(v, col) for v, col in zip(values, columns)]
+
+    # walking backwards is walking forwards over the reversed ordering
+    backwards = direction == "p"
+    reverse = descending != backwards
+
+    query = keyset_query(query, columns, values, reverse, per_page + 1)
+    return query, values, backwards
+
+
+def _page(rows, columns, values, backwards, per_page):
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def key_of(row):
+        return [getattr(row, col.key) for col in columns]
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or backwards:
+            next_cursor = encode_cursor(key_of(rows[-1]), "n")
+        if (has_more and backwards) or (values is not None and not backwards):
+            prev_cursor = encode_cursor(key_of(rows[0]), "p")
+
+    return Page(rows, next_cursor, prev_cursor)
+
+
+def paginate(query, columns, cursor=None, per_page=20, descending=False,
+             stream=False):
+    """Return a Page of `query` ordered by `columns`, seeking past `cursor`.
+
+    `columns` must end in a unique column (normally the primary key) so the
+    sort key is total. Every page costs one index seek plus `per_page` rows,
+    however deep into the table it is.
+
+    With `stream`, forward pages are a StreamingPage: the query runs, and
+    its rows are fetched STREAM_BATCH_SIZE at a time, while the page is
+    iterated. Backward pages come back in reverse and are read whole.
+    """
+
+    query, values, backwards = _seek(query, columns, cursor, per_page,
+                                     descending)
+    if stream and not backwards:
+        batch_size = current_app.config['STREAM_BATCH_SIZE']
+        return StreamingPage(query.yield_per(batch_size), columns, values,
+                             per_page)
+    return _page(query.all(), columns, values, backwards, per_page)
+
+
+async def paginate_async(session, query, columns, cursor=None, per_page=20,
+                         descending=False):
+    """paginate(), running the query on an AsyncSession."""
+
+    query, values, backwards = _seek(query, columns, cursor, per_page,
+                                     descending)
+    rows = (await session.execute(query.statement)).scalars().all()
+    return _page(list(rows), columns, values, backwards, per_page)
+
+
+def _page_args():
+    config = current_app.config
+    per_page = request.args.get('per_page', config['PAGE_SIZE'], type=int)
+    per_page = max(1, min(per_page, config['MAX_PAGE_SIZE']))
+    return request.args.get('cursor'), per_page
+
+
+def paginate_request(query, columns, descending=False, stream=False):
+    """Page `query` using the ?cursor= and ?per_page= request args."""
+
+    cursor, per_page = _page_args()
+    try:
+        return paginate(query, columns, cursor=cursor, per_page=per_page,
+                        descending=descending, stream=stream)
+    except InvalidCursor:
+        abort(400)
+
+
+async def paginate_request_async(session, query, columns, descending=False):
+    """paginate_request(), running the query on an AsyncSession."""
+
+    cursor, per_page = _page_args()
+    try:
+        return await paginate_async(session, query, columns, cursor=cursor,
+                                    per_page=per_page, descending=descending)
+    except InvalidCursor:
+        abort(400)
@@ -0,0 +1,142 @@
+"""Hard-delete soft-deleted users, posts and tags.
+
+The views only set deleted_at (see models.soft_delete), so deleting even a
+prolific user is a couple of UPDATEs. `flask blog purge`, run from cron or by
+hand, removes those rows afterwards in dependency order:
+
+1. posts_tags, related_posts and tag_pairs rows of deleted posts and tags,
+2. deleted posts,
+3. deleted tags,
+4. deleted users with no posts left.
+
+Each batch of at most PURGE_BATCH_SIZE rows is its own short transaction,
+and batches are spaced out to stay under PURGE_ROWS_PER_SECOND (0 for no
+limit), so a large purge never holds long locks or floods replication.
+The counter triggers ignore rows that are already soft-deleted, so purging
+doesn't touch any post_count.
+"""
+
+import time
+from collections import Counter
+
+from sqlalchemy import delete, exists, select, tuple_
+
+from models import db, User, Post, Tag, PostTag, RelatedPost, TagPair
+
+
+def _deleted(model):
+    return model.deleted_at.is_not(None)
+
+
+# (report name, query selecting the keys of rows to purge, table, key columns)
+STEPS = [
+    ("posts_tags",
+     select(PostTag.post_id, PostTag.tag_id)
+     .join(Post, Post.id == PostTag.post_id)
+     .where(_deleted(Post)),
+     PostTag.__table__, ("post_id", "tag_id")),
+    ("posts_tags",
+     select(PostTag.post_id, PostTag.tag_id)
+     .join(Tag, Tag.id == PostTag.tag_id)
+     .where(_deleted(Tag)),
+     PostTag.__table__, ("post_id", "tag_id")),
+    ("related_posts",
+     select(RelatedPost.post_id, RelatedPost.related_id)
+     .join(Post, Post.id == RelatedPost.post_id)
+     .where(_deleted(Post)),
+     RelatedPost.__table__, ("post_id", "related_id")),
+    ("related_posts",
+     select(RelatedPost.post_id, RelatedPost.related_id)
+     .join(Post, Post.id == RelatedPost.related_id)
+     .where(_deleted(Post)),
+     RelatedPost.__table__, ("post_id", "related_id")),
+    ("tag_pairs",
+     select(TagPair.tag_id, TagPair.other_id)
+     .join(Tag, Tag.id == TagPair.tag_id)
+     .where(_deleted(Tag)),
+     TagPair.__table__, ("tag_id", "other_id")),
+    ("tag_pairs",
+     select(TagPair.tag_id, TagPair.other_id)
+     .join(Tag, Tag.id == TagPair.other_id)
+     .where(_deleted(Tag)),
+     TagPair.__table__, ("tag_id", "other_id")),
+    ("posts",
+     select(Post.id).where(_deleted(Post)),
+     Post.__table__, ("id",)),
+    ("tags",
+     select(Tag.id).where(_deleted(Tag)),
+     Tag.__table__, ("id",)),
+    ("users",
+     select(User.id)
+     .where(_deleted(User), ~exists().where(Post.user_id == User.id)),
+     User.__table__, ("id",)),
+]
+
+
+class Purger:
+    """Runs the purge steps in batches, at a limited rate."""
+
+    def __init__(self, batch_size=1000, rows_per_second=0, sleep=time.sleep):
+        self.batch_size = batch_size
+        self.rows_per_second = rows_per_second
+        self.sleep = sleep
+        self.counts = Counter()
+        self._rows = 0
+        self._start = None
+
+    def run(self, progress=None):
+        """Purge everything soft-deleted so far; returns rows per table.
+
+        `progress(table, rows)` is called after each batch.
+        """
+
+        self._start = time.monotonic()
+        for name, keys, table, columns in STEPS:
+            while True:
+                count = self.purge_batch(keys, table, columns)
+                if not count:
+                    break
+                self.counts[name] += count
+                if progress is not None:
+                    progress(name, count)
+                self.throttle(count)
+
+        return self.counts
+
+    def purge_batch(self, keys, table, columns):
+        """Delete one batch of rows; returns how many."""
+
+        batch = db.session.execute(
+            keys.limit(self.batch_size)
+            .execution_options(include_deleted=True)).all()
+        if not batch:
+            db.session.commit()
+            return 0
+
+        # on the table, not the model: nothing the ORM hooks care about
+        # changes when rows that were already deleted go
+        if len(columns) == 1:
+            where = table.c[columns[0]].in_([key for key, in batch])
+        else:
+            where = tuple_(*[table.c[c] for c in columns]).in_(
+                [tuple(row) for row in batch])
+
+        db.session.execute(delete(table).where(where))
+        db.session.commit()
+        return len(batch)
+
+    def throttle(self, rows):
+        """Sleep long enough to keep the purge under rows_per_second."""
+
+        self._rows += rows
+        if self.rows_per_second:
+            ahead = (self._rows / self.rows_per_second
+                     - (time.monotonic() - self._start))
+            if ahead > 0:
+                self.sleep(ahead)
+
+
+def purge_deleted(batch_size=1000, rows_per_second=0, progress=None):
+    """Hard-delete every soft-deleted row; returns rows per table."""
+
+    return Purger(batch_size, rows_per_second).run(progress)
@@ -0,0 +1,168 @@
+"""Catch N+1 queries, slow statements and blown query budgets per request.
+
+Every statement a request runs is reduced to its shape (the SQL with
+literals and placeholders replaced by ?). A shape that repeats more than
+QUERY_REPEAT_LIMIT times is almost always a query inside a loop; a
+statement slower than SLOW_QUERY_MS is slow. Views can also declare how
+many statements they may run with @query_budget(n).
+
+Findings are logged on the "blogly.queries" logger with the view and the
+template line (or application line) that issued the statement. With
+QUERY_CHECK=raise, repeats and blown budgets raise QueryCheckError instead,
+which is what the test suite runs with. QUERY_CHECK=off installs nothing.
+
+Connections with the query_check=False execution option aren't checked;
+the replica health checks use it, since they run in whichever request
+happens to come along.
+
+Streamed pages run their query in the view and fetch rows while the
+response goes out; statements issued after the view returns (lazy loads
+from a streamed template) come too late to be checked.
+"""
+
+import logging
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from models import db
+
+log = logging.getLogger("blogly.queries")
+
+HERE = os.path.abspath(__file__)
+
+
+class QueryCheckError(RuntimeError):
+    """A request ran statements in a loop or went over its query budget."""
+
+
+def query_budget(limit):
+    """Declare the most statements a view may run per request."""
+
+    def decorator(view):
+        view.query_budget = limit
+        return view
+
+    return decorator
+
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|:\w+|\$\d+")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+def sql_shape(statement):
+    """The statement with literals, placeholders and IN lists normalized."""
+
+    shape = _STRING.sub("?", statement)
+    shape = _PLACEHOLDER.sub("?", shape)
+    shape = _NUMBER.sub("?", shape)
+    shape = _LIST.sub("(?)", shape)
+    return _SPACE.sub(" ", shape).strip()
+
+
+def statement_origin(root_path):
+    """Where the running statement came from: a template line if it was
+    issued while rendering, else the innermost line of application code."""
+
+    app_line = None
+    frame = sys._getframe(1)
+
+    while frame is not None:
+        template = frame.f_globals.get("__jinja_template__")
+        if template is not None:
+            line = template.get_corresponding_lineno(frame.f_lineno)
+            return f"{template.name}:{line}"
+
+        filename = frame.f_code.co_filename
+        if (app_line is None and not filename.startswith("<")
+                and os.path.abspath(filename).startswith(root_path)
+                and os.path.abspath(filename) != HERE
+                and "site-packages" not in filename):
+            app_line = (f"{os.path.relpath(filename, root_path)}:"
+                        f"{frame.f_lineno}")
+
+        frame = frame.f_back
+
+    return app_line
+
+
+def init_query_check(app):
+    """Install the per-request statement checks, unless QUERY_CHECK=off."""
+
+    if app.config['QUERY_CHECK'] == "off":
+        return
+
+    root_path = os.path.abspath(app.root_path) + os.sep
+
+    def start_query(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("check_start", []).append(time.perf_counter())
+
+    def check_query(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - conn.info["check_start"].pop()
+        if (not has_request_context()
+                or not conn.get_execution_options().get("query_check", True)):
+            return
+
+        # insertmanyvalues may split one execute() into a cursor call per
+        # row (SQLite can't batch INSERT .. RETURNING); that isn't a loop
+        if context is not None and conn.info.get("check_context") is context:
+            return
+        conn.info["check_context"] = context
+
+        shapes = g.setdefault("query_shapes", Counter())
+        shape = sql_shape(statement)
+        shapes[shape] += 1
+
+        # look up the origin once per offending shape, when it first
+        # crosses the limit, so well-behaved requests never walk the stack
+        if shapes[shape] == current_app.config['QUERY_REPEAT_LIMIT'] + 1:
+            g.setdefault("query_findings", []).append(
+                (shape, statement_origin(root_path)))
+
+        slow_ms = current_app.config['SLOW_QUERY_MS']
+        if slow_ms is not None and elapsed * 1000 > slow_ms:
+            log.warning("slow query in %s (%.1f ms) from %s: %s",
+                        request.endpoint, elapsed * 1000,
+                        statement_origin(root_path), shape)
+
+    # the primary and any read replicas
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, "before_cursor_execute", start_query)
+            event.listen(engine, "after_cursor_execute", check_query)
+
+    @app.before_request
+    def reset_queries():
+        g.query_shapes = Counter()
+        g.query_findings = []
+
+    @app.after_request
+    def report_queries(response):
+        shapes = g.get("query_shapes", Counter())
+        problems = []
+
+        for shape, origin in g.get("query_findings", []):
+            problems.append(f"{shape!r} ran {shapes[shape]} times, "
+                            f"first repeated from {origin}")
+
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, "query_budget", None)
+        total = sum(shapes.values())
+        if budget is not None and total > budget:
+            problems.append(f"{total} statements, budget is {budget}")
+
+        if problems:
+            message = f"{request.endpoint}: " + "; ".join(problems)
+            if current_app.config['QUERY_CHECK'] == "raise":
+                raise QueryCheckError(message)
+            log.warning(message)
+
+        return response
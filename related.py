@@ -0,0 +1,177 @@
+"""Related posts, precomputed into the related_posts table.
+
+A post's related posts are the ones sharing the most tags with it, newest
+first among ties. Only the RELATED_CANDIDATES newest posts of each of its tags
+are compared, so a post with a very popular tag costs the same to refresh as
+any other. "Newest" means the highest id, so that the candidates are one range
+of ix_posts_tags_tag_id; posts imported with older created_at dates count as
+new here. The post page reads the top RELATED_POSTS_LIMIT with one lookup on
+the primary key; tag pages read related tags straight from tag_pairs (see
+models, Related content).
+
+When a transaction retags or deletes posts, the refresh_related job
+recomputes their lists and the lists they appear on. Other posts pick up a new
+neighbour the next time they're refreshed themselves. `flask blog
+rebuild-related` recomputes tag_pairs and every list from posts_tags in a
+couple of set-based statements, e.g. after a bulk import.
+"""
+
+from flask import current_app, has_app_context
+from sqlalchemy import and_, delete, event, func, insert, literal, select
+from sqlalchemy.orm import aliased
+
+from jobs import enqueue, job
+from models import (db, utcnow, tag_pairs_select, Post, PostTag, RelatedPost,
+                    Tag, TagPair)
+
+# posts per IN list when refreshing many lists
+REFRESH_BATCH_SIZE = 500
+
+
+def related_posts_select(post_ids=None, candidates=100, limit=5):
+    """(post_id, related_id, shared_tags) for the `limit` most related posts
+    of each live post, or of just `post_ids`."""
+
+    live_post = and_(Post.id == PostTag.post_id, Post.deleted_at.is_(None))
+    live_tag = and_(Tag.id == PostTag.tag_id, Tag.deleted_at.is_(None))
+
+    mine = select(PostTag.post_id, PostTag.tag_id).join(Post, live_post)
+    if post_ids is not None:
+        mine = mine.where(PostTag.post_id.in_(post_ids))
+    mine = mine.join(Tag, live_tag).subquery("mine")
+
+    if post_ids is None:
+        # every tag's posts, numbered newest first in one pass
+        numbered = (select(PostTag.tag_id, PostTag.post_id,
+                           func.row_number().over(
+                               partition_by=PostTag.tag_id,
+                               order_by=PostTag.post_id.desc())
+                           .label("position"))
+                    .join(Post, live_post)).subquery("numbered")
+        newest = (select(numbered.c.tag_id, numbered.c.post_id)
+                  .where(numbered.c.position <= candidates))
+    else:
+        # the oldest candidate of each of the posts' tags, reached by walking
+        # the tag's index back from its newest post: `candidates` steps
+        # however many posts the tag has
+        tags = select(mine.c.tag_id).distinct().subquery("batch_tags")
+        within = aliased(PostTag)
+        oldest = (select(within.post_id)
+                  .join(Post, and_(Post.id == within.post_id,
+                                   Post.deleted_at.is_(None)))
+                  .where(within.tag_id == tags.c.tag_id)
+                  .order_by(within.post_id.desc())
+                  .offset(candidates - 1).limit(1)
+                  .correlate(tags).scalar_subquery())
+        bounds = select(tags.c.tag_id,
+                        func.coalesce(oldest, 0).label("oldest")
+                        ).subquery("bounds")
+        newest = (select(PostTag.tag_id, PostTag.post_id)
+                  .join(bounds, and_(bounds.c.tag_id == PostTag.tag_id,
+                                     PostTag.post_id >= bounds.c.oldest))
+                  .join(Post, live_post))
+    newest = newest.subquery("newest")
+
+    shared = (select(mine.c.post_id, newest.c.post_id.label("related_id"),
+                     func.count().label("shared_tags"))
+              .join(newest, and_(newest.c.tag_id == mine.c.tag_id,
+                                 newest.c.post_id != mine.c.post_id))
+              .group_by(mine.c.post_id, newest.c.post_id)).subquery("shared")
+
+    ranked = select(
+        shared,
+        func.row_number().over(partition_by=shared.c.post_id,
+                               order_by=(shared.c.shared_tags.desc(),
+                                         shared.c.related_id.desc()))
+        .label("position")).subquery("ranked")
+
+    return (select(ranked.c.post_id, ranked.c.related_id,
+                   ranked.c.shared_tags)
+            .where(ranked.c.position <= limit))
+
+
+def write_related_posts(post_ids=None):
+    """Replace the related posts of `post_ids` (all posts if None) with a
+    DELETE and one INSERT .. SELECT; returns the rows written."""
+
+    config = current_app.config
+    rows = related_posts_select(post_ids, config['RELATED_CANDIDATES'],
+                                config['RELATED_POSTS_LIMIT'])
+
+    if post_ids is None:
+        db.session.execute(delete(RelatedPost))
+    else:
+        db.session.execute(
+            delete(RelatedPost).where(RelatedPost.post_id.in_(post_ids)))
+
+    return db.session.execute(
+        insert(RelatedPost).from_select(
+            ["post_id", "related_id", "shared_tags", "refreshed_at"],
+            rows.add_columns(literal(utcnow(), db.DateTime)))).rowcount
+
+
+def _batches(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), REFRESH_BATCH_SIZE):
+        yield ids[start:start + REFRESH_BATCH_SIZE]
+
+
+def refresh_related_posts(post_ids):
+    """Recompute the lists of `post_ids`, then of every post on either side
+    of them (listing them before, or listed by them now); returns how many
+    lists were refreshed."""
+
+    post_ids = set(post_ids)
+    neighbours = set()
+    for batch in _batches(post_ids):
+        neighbours.update(db.session.execute(
+            select(RelatedPost.post_id)
+            .where(RelatedPost.related_id.in_(batch))).scalars())
+        write_related_posts(batch)
+        neighbours.update(db.session.execute(
+            select(RelatedPost.related_id)
+            .where(RelatedPost.post_id.in_(batch))).scalars())
+
+    neighbours -= post_ids
+    for batch in _batches(neighbours):
+        write_related_posts(batch)
+
+    return len(post_ids) + len(neighbours)
+
+
+@job
+def refresh_related(post_ids):
+    """Refresh related posts after `post_ids` were retagged or deleted."""
+
+    refresh_related_posts(post_ids)
+    db.session.commit()
+
+
+def rebuild_related():
+    """Recompute tag_pairs and related_posts from posts_tags; returns rows
+    written per table."""
+
+    db.session.execute(delete(TagPair))
+    pairs = db.session.execute(
+        insert(TagPair).from_select(["tag_id", "other_id", "post_count"],
+                                    tag_pairs_select())).rowcount
+    posts = write_related_posts()
+    db.session.commit()
+
+    return {"tag_pairs": pairs, "related_posts": posts}
+
+
+############################# Refresh on commit #################################
+
+def watch_related(session):
+    """Queue refresh_related for the posts a transaction retagged."""
+
+    @event.listens_for(session, "before_commit")
+    def queue_refresh(session):
+        post_ids = session.info.pop('retagged_posts', None)
+        if post_ids and has_app_context():
+            enqueue(session, "refresh_related", post_ids=sorted(post_ids))
+
+    @event.listens_for(session, "after_rollback")
+    def forget_retagged(session):
+        session.info.pop('retagged_posts', None)
@@ -0,0 +1,180 @@
+"""Send reads from GET requests to read replicas.
+
+Replicas are extra SQLAlchemy binds ("replica0", "replica1", ...) built
+from REPLICA_URLS. RoutingSession, the session class behind db.session,
+sends a SELECT to a replica when all of these hold:
+
+- it runs in a GET or HEAD request,
+- the session hasn't written anything in this request,
+- the client hasn't written anything in the last READ_YOUR_WRITES_SECONDS,
+  which covers the GET that follows a POST's redirect, and
+- the code isn't inside reading_from_primary().
+
+Everything else (writes, SELECT .. FOR UPDATE, CLI commands, and reads
+that will be cached for everyone) goes to the primary. Replicas take turns,
+one per request, and a replica is skipped when its last health check
+failed. Checks run at most every REPLICA_CHECK_SECONDS.
+"""
+
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import Select
+
+log = logging.getLogger("blogly.replicas")
+
+PRIMARY_COOKIE = "read_primary_until"
+
+
+class ReplicaSet:
+    """Round-robin over the replica binds that pass their health checks."""
+
+    def __init__(self, keys, check_seconds=10):
+        self.keys = keys
+        self.check_seconds = check_seconds
+        self._cycle = itertools.cycle(keys)
+        self._lock = threading.Lock()
+        # bind key -> (checked at, healthy)
+        self._health = {}
+
+    def choose(self, engines):
+        """The next healthy replica's engine, or None if all are down."""
+
+        for _ in self.keys:
+            with self._lock:
+                key = next(self._cycle)
+            if self.healthy(key, engines[key]):
+                return engines[key]
+        return None
+
+    def healthy(self, key, engine):
+        checked_at, healthy = self._health.get(key, (None, False))
+        if (checked_at is not None
+                and time.monotonic() - checked_at < self.check_seconds):
+            return healthy
+
+        try:
+            # not one of the request's own statements; see querycheck
+            with engine.connect() as conn:
+                conn.execution_options(query_check=False).execute(
+                    text("SELECT 1"))
+            healthy = True
+        except DBAPIError as exc:
+            log.warning("replica %s failed its health check: %s", key, exc)
+            healthy = False
+
+        self._health[key] = (time.monotonic(), healthy)
+        return healthy
+
+    def mark_down(self, key):
+        self._health[key] = (time.monotonic(), False)
+
+
+class RoutingSession(Session):
+    """Session that reads from a replica when that's safe; see above."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _can_use_replica(self, clause):
+            if 'replica' not in g:
+                g.replica = current_app.extensions['replicas'].choose(
+                    self._db.engines)
+            if g.replica is not None:
+                return g.replica
+
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+def _can_use_replica(session, clause):
+    return (has_request_context()
+            and 'replicas' in current_app.extensions
+            and isinstance(clause, Select)
+            and clause._for_update_arg is None
+            and not session._flushing
+            and request.method in ("GET", "HEAD")
+            and not g.get('db_wrote')
+            and not g.get('read_primary')
+            and request.cookies.get(PRIMARY_COOKIE, 0, type=float)
+            < time.time())
+
+
+@contextmanager
+def reading_from_primary():
+    """Read from the primary inside the block, e.g. to fill a shared cache
+    that a lagging replica would otherwise fill with stale data."""
+
+    previous = g.get('read_primary', False)
+    g.read_primary = True
+    try:
+        yield
+    finally:
+        g.read_primary = previous
+
+
+def configure_replicas(app):
+    """Add a bind for each REPLICA_URLS entry; call before db.init_app."""
+
+    urls = app.config['REPLICA_URLS']
+    if urls:
+        app.config['SQLALCHEMY_BINDS'] = {
+            **app.config.get('SQLALCHEMY_BINDS', {}),
+            **{f"replica{i}": url for i, url in enumerate(urls)},
+        }
+
+
+def init_replicas(app, db):
+    """Start routing reads to the replica binds, if there are any."""
+
+    keys = [f"replica{i}" for i in range(len(app.config['REPLICA_URLS']))]
+    if not keys:
+        return None
+
+    replicas = app.extensions['replicas'] = ReplicaSet(
+        keys, app.config['REPLICA_CHECK_SECONDS'])
+
+    def watch(key, engine):
+        @event.listens_for(engine, "handle_error")
+        def replica_error(context):
+            if context.is_disconnect:
+                replicas.mark_down(key)
+
+    with app.app_context():
+        for key in keys:
+            watch(key, db.engines[key])
+
+    @app.before_request
+    def reset_routing():
+        g.pop('replica', None)
+        g.db_wrote = False
+
+    @app.after_request
+    def remember_write(response):
+        if g.get('db_wrote'):
+            seconds = app.config['READ_YOUR_WRITES_SECONDS']
+            response.set_cookie(PRIMARY_COOKIE, str(time.time() + seconds),
+                                max_age=seconds, httponly=True)
+        return response
+
+    return replicas
+
+
+def watch_writes(session):
+    """Note on `g` when a request's session writes, so it stops reading
+    from replicas (which may not have the write yet)."""
+
+    @event.listens_for(session, "after_flush")
+    def wrote_on_flush(session, flush_context):
+        if has_request_context():
+            g.db_wrote = True
+
+    @event.listens_for(session, "do_orm_execute")
+    def wrote_in_bulk(orm_execute_state):
+        state = orm_execute_state
+        if has_request_context() and not state.is_select:
+            g.db_wrote = True
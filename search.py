@@ -0,0 +1,87 @@
+"""Full-text search over posts.
+
+Postgres ranks the generated posts.search_vector column with ts_rank_cd and
+builds snippets with ts_headline; SQLite falls back to the posts_fts FTS5
+table with bm25() and snippet(). Both produce the same result rows, so views
+and pagination don't care which one ran.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import Float, column, func, literal_column, select, table
+
+from models import db, Post, PostTag, Tag
+
+# snippet highlight markers; private-use characters that never appear in
+# posts, swapped for <mark> tags once the snippet has been HTML-escaped
+MARK_START = "\ue000"
+MARK_END = "\ue001"
+
+SNIPPET_WORDS = 24
+
+
+def _postgres_search(terms):
+    vector = literal_column("posts.search_vector")
+    tsquery = func.websearch_to_tsquery("english", terms)
+    options = (f"StartSel={MARK_START}, StopSel={MARK_END}, "
+               f"MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}")
+
+    score = func.ts_rank_cd(vector, tsquery, type_=Float).label("score")
+    snippet = func.ts_headline(
+        "english", Post.content, tsquery, options).label("snippet")
+
+    query = (db.session.query(Post.id, Post.title, score, snippet)
+             .filter(vector.op("@@")(tsquery)))
+    return query, score
+
+
+def _sqlite_search(terms):
+    words = re.findall(r"\w+", terms)
+    # quote each word so FTS5 never sees operators or stray punctuation
+    match = " ".join(f'"{word}"' for word in words) or '""'
+
+    fts = table("posts_fts", column("rowid"))
+    fts_name = literal_column("posts_fts")
+
+    # bm25 is lower-is-better; negate it so both backends sort descending
+    score = (-func.bm25(fts_name, type_=Float)).label("score")
+    snippet = func.snippet(fts_name, 1, MARK_START, MARK_END, "…",
+                           SNIPPET_WORDS // 2).label("snippet")
+
+    query = (db.session.query(Post.id, Post.title, score, snippet)
+             .join(fts, fts.c.rowid == Post.id)
+             .filter(fts_name.op("MATCH")(match)))
+    return query, score
+
+
+def search_query(terms, tag=None, author=None):
+    """Build a ranked search query for `terms`.
+
+    Returns (query, order): page it with paginate(query, order,
+    descending=True). Rows have id, title, score and snippet attributes.
+    """
+
+    if db.engine.dialect.name == "postgresql":
+        query, score = _postgres_search(terms)
+    else:
+        query, score = _sqlite_search(terms)
+
+    if tag:
+        query = query.filter(Post.id.in_(
+            select(PostTag.post_id)
+            .join(Tag, Tag.id == PostTag.tag_id)
+            .where(Tag.name == tag)))
+
+    if author:
+        query = query.filter(Post.user_id == author)
+
+    return query, (score, Post.id)
+
+
+def highlight(snippet):
+    """Escape a snippet for HTML and turn its markers into <mark> tags."""
+
+    html = str(escape(snippet or ""))
+    return Markup(html.replace(MARK_START, "<mark>")
+                  .replace(MARK_END, "</mark>"))
@@ -1,5 +1,8 @@
 from models import db, User
-from app import app
+from app import create_app
+
+app = create_app()
+app.app_context().push()
 
 # Create all tables
 db.drop_all()
@@ -1,16 +1,48 @@
-from models import DEFAULT_IMAGE_URL, User, Post, Tag, PostTag
-from app import app, db
-from unittest import TestCase
+from models import (DEFAULT_IMAGE_URL, EXCERPT_LENGTH, User, Post, Tag,
+                    PostTag, TagPair, RelatedPost, Job, CacheVersion,
+                    summarize, soft_delete, live_criteria,
+                    repair_post_counts, utcnow,
+                    recent_posts_query, users_query, user_posts_query,
+                    tag_posts_query, related_posts_query, tag_pairs_select,
+                    USER_ORDER, POST_ORDER)
+from app import create_app, db
+from config import DevelopmentConfig, ProductionConfig, TestingConfig
+from datagen import generate
+from bulk import (export_csv, export_ndjson, export_records, import_records,
+                  read_csv, read_ndjson)
+from cache import LRUCache, RedisCache
+from pagination import encode_cursor, keyset_query, paginate
+from querycheck import QueryCheckError, query_budget, sql_shape
+from templating import precompile_templates
+from jobs import ThreadQueue, Worker, enqueue, job
+from purge import Purger
+from related import rebuild_related
+from vocabulary import get_tag_vocabulary, resolve_tags
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from fnmatch import fnmatch
+from flask import render_template
+from importlib.util import find_spec
+from jinja2 import DictLoader, TemplateSyntaxError
+from sqlalchemy import event, insert, text
+from unittest import TestCase, mock, skipUnless
+from xml.etree import ElementTree
+import asyncio
+import io
+import json
 import os
+import tempfile
+import threading
+import tracemalloc
 
-os.environ["DATABASE_URL"] = "postgresql:///blogly_test"
+# The testing profile turns on TESTING (so Flask errors are real errors,
+# rather than HTML pages with error info), leaves out the DebugToolbar and
+# uses TEST_DATABASE_URL, postgresql:///blogly_test by default.
+app = create_app("testing")
+app.app_context().push()
 
 
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+page_cache = app.extensions['page_cache']
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -19,6 +51,48 @@ app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 db.drop_all()
 db.create_all()
 
+# the async read path needs asgiref plus the async driver for this database
+ASYNC_DRIVER = {"postgresql": "asyncpg",
+                "sqlite": "aiosqlite"}.get(db.engine.dialect.name)
+HAS_ASYNC = bool(ASYNC_DRIVER and find_spec(ASYNC_DRIVER)
+                 and find_spec("asgiref") and find_spec("greenlet"))
+
+
+def clear_tables():
+    """Delete every row the tests write, children before their parents."""
+
+    for model in (RelatedPost, TagPair, PostTag, Tag, Post, User, Job):
+        model.query.delete()
+
+
+class QueryCountMixin:
+    """Lets a test cap the number of SQL statements a block may issue."""
+
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        """Fail if the block runs more than `limit` statements.
+
+        The session is emptied first so nothing is served from the identity
+        map of earlier setUp work.
+        """
+
+        db.session.expunge_all()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertLessEqual(
+            len(statements), limit,
+            f"{len(statements)} queries issued, budget was {limit}:\n"
+            + "\n".join(statements))
+
 
 class UserViewTestCase(TestCase):
     """Test views for users."""
@@ -29,10 +103,7 @@ class UserViewTestCase(TestCase):
         # As you add more models later in the exercise, you'll want to delete
         # all of their records before each test just as we're doing with the
         # User model below.
-        PostTag.query.delete()
-        Tag.query.delete()
-        Post.query.delete()
-        User.query.delete()
+        clear_tables()
 
         self.client = app.test_client()
 
@@ -78,7 +149,7 @@ class UserViewTestCase(TestCase):
                 'fname': "test2_first",
                 'lname': "test2_last",
                 'imgurl': "",
-            }, follow_redirects=True)
+            }, follow_redirects=True, buffered=True)
             html = resp.text
 
             # test if it is in the database
@@ -139,10 +210,7 @@ class PostViewTestCase(TestCase):
         # As you add more models later in the exercise, you'll want to delete
         # all of their records before each test just as we're doing with the
         # User model below.
-        PostTag.query.delete()
-        Tag.query.delete()
-        Post.query.delete()
-        User.query.delete()
+        clear_tables()
 
         self.client = app.test_client()
 
@@ -262,10 +330,7 @@ class TagViewTestCase(TestCase):
         # all of their records before each test just as we're doing with the
         # User model below.
 
-        PostTag.query.delete()
-        Tag.query.delete()
-        Post.query.delete()
-        User.query.delete()
+        clear_tables()
 
         self.client = app.test_client()
 
@@ -351,7 +416,7 @@ class TagViewTestCase(TestCase):
         with self.client as c:
             resp = c.post("/tags/new", data={
                 'name': 'test_new_tag'
-            }, follow_redirects=True)
+            }, follow_redirects=True, buffered=True)
 
             html = resp.text
 
@@ -380,7 +445,7 @@ class TagViewTestCase(TestCase):
         with self.client as c:
             resp = c.post(f"/tags/{self.tag_id}/edit", data={
                 'name': 'an updated tag'
-            }, follow_redirects=True)
+            }, follow_redirects=True, buffered=True)
 
             html = resp.text
 
@@ -390,7 +455,8 @@ class TagViewTestCase(TestCase):
 
     def test_delete_tag(self):
         with self.client as c:
-            resp = c.post(f"/tags/{self.tag_id}/delete", follow_redirects=True)
+            resp = c.post(f"/tags/{self.tag_id}/delete",
+                          follow_redirects=True, buffered=True)
             html = resp.text
 
             self.assertEqual(resp.status_code, 200)
@@ -452,3 +518,2577 @@ class TagViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("test_tag_3", html)
             self.assertNotIn("test_tag_1", html)
+
+
+######################### PAGINATION ###########################################
+
+class PaginationTestCase(TestCase):
+    """Test keyset pagination of list pages."""
+
+    def setUp(self):
+        """Create five users with colliding last names."""
+
+        clear_tables()
+
+        self.client = app.test_client()
+
+        db.session.add_all([
+            User(first_name=first, last_name=last)
+            for first, last in [("a", "smith"), ("b", "smith"),
+                                ("c", "jones"), ("d", "brown"),
+                                ("e", "smith")]])
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+
+    def test_walk_forward_and_back(self):
+        names = []
+        cursor = None
+        pages = []
+        while True:
+            page = paginate(User.query, USER_ORDER, cursor=cursor, per_page=2)
+            pages.append([u.first_name for u in page])
+            names.extend(u.first_name for u in page)
+            if not page.next_cursor:
+                break
+            cursor = page.next_cursor
+
+        self.assertEqual(names, ["d", "c", "a", "b", "e"])
+        self.assertEqual(pages, [["d", "c"], ["a", "b"], ["e"]])
+
+        back = paginate(User.query, USER_ORDER,
+                        cursor=page.prev_cursor, per_page=2)
+        self.assertEqual([u.first_name for u in back], ["a", "b"])
+        back = paginate(User.query, USER_ORDER,
+                        cursor=back.prev_cursor, per_page=2)
+        self.assertEqual([u.first_name for u in back], ["d", "c"])
+        self.assertIsNone(back.prev_cursor)
+
+    def test_list_users_page_links(self):
+        with self.client as c:
+            resp = c.get("/users?per_page=2")
+            html = resp.text
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<li>d brown</li>", html)
+            self.assertNotIn("<li>a smith</li>", html)
+            self.assertIn("Next", html)
+            self.assertNotIn("Previous", html)
+
+    def test_bad_cursor(self):
+        with self.client as c:
+            resp = c.get("/users?cursor=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_cursor_of_wrong_types(self):
+        for values in (["smith", "a", "1"], ["smith", 7, 1],
+                       ["smith", "a", True], ["smith", "a", 1.5],
+                       ["smith", "a", None]):
+            resp = self.client.get(
+                "/users?cursor=" + encode_cursor(values, "n"))
+            self.assertEqual(resp.status_code, 400, values)
+
+        resp = self.client.get(
+            "/api/v1/posts?cursor=" + encode_cursor(["2020-01-01", 1], "n"))
+        self.assertEqual(resp.status_code, 400)
+
+        # a whole number will do for a float sort key, like search scores
+        resp = self.client.get(
+            "/search?q=post&cursor=" + encode_cursor([0, 1], "n"))
+        self.assertEqual(resp.status_code, 200)
+
+
+######################### TAG ASSIGNMENT #######################################
+
+class TagAssignmentTestCase(QueryCountMixin, TestCase):
+    """Tagging a post costs the same few statements however many tags."""
+
+    def setUp(self):
+        """Create a user, a post and twenty tags."""
+
+        clear_tables()
+
+        self.client = app.test_client()
+
+        user = User(first_name="tagger_first", last_name="tagger_last")
+        tags = [Tag(name=f"bulk_tag_{i}") for i in range(20)]
+        post = Post(title="bulk_title", content="bulk_content",
+                    user=user, tags=tags[:10])
+        db.session.add_all([user, post] + tags)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.post_id = post.id
+        self.names = [tag.name for tag in tags]
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+
+    def tag_names(self, post_id):
+        return sorted(tag.name for tag in Post.query.get(post_id).tags)
+
+    def test_new_post_with_many_tags(self):
+        with self.client as c:
+            # the author, the post, the vocabulary, its tags and their pairs
+            with self.assertMaxQueries(5):
+                resp = c.post(f"/users/{self.user_id}/posts/new", data={
+                    'title': "many tags",
+                    'content': "content",
+                    'tag': self.names,
+                })
+            self.assertEqual(resp.status_code, 302)
+
+        post = Post.query.filter(Post.title == "many tags").one()
+        self.assertEqual(self.tag_names(post.id), sorted(self.names))
+
+    def test_edit_post_writes_only_the_diff(self):
+        wanted = self.names[5:15]
+
+        with self.client as c:
+            with self.assertMaxQueries(7) as statements:
+                resp = c.post(f"/posts/{self.post_id}/edit", data={
+                    'title': "bulk_title",
+                    'content': "bulk_content",
+                    'tag': wanted,
+                })
+            self.assertEqual(resp.status_code, 302)
+
+        inserts = [s for s in statements
+                   if s.startswith("INSERT INTO posts_tags")]
+        deletes = [s for s in statements if s.startswith("DELETE")]
+        pairs = [s for s in statements if s.startswith("INSERT INTO tag_pairs")]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(len(deletes), 1)
+        self.assertEqual(len(pairs), 1)
+        self.assertEqual(self.tag_names(self.post_id), sorted(wanted))
+
+    def test_edit_post_unchanged_tags(self):
+        with self.client as c:
+            with self.assertMaxQueries(4) as statements:
+                c.post(f"/posts/{self.post_id}/edit", data={
+                    'title': "bulk_title",
+                    'content': "bulk_content",
+                    'tag': self.names[:10],
+                })
+
+        self.assertFalse([s for s in statements
+                          if s.startswith(("INSERT", "DELETE"))])
+
+
+######################### COUNTERS #############################################
+
+class PostCountTestCase(TestCase):
+    """users.post_count and tags.post_count follow every write."""
+
+    def setUp(self):
+        """Create two users and three tags, with no posts."""
+
+        clear_tables()
+
+        self.client = app.test_client()
+
+        users = [User(first_name=f"count{i}", last_name="user")
+                 for i in range(2)]
+        tags = [Tag(name=f"count_tag_{i}") for i in range(3)]
+        db.session.add_all(users + tags)
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.tag_ids = [tag.id for tag in tags]
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+
+    def counts(self):
+        db.session.expire_all()
+        return ([User.query.get(i).post_count for i in self.user_ids],
+                [Tag.query.get(i).post_count for i in self.tag_ids])
+
+    def test_counts_follow_posts_and_tags(self):
+        user_id = self.user_ids[0]
+
+        with self.client as c:
+            c.post(f"/users/{user_id}/posts/new", data={
+                'title': "one", 'content': "x",
+                'tag': ["count_tag_0", "count_tag_1"]})
+            c.post(f"/users/{user_id}/posts/new", data={
+                'title': "two", 'content': "x", 'tag': ["count_tag_0"]})
+            self.assertEqual(self.counts(), ([2, 0], [2, 1, 0]))
+
+            post_id = Post.query.filter_by(title="one").one().id
+            c.post(f"/posts/{post_id}/edit", data={
+                'title': "one", 'content': "x", 'tag': ["count_tag_2"]})
+            self.assertEqual(self.counts(), ([2, 0], [1, 0, 1]))
+
+            c.post(f"/posts/{post_id}/delete")
+            self.assertEqual(self.counts(), ([1, 0], [1, 0, 0]))
+
+            c.patch("/api/v1/posts", json=[{
+                "id": Post.query.filter_by(title="two").one().id,
+                "user_id": self.user_ids[1]}])
+            self.assertEqual(self.counts(), ([0, 1], [1, 0, 0]))
+
+    def test_repair_command(self):
+        db.session.add(Post(title="p", content="x", user_id=self.user_ids[0],
+                            tags=[Tag.query.get(self.tag_ids[0])]))
+        db.session.commit()
+        User.query.update({"post_count": 99})
+        Tag.query.update({"post_count": 99})
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["blog", "repair-counts"])
+
+        self.assertIn("2 users and 3 tags", result.output)
+        self.assertEqual(self.counts(), ([1, 0], [1, 0, 0]))
+
+    def test_sort_by_popularity(self):
+        db.session.add_all([
+            Post(title="p", content="x", user_id=self.user_ids[1],
+                 tags=[Tag.query.get(self.tag_ids[2])]),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            html = c.get("/users?sort=popular").text
+            self.assertLess(html.index("count1 user"), html.index("count0 user"))
+            self.assertIn("1 posts", html)
+
+            html = c.get("/tags?sort=popular&per_page=1").text
+            self.assertIn("count_tag_2", html)
+            self.assertNotIn("count_tag_0", html)
+
+
+######################### CACHING ##############################################
+
+class FakeRedis:
+    """Local stand-in for the slice of the Redis client RedisCache uses."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode()
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, pattern):
+        return [key for key in self.data if fnmatch(key, pattern)]
+
+
+class CacheBackendTestCase(TestCase):
+    """Test the cache backends on their own."""
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+
+        self.assertEqual(cache.get("a"), "1")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "3")
+
+    def test_lru_ttl(self):
+        cache = LRUCache(ttl=-1)
+        cache.set("a", "1")
+        self.assertIsNone(cache.get("a"))
+
+    def test_redis_cache(self):
+        client = FakeRedis()
+        cache = RedisCache(client, prefix="test:")
+        cache.set("a", "<h1>hi</h1>")
+
+        self.assertEqual(cache.get("a"), "<h1>hi</h1>")
+        self.assertIn("test:a", client.data)
+
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+
+        cache.set("b", "x")
+        cache.clear()
+        self.assertEqual(client.data, {})
+
+    def test_redis_down_is_a_miss(self):
+        client = mock.Mock(**{f"{name}.side_effect": ConnectionError
+                              for name in ("get", "set", "delete",
+                                           "scan_iter")})
+        cache = RedisCache(client, errors=ConnectionError)
+
+        with self.assertLogs("blogly.cache", "WARNING") as logs:
+            cache.set("a", "1")
+            self.assertIsNone(cache.get("a"))
+            cache.delete("a")
+            cache.clear()
+        self.assertEqual(len(logs.records), 4)
+
+
+class HomepageCacheTestCase(QueryCountMixin, TestCase):
+    """The homepage is cached and dropped whenever what it shows changes."""
+
+    def setUp(self):
+        """Create a user with a post, and start from an empty cache."""
+
+        clear_tables()
+
+        self.client = app.test_client()
+
+        user = User(first_name="cache_first", last_name="cache_last")
+        post = Post(title="cached_title", content="cached_content", user=user)
+        db.session.add_all([user, post])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.post_id = post.id
+        page_cache.clear()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+
+    def test_second_hit_skips_database(self):
+        with self.client as c:
+            c.get("/")
+            with self.assertMaxQueries(0):
+                resp = c.get("/")
+
+            self.assertIn("cached_title", resp.text)
+
+    def test_new_post_invalidates(self):
+        with self.client as c:
+            c.get("/")
+            c.post(f"/users/{self.user_id}/posts/new", data={
+                'title': "fresh_title",
+                'content': "fresh_content",
+            })
+            self.assertIn("fresh_title", c.get("/").text)
+
+    def test_edit_post_invalidates(self):
+        with self.client as c:
+            c.get("/")
+            c.post(f"/posts/{self.post_id}/edit", data={
+                'title': "edited_title",
+                'content': "edited_content",
+            })
+            self.assertIn("edited_title", c.get("/").text)
+
+    def test_delete_post_invalidates(self):
+        with self.client as c:
+            c.get("/")
+            c.post(f"/posts/{self.post_id}/delete")
+            self.assertNotIn("cached_title", c.get("/").text)
+
+    def test_rename_author_invalidates(self):
+        with self.client as c:
+            c.get("/")
+            c.post(f"/users/{self.user_id}/edit", data={
+                'fname': "renamed_first",
+                'lname': "",
+                'imgurl': "",
+            })
+            self.assertIn("renamed_first cache_last", c.get("/").text)
+
+    def test_delete_user_invalidates(self):
+        with self.client as c:
+            c.get("/")
+            c.post(f"/users/{self.user_id}/delete")
+            self.assertNotIn("cache_first", c.get("/").text)
+
+    def test_rollback_keeps_cache(self):
+        with self.client as c:
+            c.get("/")
+            db.session.add(Post(title="rolled_back", content="x",
+                                user_id=self.user_id))
+            db.session.flush()
+            db.session.rollback()
+
+            with self.assertMaxQueries(0):
+                resp = c.get("/")
+            self.assertNotIn("rolled_back", resp.text)
+
+
+######################### CONDITIONAL REQUESTS #################################
+
+class ConditionalRequestTestCase(QueryCountMixin, TestCase):
+    """Read views answer revalidation with 304 when nothing changed."""
+
+    def setUp(self):
+        """Create a user with a tagged post."""
+
+        clear_tables()
+
+        self.client = app.test_client()
+
+        user = User(first_name="etag_first", last_name="etag_last")
+        tag = Tag(name="etag_tag")
+        post = Post(title="etag_title", content="etag_content",
+                    user=user, tags=[tag])
+        db.session.add_all([user, tag, post])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.post_id = post.id
+        self.tag_id = tag.id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+
+    def assertRevalidates(self, url):
+        """GET `url`, then check a conditional GET is a cheap 304."""
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.get_etag()[0]
+        self.assertTrue(etag)
+        self.assertIsNotNone(resp.last_modified)
+
+        with self.assertMaxQueries(1):
+            resp = self.client.get(url,
+                                   headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+
+        return etag
+
+    def test_read_views_revalidate(self):
+        for url in ["/", f"/users/{self.user_id}",
+                    f"/posts/{self.post_id}", f"/tags/{self.tag_id}"]:
+            self.assertRevalidates(url)
+
+    def test_if_modified_since(self):
+        with self.client as c:
+            resp = c.get(f"/posts/{self.post_id}")
+            resp = c.get(f"/posts/{self.post_id}", headers={
+                'If-Modified-Since': resp.headers['Last-Modified']})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_edit_post_changes_etag(self):
+        etag = self.assertRevalidates(f"/posts/{self.post_id}")
+        with self.client as c:
+            c.post(f"/posts/{self.post_id}/edit", data={
+                'title': "etag_title",
+                'content': "etag_content",
+            })
+            resp = c.get(f"/posts/{self.post_id}",
+                         headers={'If-None-Match': f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("etag_tag", resp.text)
+
+    def test_related_changes_change_etag(self):
+        etag = self.assertRevalidates(f"/posts/{self.post_id}")
+        with self.client as c:
+            c.post(f"/tags/{self.tag_id}/edit", data={'name': "renamed_tag"})
+            resp = c.get(f"/posts/{self.post_id}",
+                         headers={'If-None-Match': f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("renamed_tag", resp.text)
+
+            etag = resp.get_etag()[0]
+            c.post(f"/users/{self.user_id}/edit", data={
+                'fname': "renamed_first", 'lname': "", 'imgurl': ""})
+            resp = c.get(f"/posts/{self.post_id}",
+                         headers={'If-None-Match': f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("renamed_first", resp.text)
+
+    def test_post_writes_change_list_etags(self):
+        urls = [f"/users/{self.user_id}", f"/tags/{self.tag_id}"]
+        etags = {url: self.assertRevalidates(url) for url in urls}
+
+        for url in urls:
+            # the user's or tag's own row carries the version
+            with self.assertMaxQueries(1) as statements:
+                self.client.get(url,
+                                headers={'If-None-Match': f'"{etags[url]}"'})
+            self.assertNotIn("JOIN posts", statements[0])
+            self.assertNotIn("FROM posts", statements[0])
+
+        self.client.post(f"/posts/{self.post_id}/edit", data={
+            'title': "edited_title", 'content': "etag_content",
+            'tag': ["etag_tag"]})
+
+        for url in urls:
+            resp = self.client.get(
+                url, headers={'If-None-Match': f'"{etags[url]}"'})
+            self.assertEqual(resp.status_code, 200, url)
+            self.assertIn("edited_title", resp.text)
+
+    def test_missing_resource(self):
+        with self.client as c:
+            self.assertEqual(c.get("/posts/0").status_code, 404)
+
+
+######################### FEEDS ################################################
+
+class FeedTestCase(QueryCountMixin, TestCase):
+    """Atom feeds for the site, users and tags."""
+
+    ATOM = "{http://www.w3.org/2005/Atom}"
+
+    def setUp(self):
+        """Two users; three posts, two of them tagged."""
+
+        clear_tables()
+        page_cache.clear()
+
+        self.client = app.test_client()
+
+        tag = Tag(name="feed_tag")
+        ann = User(first_name="Ann", last_name="Feed")
+        ben = User(first_name="Ben", last_name="Feed")
+        posts = [Post(title=f"feed post {i}", content=f"body <{i}>",
+                      user=ann if i < 2 else ben,
+                      tags=[tag] if i != 1 else [],
+                      created_at=datetime(2024, 1, 1) + timedelta(days=i))
+                 for i in range(3)]
+        db.session.add_all([tag, ann, ben] + posts)
+        db.session.commit()
+
+        self.user_id = ann.id
+        self.tag_id = tag.id
+        self.post_id = posts[0].id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def entries(self, resp):
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/atom+xml")
+        feed = ElementTree.fromstring(resp.data)
+        return [(e.find(self.ATOM + "title").text,
+                 e.find(self.ATOM + "content").text)
+                for e in feed.iter(self.ATOM + "entry")]
+
+    def test_feeds(self):
+        self.assertEqual(
+            [title for title, _ in self.entries(self.client.get("/feed.xml"))],
+            ["feed post 2", "feed post 1", "feed post 0"])
+
+        entries = self.entries(self.client.get(f"/users/{self.user_id}/feed.xml"))
+        self.assertEqual(entries, [("feed post 1", "body <1>"),
+                                   ("feed post 0", "body <0>")])
+
+        entries = self.entries(self.client.get(f"/tags/{self.tag_id}/feed.xml"))
+        self.assertEqual([title for title, _ in entries],
+                         ["feed post 2", "feed post 0"])
+
+        self.assertEqual(self.client.get("/tags/0/feed.xml").status_code, 404)
+
+    def test_feed_size(self):
+        with mock.patch.dict(app.config, FEED_SIZE=1):
+            entries = self.entries(self.client.get("/feed.xml"))
+        self.assertEqual(len(entries), 1)
+
+    def test_polling(self):
+        url = f"/users/{self.user_id}/feed.xml"
+        with self.client as c:
+            resp = c.get(url)
+            etag = resp.get_etag()[0]
+            last_modified = resp.headers['Last-Modified']
+
+            with self.assertMaxQueries(1):
+                resp = c.get(url, headers={'If-None-Match': f'"{etag}"'})
+            self.assertEqual(resp.status_code, 304)
+
+            with self.assertMaxQueries(1):
+                resp = c.get(url, headers={'If-Modified-Since': last_modified})
+            self.assertEqual(resp.status_code, 304)
+
+            # served from the cache while nothing changed
+            with self.assertMaxQueries(1):
+                resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+
+    def test_edits_show_up(self):
+        self.client.get(f"/tags/{self.tag_id}/feed.xml")
+
+        resp = self.client.post(f"/posts/{self.post_id}/edit", data={
+            "title": "renamed", "content": "c", "tag": ["feed_tag"]})
+        self.assertEqual(resp.status_code, 302)
+
+        entries = self.entries(self.client.get(f"/tags/{self.tag_id}/feed.xml"))
+        self.assertIn("renamed", [title for title, _ in entries])
+
+        entries = self.entries(self.client.get("/feed.xml"))
+        self.assertIn("renamed", [title for title, _ in entries])
+
+
+######################### API ##################################################
+
+class ApiTestCase(QueryCountMixin, TestCase):
+    """Test the JSON API."""
+
+    def setUp(self):
+        """Create a user, a tagged post and some tags."""
+
+        clear_tables()
+
+        self.client = app.test_client()
+
+        user = User(first_name="api_first", last_name="api_last")
+        tags = [Tag(name=f"api_tag_{i}") for i in range(3)]
+        post = Post(title="api_title", content="api_content",
+                    user=user, tags=tags[:1])
+        db.session.add_all([user, post] + tags)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.post_id = post.id
+        self.tag_id = tags[0].id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+
+    def test_list_and_get(self):
+        with self.client as c:
+            resp = c.get("/api/v1/users")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["data"][0]["first_name"], "api_first")
+            self.assertIsNone(resp.json["next"])
+
+            resp = c.get(f"/api/v1/posts/{self.post_id}")
+            self.assertEqual(resp.json["data"]["tags"], ["api_tag_0"])
+
+            resp = c.get("/api/v1/tags/0")
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.json["error"], "Not Found")
+
+    def test_sparse_fields_skip_content(self):
+        with self.client as c:
+            with self.assertMaxQueries(1) as statements:
+                resp = c.get("/api/v1/posts?fields=title")
+
+            self.assertEqual(resp.json["data"],
+                             [{"id": self.post_id, "title": "api_title"}])
+            self.assertNotIn("content", statements[0])
+
+            resp = c.get("/api/v1/posts?fields=bogus")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_pagination(self):
+        with self.client as c:
+            resp = c.get("/api/v1/tags?per_page=2&fields=name")
+            names = [tag["name"] for tag in resp.json["data"]]
+            resp = c.get(f"/api/v1/tags?per_page=2&fields=name"
+                         f"&cursor={resp.json['next']}")
+            names += [tag["name"] for tag in resp.json["data"]]
+
+            self.assertEqual(names, ["api_tag_0", "api_tag_1", "api_tag_2"])
+
+    def test_create_one(self):
+        with self.client as c:
+            resp = c.post("/api/v1/posts", json={
+                "title": "new", "content": "body",
+                "user_id": self.user_id, "tags": ["api_tag_1"]})
+
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(resp.json["data"]["tags"], ["api_tag_1"])
+
+            resp = c.post("/api/v1/posts", json={"title": "no body"})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_batch_create(self):
+        batch = [{"title": f"batch {i}", "content": "body",
+                  "user_id": self.user_id,
+                  "tags": ["api_tag_1", "api_tag_2"]} for i in range(10)]
+
+        with self.client as c:
+            # SQLite inserts the posts one at a time to get their ids back
+            # in order; Postgres batches them. The authors are checked with
+            # one IN query
+            with self.assertMaxQueries(len(batch) + 6) as statements:
+                resp = c.post("/api/v1/posts", json=batch)
+
+            self.assertEqual(resp.status_code, 201)
+            # one read of the tag names, from the tag vocabulary
+            self.assertEqual(len([s for s in statements
+                                  if s.startswith("SELECT tags")
+                                  or "FROM cache_versions" in s]), 1)
+            self.assertEqual(len([s for s in statements
+                                  if s.startswith("INSERT INTO posts_tags")]),
+                             1)
+            self.assertEqual(len([s for s in statements
+                                  if s.startswith("INSERT INTO tag_pairs")]),
+                             1)
+            self.assertEqual(len(resp.json["data"]), 10)
+            self.assertEqual(PostTag.query.count(), 21)
+
+    def test_invalid_values(self):
+        post = {"title": "new", "content": "body", "user_id": self.user_id}
+        invalid = [
+            ("posts", {**post, "content": 123}),
+            ("posts", {**post, "content": None}),
+            ("posts", {**post, "title": ["x"]}),
+            ("posts", {**post, "title": "x" * 51}),
+            ("posts", {**post, "user_id": "1"}),
+            ("posts", {**post, "user_id": True}),
+            ("posts", {**post, "user_id": None}),
+            ("tags", {"name": "x" * 26}),
+        ]
+
+        with self.client as c:
+            for kind, data in invalid:
+                resp = c.post(f"/api/v1/{kind}", json=data)
+                self.assertEqual(resp.status_code, 400, data)
+
+            resp = c.patch(f"/api/v1/users/{self.user_id}",
+                           json={"first_name": None})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json["message"], "first_name can't be null")
+
+        self.assertEqual(Post.query.count(), 1)
+
+    def test_unknown_authors(self):
+        deleted = User(first_name="gone", last_name="user")
+        db.session.add(deleted)
+        db.session.flush()
+        soft_delete(deleted)
+        db.session.commit()
+
+        with self.client as c:
+            for user_id in (0, deleted.id):
+                resp = c.post("/api/v1/posts", json=[
+                    {"title": "ok", "content": "body",
+                     "user_id": self.user_id},
+                    {"title": "orphan", "content": "body",
+                     "user_id": user_id}])
+                self.assertEqual(resp.status_code, 404)
+
+            resp = c.patch(f"/api/v1/posts/{self.post_id}",
+                           json={"user_id": 0})
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(Post.query.count(), 1)
+
+    def test_batch_is_all_or_nothing(self):
+        with self.client as c:
+            resp = c.post("/api/v1/tags", json=[
+                {"name": "fresh_tag"}, {"name": "api_tag_0"}])
+
+            self.assertEqual(resp.status_code, 409)
+            self.assertIsNone(Tag.query.filter_by(name="fresh_tag").first())
+
+    def test_update(self):
+        with self.client as c:
+            resp = c.patch(f"/api/v1/posts/{self.post_id}",
+                           json={"tags": ["api_tag_2"]})
+            self.assertEqual(resp.json["data"]["tags"], ["api_tag_2"])
+            self.assertEqual(resp.json["data"]["title"], "api_title")
+
+            resp = c.patch("/api/v1/users", json=[
+                {"id": self.user_id, "first_name": "batch_first"}])
+            self.assertEqual(resp.json["data"][0]["first_name"], "batch_first")
+
+            resp = c.patch("/api/v1/users", json=[{"id": 0}])
+            self.assertEqual(resp.status_code, 404)
+
+    def test_delete(self):
+        with self.client as c:
+            resp = c.delete(f"/api/v1/posts/{self.post_id}")
+            self.assertEqual(resp.status_code, 204)
+            self.assertIsNone(Post.query.get(self.post_id))
+
+
+######################### SEARCH ###############################################
+
+class SearchTestCase(TestCase):
+    """Test full-text search over posts."""
+
+    def setUp(self):
+        """Create posts by two users, some of them tagged."""
+
+        clear_tables()
+
+        self.client = app.test_client()
+
+        alice = User(first_name="alice", last_name="a")
+        bob = User(first_name="bob", last_name="b")
+        tag = Tag(name="pets")
+        db.session.add_all([
+            alice, bob, tag,
+            Post(title="Dogs", content="My dog runs <b>fast</b> every day",
+                 user=alice, tags=[tag]),
+            Post(title="Running", content="Notes from the morning run",
+                 user=bob),
+            Post(title="Cats", content="Cats sleep all day", user=alice,
+                 tags=[tag]),
+        ])
+        db.session.commit()
+
+        self.alice_id = alice.id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+
+    def test_search_page(self):
+        with self.client as c:
+            resp = c.get("/search?q=running")
+            html = resp.text
+
+            self.assertEqual(resp.status_code, 200)
+            # stemming matches runs, run and Running
+            self.assertIn("Dogs", html)
+            self.assertIn("Running", html)
+            self.assertNotIn("Cats", html)
+            self.assertIn("<mark>runs</mark>", html)
+            # post content is escaped around the highlights
+            self.assertIn("&lt;b&gt;fast&lt;/b&gt;", html)
+
+    def test_filters(self):
+        with self.client as c:
+            html = c.get("/search?q=day&tag=pets").text
+            self.assertIn("Dogs", html)
+            self.assertIn("Cats", html)
+
+            html = c.get("/search?q=run&tag=pets").text
+            self.assertIn("Dogs", html)
+            self.assertNotIn("Running", html)
+
+            html = c.get(f"/search?q=run&author={self.alice_id}").text
+            self.assertIn("Dogs", html)
+            self.assertNotIn("Running", html)
+
+    def test_api_pages_through_results(self):
+        with self.client as c:
+            resp = c.get("/api/v1/search?q=day&per_page=1")
+            titles = [row["title"] for row in resp.json["data"]]
+            self.assertIn("<mark>", resp.json["data"][0]["snippet"])
+
+            resp = c.get(f"/api/v1/search?q=day&per_page=1"
+                         f"&cursor={resp.json['next']}")
+            titles += [row["title"] for row in resp.json["data"]]
+
+            self.assertEqual(sorted(titles), ["Cats", "Dogs"])
+            self.assertIsNone(resp.json["next"])
+
+    def test_edits_are_searchable(self):
+        post = Post.query.filter_by(title="Cats").one()
+        post.content = "Cats chase mice"
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/api/v1/search?q=mice")
+            self.assertEqual([row["title"] for row in resp.json["data"]],
+                             ["Cats"])
+            resp = c.get("/api/v1/search?q=sleep")
+            self.assertEqual(resp.json["data"], [])
+
+
+######################### ASYNC READ PATH ######################################
+
+@skipUnless(HAS_ASYNC, "needs asgiref and an async database driver")
+class AsyncReadTestCase(TestCase):
+    """The public pages served by the ASGI app's async views."""
+
+    def setUp(self):
+        """Create a user with two tagged posts."""
+
+        from aio import AsyncReadApp
+
+        clear_tables()
+
+        user = User(first_name="async_first", last_name="async_last")
+        tag = Tag(name="async_tag")
+        posts = [Post(title=f"async post {i}", content="async content",
+                      user=user, tags=[tag],
+                      created_at=datetime(2024, 1, 1) + timedelta(days=i))
+                 for i in range(2)]
+        db.session.add_all([user, tag] + posts)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.post_id = posts[0].id
+        self.tag_id = tag.id
+
+        self.flask_app = create_app("testing")
+        self.asgi = AsyncReadApp(self.flask_app)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def request(self, method, url, headers=None, body=b""):
+        """Send one request through the ASGI app; returns (status, headers,
+        body)."""
+
+        path, _, query = url.partition("?")
+        scope = {
+            "type": "http", "method": method, "path": path,
+            "query_string": query.encode(), "root_path": "",
+            "http_version": "1.1", "scheme": "http",
+            "headers": [(k.lower().encode(), v.encode())
+                        for k, v in (headers or {}).items()],
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        async def run():
+            try:
+                await self.asgi(scope, receive, send)
+            finally:
+                await self.asgi.engine.dispose()
+
+        asyncio.run(run())
+
+        start = messages[0]
+        headers = {k.decode(): v.decode() for k, v in start["headers"]}
+        return (start["status"], headers,
+                b"".join(m.get("body", b"") for m in messages[1:]))
+
+    def test_homepage_matches_sync(self):
+        status, headers, body = self.request("GET", "/")
+        self.assertEqual(status, 200)
+        self.assertIn(b"async post 1", body)
+
+        sync = self.flask_app.test_client().get("/")
+        self.assertEqual(body, sync.data)
+        self.assertEqual(headers["etag"], sync.headers["ETag"])
+
+    def test_post_detail(self):
+        status, headers, body = self.request("GET", f"/posts/{self.post_id}")
+        self.assertEqual(status, 200)
+        self.assertIn(b"async_tag", body)
+        self.assertIn(b"async_first async_last", body)
+
+        status, _, body = self.request(
+            "GET", f"/posts/{self.post_id}",
+            headers={"If-None-Match": headers["etag"]})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+
+        status, _, _ = self.request("GET", "/posts/0")
+        self.assertEqual(status, 404)
+
+    def test_paged_details(self):
+        status, _, body = self.request(
+            "GET", f"/users/{self.user_id}?per_page=1")
+        self.assertEqual(status, 200)
+        self.assertIn(b"async post 1", body)
+        self.assertNotIn(b"async post 0", body)
+        self.assertIn(f"/users/{self.user_id}?per_page=1&amp;cursor=".encode(),
+                      body)
+
+        status, _, body = self.request("GET", f"/tags/{self.tag_id}")
+        self.assertEqual(status, 200)
+        self.assertIn(b"async post 0", body)
+
+        status, _, body = self.request("GET", "/tags?sort=popular")
+        self.assertEqual(status, 200)
+        self.assertIn(b"2 posts", body)
+
+        status, _, _ = self.request("GET", f"/users/{self.user_id}?cursor=x")
+        self.assertEqual(status, 400)
+
+    def test_head(self):
+        status, headers, body = self.request("HEAD", f"/tags/{self.tag_id}")
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b"")
+        self.assertIn("etag", headers)
+
+    def test_other_routes_go_to_flask(self):
+        status, _, body = self.request("GET", "/users/new")
+        self.assertEqual(status, 200)
+
+        form = b"fname=Via&lname=Asgi&imgurl="
+        status, headers, _ = self.request(
+            "POST", "/users/new",
+            headers={"Content-Type": "application/x-www-form-urlencoded",
+                     "Content-Length": str(len(form))},
+            body=form)
+        self.assertEqual(status, 302)
+        self.assertEqual(User.query.filter_by(last_name="Asgi").count(), 1)
+
+
+######################### READ REPLICAS ########################################
+
+@skipUnless(db.engine.dialect.name == "sqlite",
+            "replica tests use a second SQLite file")
+class ReplicaRoutingTestCase(TestCase):
+    """GET requests read from replicas; writes and their follow-ups don't."""
+
+    REPLICA_URI = "sqlite:///" + os.path.join(tempfile.gettempdir(),
+                                              "blogly_replica.db")
+
+    def setUp(self):
+        """Put one user on the primary and a different one on the replica."""
+
+        clear_tables()
+        db.session.add(User(first_name="On", last_name="Primary"))
+        db.session.commit()
+
+        with mock.patch.object(TestingConfig, "REPLICA_URLS",
+                               [self.REPLICA_URI]):
+            self.app = create_app("testing")
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            replica = db.engines['replica0']
+            db.metadata.drop_all(replica)
+            db.metadata.create_all(replica)
+            with replica.begin() as conn:
+                conn.execute(insert(User), [{"first_name": "On",
+                                             "last_name": "Replica"}])
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_get_reads_from_replica(self):
+        resp = self.client.get("/users")
+        self.assertIn(b"On Replica", resp.data)
+        self.assertNotIn(b"On Primary", resp.data)
+
+    def test_read_your_writes(self):
+        resp = self.client.post("/users/new", data={
+            "fname": "New", "lname": "Writer", "imgurl": ""})
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn("read_primary_until", resp.headers["Set-Cookie"])
+
+        # the redirect's GET sees the write
+        resp = self.client.get("/users")
+        self.assertIn(b"New Writer", resp.data)
+        self.assertIn(b"On Primary", resp.data)
+
+        # other clients keep reading from the replica
+        resp = self.app.test_client().get("/users")
+        self.assertIn(b"On Replica", resp.data)
+
+    def test_cached_pages_fill_from_primary(self):
+        user = User.query.filter_by(last_name="Primary").one()
+        db.session.add(Post(title="primary only", content="c", user=user))
+        db.session.commit()
+
+        resp = self.client.get("/")
+        self.assertIn(b"primary only", resp.data)
+
+    def test_replica_queries_are_instrumented(self):
+        with self.app.app_context(), db.engines['replica0'].connect() as conn:
+            user_id = conn.execute(db.select(User.id)).scalar()
+
+        with self.assertLogs("blogly.requests", "INFO") as logs:
+            resp = self.client.get(f"/users/{user_id}")
+        self.assertIn(b"On Replica", resp.data)
+        self.assertGreater(json.loads(logs.records[-1].getMessage())["queries"],
+                           0)
+
+    def test_unhealthy_replica_is_skipped(self):
+        with mock.patch.object(TestingConfig, "REPLICA_URLS",
+                               ["sqlite:////nonexistent/dir/replica.db"]):
+            app = create_app("testing")
+
+        # the list streams, so its query runs as the body is read
+        with self.assertLogs("blogly.replicas", "WARNING"):
+            html = app.test_client().get("/users").data
+        self.assertIn(b"On Primary", html)
+
+
+######################### CONFIGURATION ########################################
+
+class ConfigTestCase(TestCase):
+    """Test the configuration profiles."""
+
+    # a file database, so the pool settings apply; nothing connects to it
+    DATABASE_URI = "sqlite:///" + os.path.join(tempfile.gettempdir(),
+                                               "blogly_config.db")
+
+    def test_development(self):
+        with mock.patch.object(DevelopmentConfig, "SQLALCHEMY_DATABASE_URI",
+                               self.DATABASE_URI):
+            dev = create_app("development")
+
+        self.assertTrue(dev.config['SQLALCHEMY_ECHO'])
+        # the toolbar is installed, and shows up when run with --debug
+        self.assertIn('DEBUG_TB_ENABLED', dev.config)
+
+    def test_production(self):
+        with mock.patch.multiple(ProductionConfig,
+                                 SECRET_KEY="prod-secret",
+                                 SQLALCHEMY_DATABASE_URI=self.DATABASE_URI):
+            prod = create_app("production")
+
+        self.assertFalse(prod.config['SQLALCHEMY_ECHO'])
+        self.assertNotIn('DEBUG_TB_ENABLED', prod.config)
+        self.assertTrue(
+            prod.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_pre_ping'])
+        # statement_timeout is passed to Postgres connections only
+        self.assertNotIn('connect_args',
+                         prod.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        # workers share one page cache when given a Redis to keep it in
+        self.assertIsInstance(prod.extensions['page_cache'], LRUCache)
+        with mock.patch.multiple(ProductionConfig,
+                                 SECRET_KEY="prod-secret",
+                                 SQLALCHEMY_DATABASE_URI=self.DATABASE_URI,
+                                 PAGE_CACHE="redis",
+                                 PAGE_CACHE_URL="redis://localhost:1/0"):
+            shared = create_app("production")
+        self.assertIsInstance(shared.extensions['page_cache'], RedisCache)
+        # templates are compiled up front and never checked for changes
+        self.assertFalse(prod.jinja_env.auto_reload)
+        self.assertEqual(len(prod.jinja_env.cache),
+                         len(prod.jinja_env.list_templates()))
+
+    def test_production_needs_secret_key(self):
+        with mock.patch.object(ProductionConfig, "SECRET_KEY", None):
+            with self.assertRaises(RuntimeError):
+                create_app("production")
+
+
+######################### PRECOMPILED TEMPLATES ################################
+
+class PrecompiledTemplateTestCase(TestCase):
+    """Compiling every template at startup."""
+
+    def make_app(self, **config):
+        with mock.patch.multiple(TestingConfig, TEMPLATE_PRECOMPILE=True,
+                                 **config):
+            return create_app("testing")
+
+    def test_compiles_everything(self):
+        lazy = create_app("testing")
+        self.assertEqual(len(lazy.jinja_env.cache), 0)
+
+        compiled = self.make_app()
+        names = compiled.jinja_env.list_templates()
+        self.assertIn("feed.xml", names)
+        self.assertEqual(len(compiled.jinja_env.cache), len(names))
+        self.assertFalse(compiled.jinja_env.auto_reload)
+
+    def test_broken_template_fails_fast(self):
+        app = create_app("testing")
+        app.jinja_loader = DictLoader({"broken.html": "{% if %}"})
+
+        with self.assertRaises(TemplateSyntaxError) as cm:
+            precompile_templates(app)
+        self.assertEqual(cm.exception.name, "broken.html")
+
+    def test_bytecode_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.make_app(TEMPLATE_CACHE_DIR=cache_dir)
+            written = os.listdir(cache_dir)
+            self.assertTrue(written)
+
+            # a second start loads the same bytecode rather than compiling
+            with mock.patch("jinja2.environment.Environment._compile") as c:
+                app = self.make_app(TEMPLATE_CACHE_DIR=cache_dir)
+            c.assert_not_called()
+            self.assertEqual(sorted(os.listdir(cache_dir)), sorted(written))
+
+        resp = app.test_client().get("/users/new")
+        self.assertEqual(resp.status_code, 200)
+
+
+######################### RELATED CONTENT ######################################
+
+class RelatedContentTestCase(QueryCountMixin, TestCase):
+    """The tag_pairs matrix and related_posts lists, kept up to date."""
+
+    def setUp(self):
+        clear_tables()
+
+        self.user = User(first_name="Rel", last_name="Ated")
+        self.tags = {name: Tag(name=name)
+                     for name in ("python", "sql", "web", "cooking")}
+        db.session.add_all([self.user, *self.tags.values()])
+        db.session.commit()
+
+        self.tag_ids = {name: tag.id for name, tag in self.tags.items()}
+        self.user_id = self.user.id
+        self.client = app.test_client()
+        self.queue = app.extensions['jobs']
+        self.queue.clear()
+        page_cache.clear()
+        get_tag_vocabulary().invalidate()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.expunge_all()
+        self.queue.clear()
+
+    def new_post(self, title, *tags):
+        self.client.post(f"/users/{self.user_id}/posts/new",
+                         data={"title": title, "content": "c",
+                               "tag": list(tags)})
+        return Post.query.filter_by(title=title).one().id
+
+    def pairs(self):
+        names = {id: name for name, id in self.tag_ids.items()}
+        return {(names[pair.tag_id], names[pair.other_id]): pair.post_count
+                for pair in TagPair.query if pair.post_count}
+
+    def rebuilt_pairs(self):
+        return {(row.tag_id, row.other_id): row.post_count
+                for row in db.session.execute(tag_pairs_select())}
+
+    def related_titles(self, post_id):
+        return [post.title for post in related_posts_query(post_id, 5)]
+
+    def test_pairs_follow_tagging(self):
+        first = self.new_post("first", "python", "sql", "web")
+        self.new_post("second", "python", "sql")
+        self.assertEqual(self.pairs()[("python", "sql")], 2)
+        self.assertEqual(self.pairs()[("web", "sql")], 1)
+
+        self.client.post(f"/posts/{first}/edit",
+                         data={"title": "first", "content": "c",
+                               "tag": ["python", "cooking"]})
+        self.assertEqual(self.pairs(), {("python", "sql"): 1,
+                                        ("sql", "python"): 1,
+                                        ("python", "cooking"): 1,
+                                        ("cooking", "python"): 1})
+
+        self.client.post(f"/posts/{first}/delete")
+        self.assertEqual(set(self.pairs()), {("python", "sql"),
+                                             ("sql", "python")})
+
+        self.client.post(f"/users/{self.user_id}/delete")
+        self.assertEqual(self.pairs(), {})
+        self.assertEqual(self.rebuilt_pairs(), {})
+
+    def test_deleting_tag_drops_its_pairs(self):
+        first = self.new_post("first", "python", "sql")
+        self.new_post("second", "sql", "web")
+        self.new_post("third", "python", "web")
+        self.queue.run_pending()
+        self.assertEqual(self.related_titles(first), ["third", "second"])
+
+        self.client.post(f"/tags/{self.tag_ids['sql']}/delete")
+        self.assertEqual(self.pairs(), {("python", "web"): 1,
+                                        ("web", "python"): 1})
+        self.queue.run_pending()
+        self.assertEqual(self.related_titles(first), ["third"])
+
+        # editing a post leaves the deleted tag's pairs alone
+        self.client.post(f"/posts/{first}/edit",
+                         data={"title": "first", "content": "c",
+                               "tag": ["python", "web"]})
+        expected = {("python", "web"): 2, ("web", "python"): 2}
+        self.assertEqual(self.pairs(), expected)
+        names = {id: name for name, id in self.tag_ids.items()}
+        self.assertEqual({(names[a], names[b]): count for (a, b), count
+                          in self.rebuilt_pairs().items()}, expected)
+        self.assertEqual(TagPair.query.filter(TagPair.post_count < 0).count(),
+                         0)
+
+    def test_api_batch_counts_pairs(self):
+        self.client.post("/api/v1/posts", json=[
+            {"title": f"api {i}", "content": "c", "user_id": self.user_id,
+             "tags": ["sql", "web"]} for i in range(3)])
+
+        self.assertEqual(self.pairs(), {("sql", "web"): 3, ("web", "sql"): 3})
+
+    def test_related_posts_refreshed(self):
+        python_sql = self.new_post("python sql", "python", "sql")
+        self.new_post("python only", "python")
+        self.new_post("cooking", "cooking")
+        self.assertGreater(self.queue.run_pending(), 0)
+
+        self.assertEqual(self.related_titles(python_sql), ["python only"])
+        newest = self.new_post("python sql web", "python", "sql", "web")
+        self.queue.run_pending()
+
+        # the new post reaches the lists of the posts it's related to
+        self.assertEqual(self.related_titles(python_sql),
+                         ["python sql web", "python only"])
+        self.assertEqual(self.related_titles(newest),
+                         ["python sql", "python only"])
+
+        # deleting it refreshes the lists it was on
+        self.client.post(f"/posts/{newest}/delete")
+        self.queue.run_pending()
+        self.assertEqual(self.related_titles(python_sql), ["python only"])
+        self.assertEqual(
+            RelatedPost.query.filter_by(related_id=newest).count(), 0)
+
+    def test_deleting_user_refreshes_lists(self):
+        mine = self.new_post("mine", "python", "sql")
+        other = User(first_name="Oth", last_name="Er")
+        db.session.add(other)
+        db.session.commit()
+        other_id = other.id
+        self.client.post(f"/users/{other_id}/posts/new",
+                         data={"title": "theirs", "content": "c",
+                               "tag": ["python"]})
+        self.new_post("python only", "python")
+        self.queue.run_pending()
+        self.assertEqual(self.related_titles(mine), ["python only", "theirs"])
+
+        self.client.post(f"/users/{other_id}/delete")
+        self.assertGreater(self.queue.run_pending(), 0)
+
+        theirs = Post.query.execution_options(include_deleted=True).filter_by(
+            title="theirs").one().id
+        self.assertEqual(
+            RelatedPost.query.filter_by(related_id=theirs).count(), 0)
+        self.assertEqual(self.related_titles(mine), ["python only"])
+
+    def test_candidates_limit(self):
+        old = self.new_post("old", "python", "sql")
+        for i in range(3):
+            self.new_post(f"new {i}", "python")
+        self.queue.run_pending()
+
+        with mock.patch.dict(app.config, RELATED_CANDIDATES=2):
+            rebuild_related()
+
+        # only the two newest python posts are compared
+        self.assertEqual(self.related_titles(old), ["new 2", "new 1"])
+
+    def test_refresh_candidates_limit(self):
+        old = self.new_post("old", "python", "sql")
+        for i in range(3):
+            self.new_post(f"new {i}", "python")
+        self.client.post(f"/posts/{self.new_post('gone', 'python')}/delete")
+        sql = self.new_post("sql", "sql")
+
+        with mock.patch.dict(app.config, RELATED_CANDIDATES=2):
+            self.queue.run_pending()
+
+        # the deleted post isn't a python candidate, so the two newest live
+        # ones are
+        self.assertEqual(self.related_titles(old), ["sql", "new 2", "new 1"])
+        self.assertEqual(self.related_titles(sql), ["old"])
+
+    def test_rebuild_matches_incremental(self):
+        for i, tags in enumerate([("python", "sql"), ("sql", "web"),
+                                  ("python", "sql", "web"), ("cooking",),
+                                  ("web", "cooking")]):
+            self.new_post(f"post {i}", *tags)
+        self.queue.run_pending()
+
+        pairs = {(p.tag_id, p.other_id): p.post_count for p in TagPair.query}
+        lists = {post.id: self.related_titles(post.id) for post in Post.query}
+
+        result = app.test_cli_runner().invoke(
+            args=["blog", "rebuild-related"])
+        self.assertIn("Wrote 8 tag pairs", result.output)
+
+        self.assertEqual(
+            {(p.tag_id, p.other_id): p.post_count for p in TagPair.query},
+            pairs)
+        self.assertEqual(
+            {post.id: self.related_titles(post.id) for post in Post.query},
+            lists)
+
+    def test_pages_render_related(self):
+        post_id = self.new_post("python sql", "python", "sql")
+        self.new_post("python web", "python", "web")
+        self.queue.run_pending()
+
+        with self.assertMaxQueries(4) as statements:
+            resp = self.client.get(f"/posts/{post_id}")
+        self.assertIn("python web", resp.text)
+        # the version reads related_posts too; the list itself is one lookup
+        self.assertEqual(len([s for s in statements
+                              if s.startswith("SELECT posts.id")
+                              and "JOIN related_posts" in s]), 1)
+
+        with self.assertMaxQueries(4) as statements:
+            resp = self.client.get(f"/tags/{self.tag_ids['python']}")
+        self.assertIn(f'<a href="/tags/{self.tag_ids["web"]}">web</a>',
+                      resp.text)
+        self.assertEqual(len([s for s in statements
+                              if s.startswith("SELECT tags.id")
+                              and "JOIN tag_pairs" in s]), 1)
+
+    def test_refresh_changes_post_version(self):
+        post_id = self.new_post("python sql", "python", "sql")
+        etag = self.client.get(f"/posts/{post_id}").headers["ETag"]
+
+        self.new_post("python web", "python", "web")
+        self.queue.run_pending()
+
+        resp = self.client.get(f"/posts/{post_id}",
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("python web", resp.text)
+
+    def test_purge(self):
+        post_id = self.new_post("python sql", "python", "sql")
+        self.new_post("python web", "python", "web")
+        self.queue.run_pending()
+
+        soft_delete(db.session.get(Tag, self.tag_ids["web"]))
+        soft_delete(db.session.get(Post, post_id))
+        db.session.commit()
+        counts = Purger().run()
+
+        self.assertEqual(counts["tag_pairs"], 2)
+        self.assertEqual(counts["related_posts"], 2)
+        self.assertEqual(RelatedPost.query.count(), 0)
+
+
+######################### AUTHOR NAMES #########################################
+
+class AuthorNameTestCase(QueryCountMixin, TestCase):
+    """Stored full names on users and author names on posts."""
+
+    def setUp(self):
+        clear_tables()
+
+        user = User(first_name="Ada", last_name="Lovelace")
+        other = User(first_name="Alan", last_name="Turing")
+        posts = [Post(title=f"note {i}", content="c", user=user)
+                 for i in range(5)]
+        db.session.add_all([user, other, *posts,
+                            Post(title="paper", content="c", user=other)])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.other_id = other.id
+        self.post_id = posts[0].id
+        self.client = app.test_client()
+        page_cache.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def author_names(self):
+        return {post.title: post.author_name for post in Post.query}
+
+    def test_stored_on_write(self):
+        self.assertEqual(
+            db.session.execute(
+                db.select(User.id).where(User.full_name == "Ada Lovelace")
+            ).scalar(), self.user_id)
+        self.assertEqual(
+            [user.full_name
+             for user in User.query.order_by(User.full_name.desc())],
+            ["Alan Turing", "Ada Lovelace"])
+        self.assertEqual(set(self.author_names().values()),
+                         {"Ada Lovelace", "Alan Turing"})
+
+    def test_rename_updates_posts(self):
+        with self.assertMaxQueries(6) as statements:
+            resp = self.client.post(f"/users/{self.user_id}/edit",
+                                    data={"fname": "Augusta", "lname": "",
+                                          "imgurl": ""})
+        self.assertEqual(resp.status_code, 302)
+        # the posts are updated by the trigger, not one by one
+        self.assertFalse([s for s in statements
+                          if s.startswith("UPDATE posts")])
+
+        names = self.author_names()
+        self.assertEqual(names.pop("paper"), "Alan Turing")
+        self.assertEqual(set(names.values()), {"Augusta Lovelace"})
+        self.assertIn("Augusta Lovelace", self.client.get("/").text)
+
+    def test_rename_changes_validators(self):
+        tag = Tag(name="notes")
+        note = db.session.get(Post, self.post_id)
+        paper = Post.query.filter_by(title="paper").one()
+        note.tags = paper.tags = [tag]
+        db.session.commit()
+        rebuild_related()
+
+        # the tag's feed and paper's related posts show Ada's name
+        urls = [f"/tags/{tag.id}/feed.xml", f"/posts/{paper.id}"]
+        etags = {url: self.client.get(url).get_etag()[0] for url in urls}
+
+        self.client.post(f"/users/{self.user_id}/edit",
+                         data={"fname": "Augusta", "lname": "Lovelace",
+                               "imgurl": ""})
+
+        for url in urls:
+            resp = self.client.get(
+                url, headers={"If-None-Match": f'"{etags[url]}"'})
+            self.assertEqual(resp.status_code, 200, url)
+            self.assertIn("Augusta Lovelace", resp.text)
+
+    def test_names_after_flush(self):
+        user = User(first_name="Grace", last_name="Hopper")
+        db.session.add(user)
+        db.session.flush()
+        post = Post(title="cobol", content="...", user_id=user.id)
+        db.session.add(post)
+        db.session.flush()
+
+        self.assertEqual(user.full_name, "Grace Hopper")
+        self.assertEqual(post.author_name, "Grace Hopper")
+
+    def test_moved_post(self):
+        post = db.session.get(Post, self.post_id)
+        post.user_id = self.other_id
+        db.session.commit()
+
+        self.assertEqual(db.session.get(Post, self.post_id).author_name,
+                         "Alan Turing")
+
+    def test_listings_skip_users(self):
+        for url in ("/", "/feed.xml", f"/posts/{self.post_id}"):
+            with self.assertMaxQueries(4) as statements:
+                resp = self.client.get(url)
+
+            self.assertIn("Ada Lovelace", resp.text)
+            # the validators still read users.updated_at; the post rows
+            # themselves come from posts alone
+            rows = [s for s in statements if "posts.title" in s]
+            self.assertTrue(rows, url)
+            self.assertFalse([s for s in rows if "users" in s], url)
+
+    def test_imported_posts(self):
+        generate(users=2, posts=6, tags=0)
+        self.assertFalse(Post.query.filter(Post.author_name.is_(None)).all())
+        for post in Post.query:
+            self.assertEqual(post.author_name, post.user.full_name)
+
+
+######################### SOFT DELETE ##########################################
+
+class SoftDeleteTestCase(QueryCountMixin, TestCase):
+    """Deleting only sets deleted_at; the purge removes the rows later."""
+
+    def setUp(self):
+        clear_tables()
+
+        self.user = User(first_name="Gone", last_name="Soon")
+        self.other = User(first_name="Stays", last_name="Here")
+        self.tag = Tag(name="doomed")
+        self.posts = [Post(title=f"post {i}", content="c", user=self.user,
+                           tags=[self.tag]) for i in range(5)]
+        self.kept = Post(title="kept", content="c", user=self.other,
+                         tags=[self.tag])
+        db.session.add_all([self.user, self.other, self.tag, self.kept,
+                            *self.posts])
+        db.session.commit()
+
+        self.client = app.test_client()
+        page_cache.clear()
+        get_tag_vocabulary().invalidate()
+
+    def tearDown(self):
+        db.session.rollback()
+        # the purge deletes rows under the session's objects; drop them
+        # before SQLite hands their ids to the next test's rows
+        db.session.expunge_all()
+
+    def all_rows(self, model):
+        return db.session.execute(
+            db.select(model).execution_options(include_deleted=True)
+        ).scalars().all()
+
+    def test_delete_post(self):
+        post_id = self.posts[0].id
+        resp = self.client.post(f"/posts/{post_id}/delete")
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(self.client.get(f"/posts/{post_id}").status_code, 404)
+        self.assertEqual(
+            self.client.get(f"/api/v1/posts/{post_id}").status_code, 404)
+        self.assertNotIn("post 0",
+                         self.client.get(f"/users/{self.user.id}").text)
+        self.assertNotIn("post 0", self.client.get("/").text)
+
+        self.assertEqual(len(self.all_rows(Post)), 6)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, self.user.id).post_count, 4)
+        self.assertEqual(db.session.get(Tag, self.tag.id).post_count, 5)
+
+    def test_delete_user(self):
+        user_id, tag_id = self.user.id, self.tag.id
+
+        # a fixed number of statements however many posts the user has
+        with self.assertMaxQueries(6):
+            resp = self.client.post(f"/users/{user_id}/delete")
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(self.client.get(f"/users/{user_id}").status_code, 404)
+        self.assertNotIn("Gone Soon", self.client.get("/users").text)
+        self.assertEqual([post.title for post in Post.query.all()], ["kept"])
+        self.assertEqual(db.session.get(Tag, tag_id).post_count, 1)
+
+    def test_delete_tag(self):
+        tag_id = self.tag.id
+        self.client.post(f"/tags/{tag_id}/delete")
+
+        self.assertEqual(self.client.get(f"/tags/{tag_id}").status_code, 404)
+        self.assertNotIn("doomed", self.client.get(
+            f"/posts/{self.kept.id}").text)
+        self.assertNotIn("doomed", self.client.get(
+            f"/users/{self.other.id}/posts/new").text)
+
+        # the name is free again
+        self.client.post("/tags/new", data={"name": "doomed"})
+        self.assertEqual(Tag.query.filter_by(name="doomed").count(), 1)
+        self.assertEqual(len(self.all_rows(Tag)), 2)
+
+    def test_no_posts_for_deleted_users(self):
+        user_id = self.user.id
+        soft_delete(self.user)
+        db.session.commit()
+        # requests share this session; don't let get() reuse the user
+        db.session.expunge_all()
+
+        for user_id in (user_id, user_id + 1000):
+            resp = self.client.post(f"/users/{user_id}/posts/new",
+                                    data={"title": "t", "content": "c"})
+            self.assertEqual(resp.status_code, 404)
+        self.assertEqual([post.title for post in Post.query.all()], ["kept"])
+
+    def test_export_skips_deleted(self):
+        soft_delete(self.user)
+        db.session.commit()
+
+        records = list(export_records(inline_tags=False))
+        self.assertEqual([r["title"] for kind, r in records if kind == "post"],
+                         ["kept"])
+        self.assertEqual([r for kind, r in records if kind == "post_tag"],
+                         [{"post_id": self.kept.id, "tag": "doomed"}])
+
+    def test_purge(self):
+        soft_delete(self.user)
+        soft_delete(self.tag)
+        db.session.commit()
+
+        sleeps = []
+        counts = Purger(batch_size=2, rows_per_second=1,
+                        sleep=sleeps.append).run()
+
+        self.assertEqual(counts, {"posts_tags": 6, "posts": 5, "tags": 1,
+                                  "users": 1})
+        self.assertTrue(sleeps)
+        self.assertEqual(len(self.all_rows(Post)), 1)
+        self.assertEqual(len(self.all_rows(User)), 1)
+        self.assertEqual(self.all_rows(PostTag), [])
+        self.assertEqual(repair_post_counts(), (0, 0))
+
+    def test_purge_command(self):
+        soft_delete(self.posts[0])
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(
+            args=["blog", "purge", "--rows-per-second", "0"])
+
+        self.assertIn("Purged 1 posts_tags, 0 related_posts, 0 tag_pairs, "
+                      "1 posts, 0 tags, 0 users.",
+                      result.output)
+        self.assertEqual(len(self.all_rows(Post)), 5)
+
+
+######################### POST EXCERPTS ########################################
+
+class PostExcerptTestCase(QueryCountMixin, TestCase):
+    """Stored excerpts and word counts, and list pages that never load the
+    post bodies."""
+
+    def setUp(self):
+        clear_tables()
+
+        user = User(first_name="Long", last_name="Winded")
+        tag = Tag(name="essays")
+        post = Post(title="Essay", content="word " * 500, user=user,
+                    tags=[tag])
+        db.session.add_all([user, tag, post])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.tag_id = tag.id
+        self.post_id = post.id
+        self.client = app.test_client()
+        page_cache.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_summarize(self):
+        self.assertEqual(summarize("  one\ntwo   three "),
+                         {"excerpt": "one two three", "word_count": 3})
+
+        long = summarize("lorem ipsum " * 100)
+        self.assertEqual(long["word_count"], 200)
+        self.assertLessEqual(len(long["excerpt"]), EXCERPT_LENGTH)
+        self.assertTrue(long["excerpt"].endswith("m\u2026"))
+
+        self.assertEqual(len(summarize("x" * 1000)["excerpt"]),
+                         EXCERPT_LENGTH)
+
+    def test_computed_on_write(self):
+        self.client.post(f"/users/{self.user_id}/posts/new",
+                         data={"title": "Short",
+                               "content": "just  three words"})
+        post = Post.query.filter_by(title="Short").one()
+        self.assertEqual((post.excerpt, post.word_count),
+                         ("just three words", 3))
+
+        self.client.post(f"/posts/{post.id}/edit",
+                         data={"title": "Short",
+                               "content": "now four words here"})
+        db.session.expire_all()
+        post = db.session.get(Post, post.id)
+        self.assertEqual((post.excerpt, post.word_count),
+                         ("now four words here", 4))
+
+    def test_list_pages_skip_content(self):
+        for url in ("/", f"/users/{self.user_id}", f"/tags/{self.tag_id}"):
+            with self.assertMaxQueries(10) as statements:
+                resp = self.client.get(url)
+
+            self.assertIn("word word", resp.text)
+            self.assertFalse([s for s in statements if "posts.content" in s],
+                             url)
+
+    def test_detail_loads_content(self):
+        with self.assertMaxQueries(4):
+            resp = self.client.get(f"/posts/{self.post_id}")
+        self.assertIn("word " * 100, resp.text)
+
+
+######################### TAG VOCABULARY #######################################
+
+class TagVocabularyTestCase(QueryCountMixin, TestCase):
+    """The per-process copy of the tag names behind the post forms."""
+
+    def setUp(self):
+        clear_tables()
+
+        user = User(first_name="Tag", last_name="Picker")
+        fun = Tag(name="fun")
+        db.session.add_all([user, fun, Tag(name="cats")])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.fun_id = fun.id
+        self.client = app.test_client()
+        self.vocabulary = get_tag_vocabulary()
+        self.vocabulary.invalidate()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def tag_version(self):
+        return db.session.get(CacheVersion, "tags").version
+
+    def test_triggers_bump_version(self):
+        version = self.tag_version()
+
+        db.session.add(Tag(name="dogs"))
+        db.session.commit()
+        self.assertEqual(self.tag_version(), version + 1)
+
+        Tag.query.filter_by(name="dogs").update({"name": "hounds"})
+        db.session.commit()
+        self.assertEqual(self.tag_version(), version + 2)
+
+        # other columns don't change the vocabulary
+        Tag.query.filter_by(name="hounds").update({"updated_at": utcnow()})
+        db.session.commit()
+        self.assertEqual(self.tag_version(), version + 2)
+
+        Tag.query.filter_by(name="hounds").delete()
+        db.session.commit()
+        self.assertEqual(self.tag_version(), version + 3)
+
+    def test_form_served_from_vocabulary(self):
+        self.assertEqual([tag.name for tag in self.vocabulary.tags],
+                         ["cats", "fun"])
+
+        with self.assertMaxQueries(1):
+            resp = self.client.get(f"/users/{self.user_id}/posts/new")
+        self.assertIn('value=cats', resp.text)
+        self.assertIn('value=fun', resp.text)
+
+    def test_tag_views_invalidate(self):
+        self.vocabulary.tags
+
+        self.client.post("/tags/new", data={"name": "dogs"})
+        resp = self.client.get(f"/users/{self.user_id}/posts/new")
+        self.assertIn('value=dogs', resp.text)
+
+        self.client.post(f"/tags/{self.fun_id}/edit", data={"name": "games"})
+        resp = self.client.get(f"/users/{self.user_id}/posts/new")
+        self.assertIn('value=games', resp.text)
+        self.assertNotIn('value=fun', resp.text)
+
+        self.client.post(f"/tags/{self.fun_id}/delete")
+        resp = self.client.get(f"/users/{self.user_id}/posts/new")
+        self.assertNotIn('value=games', resp.text)
+
+    def test_other_process_change(self):
+        self.vocabulary.tags
+
+        # as another process would: the tags change, this process' hooks
+        # never see it
+        with db.engine.begin() as conn:
+            conn.execute(insert(Tag), {"name": "dogs", "updated_at": utcnow(),
+                                       "post_count": 0})
+
+        names = [tag.name for tag in self.vocabulary.snapshot().tags]
+        self.assertNotIn("dogs", names)
+
+        names = [tag.name for tag in self.vocabulary.snapshot(max_age=0).tags]
+        self.assertIn("dogs", names)
+
+    def test_resolve_tags(self):
+        self.assertEqual(resolve_tags(["fun", "nope"]), {"fun": self.fun_id})
+
+        # a tag added earlier in the same transaction isn't in the copy yet
+        dogs = Tag(name="dogs")
+        db.session.add(dogs)
+        db.session.flush()
+        self.assertEqual(resolve_tags(["dogs", "fun"]),
+                         {"dogs": dogs.id, "fun": self.fun_id})
+
+    def test_resolve_tags_in_transaction(self):
+        self.vocabulary.tags
+
+        # the version is read on the transaction's own connection
+        cats = Tag.query.filter_by(name="cats").one()
+        pool = db.engine.pool
+        checkouts = []
+
+        def count_checkout(*args):
+            checkouts.append(args)
+
+        event.listen(pool, "checkout", count_checkout)
+        try:
+            self.assertEqual(resolve_tags(["fun"]), {"fun": self.fun_id})
+        finally:
+            event.remove(pool, "checkout", count_checkout)
+        self.assertEqual(checkouts, [])
+
+        # so a tag deleted earlier in it isn't resolved from the copy
+        soft_delete(cats)
+        db.session.flush()
+        self.assertEqual(resolve_tags(["cats", "fun"]), {"fun": self.fun_id})
+
+    def test_post_writes_use_vocabulary(self):
+        resp = self.client.post(f"/users/{self.user_id}/posts/new",
+                                data={"title": "t", "content": "c",
+                                      "tag": ["fun", "cats"]})
+        self.assertEqual(resp.status_code, 302)
+        post = Post.query.filter_by(title="t").one()
+        self.assertEqual(sorted(tag.name for tag in post.tags),
+                         ["cats", "fun"])
+
+        with self.assertMaxQueries(3):
+            resp = self.client.get(f"/posts/{post.id}/edit")
+        self.assertIn('value=cats checked', resp.text)
+
+        self.client.post(f"/posts/{post.id}/edit",
+                         data={"title": "t", "content": "c", "tag": ["fun"]})
+        post = Post.query.filter_by(title="t").one()
+        self.assertEqual([tag.name for tag in post.tags], ["fun"])
+
+
+######################### JOBS #################################################
+
+calls = []
+
+
+@job
+def flaky_job(fail_times):
+    """Fails its first `fail_times` runs."""
+
+    calls.append(fail_times)
+    if len(calls) <= fail_times:
+        raise RuntimeError("flaky")
+
+
+class JobQueueTestCase(TestCase):
+    """Post-write jobs, queued on commit and retried when they fail."""
+
+    def setUp(self):
+        clear_tables()
+
+        user = User(first_name="Job", last_name="Runner")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.queue = app.extensions['jobs']
+        self.queue.clear()
+        page_cache.clear()
+        calls.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_queued_on_commit(self):
+        db.session.add(Post(title="first", content="c", user_id=self.user_id))
+        db.session.flush()
+        db.session.add(Post(title="second", content="c", user_id=self.user_id))
+        db.session.flush()
+        self.assertEqual(self.queue.pending, [])
+
+        db.session.commit()
+        self.assertEqual(self.queue.pending, [("warm_homepage", {})])
+
+    def test_rollback_drops_jobs(self):
+        db.session.add(Post(title="gone", content="c", user_id=self.user_id))
+        db.session.flush()
+        db.session.rollback()
+
+        db.session.commit()
+        self.assertEqual(self.queue.pending, [])
+
+    def test_warm_homepage(self):
+        resp = app.test_client().post(f"/users/{self.user_id}/posts/new",
+                                      data={"title": "warm", "content": "c"})
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(page_cache.get("homepage"))
+
+        self.assertEqual(self.queue.run_pending(), 1)
+        self.assertIn("warm", page_cache.get("homepage"))
+        self.assertIsNotNone(page_cache.get("homepage:version"))
+
+    def test_retries(self):
+        failed = self.queue.failed()
+        enqueue(db.session, "flaky_job", fail_times=2)
+        db.session.commit()
+
+        with self.assertLogs("blogly.jobs", "ERROR"):
+            self.queue.run_pending()
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.queue.failed(), failed)
+
+    def test_gives_up(self):
+        failed = self.queue.failed()
+        enqueue(db.session, "flaky_job", fail_times=99)
+        db.session.commit()
+
+        with self.assertLogs("blogly.jobs", "ERROR"):
+            self.queue.run_pending()
+        self.assertEqual(len(calls), app.config['JOB_MAX_ATTEMPTS'])
+        self.assertEqual(self.queue.failed(), failed + 1)
+        self.assertEqual(self.queue.depth(), 0)
+
+    def test_unknown_job(self):
+        with self.assertRaises(KeyError):
+            enqueue(db.session, "no_such_job")
+
+    def test_thread_queue(self):
+        queue = ThreadQueue(app)
+        queue.committed("flaky_job", {"fail_times": 0})
+        queue.shutdown()
+        self.assertEqual(calls, [0])
+        self.assertEqual(queue.depth(), 0)
+
+    def test_queue_metrics(self):
+        enqueue(db.session, "flaky_job", fail_times=0)
+        db.session.commit()
+
+        text = app.test_client().get("/metrics").text
+        self.assertIn("blogly_jobs_queued 1", text)
+
+
+class DatabaseQueueTestCase(TestCase):
+    """Jobs kept in the jobs table and run by `flask blog worker`."""
+
+    def setUp(self):
+        clear_tables()
+        db.session.commit()
+        calls.clear()
+
+        with mock.patch.object(TestingConfig, "JOB_QUEUE", "database"):
+            self.app = create_app("testing")
+        self.worker = Worker(self.app)
+
+        ctx = self.app.app_context()
+        ctx.push()
+        self.addCleanup(ctx.pop)
+
+        user = User(first_name="Db", last_name="Queue")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+        Job.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def jobs(self):
+        db.session.expire_all()
+        return Job.query.order_by(Job.id).all()
+
+    def test_inserted_with_the_write(self):
+        db.session.add(Post(title="queued", content="c", user_id=self.user_id))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.jobs(), [])
+
+        resp = self.app.test_client().post(
+            f"/users/{self.user_id}/posts/new",
+            data={"title": "queued", "content": "c"})
+        self.assertEqual(resp.status_code, 302)
+        [row] = self.jobs()
+        self.assertEqual((row.name, row.status, row.attempts),
+                         ("warm_homepage", "queued", 0))
+
+        self.assertEqual(self.worker.work(burst=True), 1)
+        self.assertEqual(self.jobs(), [])
+
+    def test_retry_then_fail(self):
+        self.app.config['JOB_RETRY_SECONDS'] = 60
+        enqueue(db.session, "flaky_job", fail_times=99)
+        db.session.commit()
+
+        with self.assertLogs("blogly.jobs", "ERROR"):
+            self.assertEqual(self.worker.run_once(), 1)
+        [row] = self.jobs()
+        self.assertEqual((row.status, row.attempts), ("queued", 1))
+        self.assertIn("flaky", row.last_error)
+        # backed off, so not due yet
+        self.assertEqual(self.worker.run_once(), 0)
+
+        row.run_at = utcnow()
+        row.attempts = self.app.config['JOB_MAX_ATTEMPTS'] - 1
+        db.session.commit()
+        with self.assertLogs("blogly.jobs", "ERROR"):
+            self.worker.run_once()
+        [row] = self.jobs()
+        self.assertEqual(row.status, "failed")
+        self.assertEqual(self.app.extensions['jobs'].failed(), 1)
+
+    def test_stale_jobs_requeued(self):
+        enqueue(db.session, "flaky_job", fail_times=0)
+        db.session.commit()
+        [row] = self.jobs()
+        row.status = "running"
+        row.locked_at = utcnow() - timedelta(hours=1)
+        db.session.commit()
+
+        self.assertEqual(self.worker.requeue_stale(), 1)
+        self.assertEqual(self.worker.work(burst=True), 1)
+        self.assertEqual(calls, [0])
+
+    def test_worker_command(self):
+        enqueue(db.session, "flaky_job", fail_times=0)
+        enqueue(db.session, "flaky_job", fail_times=0)
+        db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(
+            args=["blog", "worker", "--burst"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Ran 1 jobs.", result.output)
+
+        with mock.patch.dict(self.app.config, JOB_QUEUE="thread"):
+            result = self.app.test_cli_runner().invoke(
+                args=["blog", "worker"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("JOB_QUEUE=database", result.output)
+
+
+######################### METRICS ##############################################
+
+class MetricsTestCase(TestCase):
+    """Per-request instrumentation and the /metrics endpoint."""
+
+    def setUp(self):
+        clear_tables()
+
+        user = User(first_name="metrics", last_name="user")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def sample(self, text, prefix):
+        for line in text.splitlines():
+            if line.startswith(prefix + " "):
+                return float(line.rsplit(" ", 1)[1])
+        return 0.0
+
+    def test_metrics(self):
+        before = self.client.get("/metrics").get_data(as_text=True)
+
+        with self.assertLogs("blogly.requests", "INFO") as logs:
+            resp = self.client.get(f"/users/{self.user_id}")
+        self.assertEqual(resp.status_code, 200)
+
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line["endpoint"], "blog.show_user_detail")
+        self.assertEqual(line["status"], 200)
+        self.assertGreater(line["queries"], 0)
+        self.assertGreater(line["render_ms"], 0)
+
+        resp = self.client.get("/metrics")
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        after = resp.get_data(as_text=True)
+
+        requests = ('blogly_http_requests_total{endpoint='
+                    '"blog.show_user_detail",method="GET",status="200"}')
+        queries = 'blogly_db_queries_total{endpoint="blog.show_user_detail"}'
+        latency = ('blogly_http_request_duration_seconds_count'
+                   '{endpoint="blog.show_user_detail"}')
+        render = ('blogly_template_render_seconds_count'
+                  '{template="user_detail.html"}')
+
+        self.assertEqual(
+            self.sample(after, requests) - self.sample(before, requests), 1)
+        self.assertEqual(
+            self.sample(after, queries) - self.sample(before, queries),
+            line["queries"])
+        self.assertEqual(
+            self.sample(after, latency) - self.sample(before, latency), 1)
+        self.assertEqual(
+            self.sample(after, render) - self.sample(before, render), 1)
+        self.assertIn('le="+Inf"', after)
+
+    def test_disabled(self):
+        with mock.patch.object(TestingConfig, "METRICS", False):
+            quiet = create_app("testing")
+
+        self.assertNotIn('metrics', quiet.extensions)
+        self.assertEqual(quiet.test_client().get("/metrics").status_code, 404)
+
+
+######################### STREAMED PAGES #######################################
+
+class StreamedPageTestCase(TestCase):
+    """List pages stream their rows instead of building the page in memory."""
+
+    def setUp(self):
+        """Lots of tags, every one on the same post."""
+
+        clear_tables()
+
+        self.client = app.test_client()
+
+        db.session.execute(insert(Tag), [
+            {"name": f"tag {i:05}", "updated_at": datetime(2024, 1, 1),
+             "post_count": 1} for i in range(4000)])
+        user = User(first_name="Streamed", last_name="Pages")
+        post = Post(title="tagged a lot", content="c", user=user)
+        db.session.add(post)
+        db.session.commit()
+        self.post_id = post.id
+
+        db.session.execute(insert(PostTag), [
+            {"post_id": post.id, "tag_id": tag_id}
+            for tag_id in db.session.scalars(db.select(Tag.id))])
+        db.session.commit()
+        self.tag_id = db.session.scalars(db.select(Tag.id)).first()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def peak_memory(self, url):
+        """Body size and peak traced memory while serving `url`."""
+
+        tracemalloc.start()
+        try:
+            resp = self.client.get(url, buffered=False)
+            self.assertTrue(resp.is_streamed)
+            size = sum(len(chunk) for chunk in resp.response)
+            resp.close()
+            return size, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_memory_stays_flat(self):
+        with mock.patch.dict(app.config, MAX_PAGE_SIZE=4000):
+            # first render compiles the template
+            self.client.get("/tags?per_page=200")
+            small_size, small_peak = self.peak_memory("/tags?per_page=200")
+            big_size, big_peak = self.peak_memory("/tags?per_page=4000")
+
+        self.assertGreater(big_size, small_size * 15)
+        self.assertLess(big_peak, small_peak * 2)
+        # the page never sits in memory whole
+        self.assertLess(big_peak, big_size)
+
+    def test_page_links(self):
+        with self.client as c:
+            html = c.get("/tags?per_page=3").text
+            self.assertIn("tag 00000", html)
+            self.assertNotIn("tag 00003", html)
+
+            next_cursor = html.split("cursor=")[1].split('"')[0]
+            html = c.get(f"/tags?per_page=3&cursor={next_cursor}").text
+            self.assertIn("tag 00003", html)
+            self.assertIn("Previous", html)
+
+            html = c.get(f"/tags/{self.tag_id}").text
+            self.assertIn("tagged a lot", html)
+            self.assertNotIn("Next", html)
+
+            html = c.get("/users").text
+            self.assertIn("Streamed Pages", html)
+
+    def test_connections_return_to_pool(self):
+        # setUp's last query left the test's own session holding one
+        db.session.close()
+        pool = db.engine.pool
+        self.assertEqual(pool.checkedout(), 0)
+
+        def serve(url):
+            resp = self.client.get(url, buffered=False)
+            responses.append((resp.is_streamed, resp.status_code))
+            resp.get_data()
+            resp.close()
+
+        for url in ["/users", "/tags", f"/tags/{self.tag_id}"]:
+            # requests served here would share the module's app context, and
+            # its session; a new thread starts without one, like a server's
+            responses = []
+            thread = threading.Thread(target=serve, args=(url,))
+            thread.start()
+            thread.join()
+            self.assertEqual(responses, [(True, 200)])
+            self.assertEqual(pool.checkedout(), 0, url)
+
+
+######################### QUERY BUDGETS #########################################
+
+class QueryBudgetTestCase(QueryCountMixin, TestCase):
+    """Views must not issue one query per row they render.
+
+    Detail budgets include the aggregate query that computes the page's ETag.
+    """
+
+    def setUp(self):
+        """Create a few users, each with tagged posts."""
+
+        clear_tables()
+
+        self.client = app.test_client()
+
+        tags = [Tag(name=f"budget_tag_{i}") for i in range(3)]
+        users = [User(first_name=f"first{i}", last_name=f"last{i}")
+                 for i in range(3)]
+        db.session.add_all(tags + users)
+        db.session.commit()
+
+        for user in users:
+            for i in range(3):
+                db.session.add(Post(title=f"{user.first_name} post {i}",
+                                    content="content",
+                                    user=user,
+                                    tags=tags))
+        db.session.commit()
+
+        self.user_id = users[0].id
+        self.post_id = users[0].posts[0].id
+        self.tag_id = tags[0].id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+
+    def test_homepage_budget(self):
+        page_cache.clear()
+        with self.client as c, self.assertMaxQueries(2):
+            resp = c.get("/")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_list_users_budget(self):
+        with self.client as c, self.assertMaxQueries(1):
+            resp = c.get("/users")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_user_detail_budget(self):
+        with self.client as c, self.assertMaxQueries(3):
+            resp = c.get(f"/users/{self.user_id}")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_post_detail_budget(self):
+        with self.client as c, self.assertMaxQueries(4):
+            resp = c.get(f"/posts/{self.post_id}")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_edit_post_budget(self):
+        with self.client as c, self.assertMaxQueries(3):
+            resp = c.get(f"/posts/{self.post_id}/edit")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_tag_detail_budget(self):
+        with self.client as c, self.assertMaxQueries(4):
+            resp = c.get(f"/tags/{self.tag_id}")
+        self.assertEqual(resp.status_code, 200)
+
+
+######################### QUERY CHECKS #########################################
+
+class QueryCheckTestCase(TestCase):
+    """The per-request N+1 and query budget checks."""
+
+    def setUp(self):
+        clear_tables()
+
+        users = [User(first_name=f"check{i}", last_name="user")
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        db.session.add_all([Post(title=f"post {i}", content="content",
+                                 user=user)
+                            for i, user in enumerate(users)])
+        db.session.commit()
+
+        # an app with a deliberately lazy view and a budgeted one
+        self.app = create_app("testing")
+        self.app.jinja_loader = DictLoader({"lazy.html": (
+            "{% for post in posts %}\n"
+            "{{ post.title }} by {{ post.user.full_name }}\n"
+            "{% endfor %}")})
+
+        @self.app.get("/lazy")
+        def lazy():
+            db.session.expunge_all()
+            return render_template("lazy.html", posts=Post.query.all())
+
+        @self.app.get("/budget")
+        @query_budget(1)
+        def budget():
+            return str(User.query.count() + Post.query.count())
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_sql_shape(self):
+        self.assertEqual(
+            sql_shape("SELECT * FROM users\n WHERE id IN (1, 2, 3) "
+                      "AND name = 'o''brien' AND x = %(x_1)s"),
+            "SELECT * FROM users WHERE id IN (?) AND name = ? AND x = ?")
+
+    def test_n_plus_one_raises(self):
+        with self.assertRaises(QueryCheckError) as cm:
+            self.app.test_client().get("/lazy")
+
+        self.assertIn("FROM users", str(cm.exception))
+        # points at the template line doing the lazy load
+        self.assertIn("lazy.html:2", str(cm.exception))
+
+    def test_budget_raises(self):
+        with self.assertRaises(QueryCheckError) as cm:
+            self.app.test_client().get("/budget")
+
+        self.assertIn("2 statements, budget is 1", str(cm.exception))
+
+    def test_log_mode(self):
+        self.app.config['QUERY_CHECK'] = "log"
+
+        with self.assertLogs("blogly.queries", "WARNING") as logs:
+            resp = self.app.test_client().get("/lazy")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("lazy.html:2", logs.output[0])
+
+
+######################### DATA GENERATOR #######################################
+
+class DataGeneratorTestCase(TestCase):
+    """The synthetic dataset generator used for benchmarks."""
+
+    def setUp(self):
+        clear_tables()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        clear_tables()
+        db.session.commit()
+
+    def test_generate(self):
+        report = generate(users=20, tags=10, posts=300, max_tags_per_post=3,
+                          batch_size=64)
+
+        self.assertEqual(report["users"]["rows"], 20)
+        self.assertEqual(report["tags"]["rows"], 10)
+        self.assertEqual(report["posts"]["rows"], 300)
+        self.assertEqual(PostTag.query.count(), report["posts_tags"]["rows"])
+
+        # counter triggers saw every row
+        self.assertEqual(sum(u.post_count for u in User.query), 300)
+        self.assertEqual(sum(t.post_count for t in Tag.query),
+                         report["posts_tags"]["rows"])
+
+        # Zipf: the first tag is far more popular than the last
+        counts = [t.post_count for t in Tag.query.order_by(Tag.id)]
+        self.assertGreater(counts[0], 3 * counts[-1])
+
+        # a second run appends after the existing ids
+        generate(users=2, tags=1, posts=5)
+        self.assertEqual(Post.query.count(), 305)
+
+    def test_posts_need_users(self):
+        with self.assertRaises(ValueError):
+            generate(users=0, tags=0, posts=1)
+
+
+######################### EXPORT / IMPORT ######################################
+
+class BulkTransferTestCase(TestCase):
+    """flask blog export / import round trips."""
+
+    def setUp(self):
+        """Two users, one with two tagged posts."""
+
+        clear_tables()
+
+        tags = [Tag(name="bulk_a"), Tag(name="bulk_b")]
+        alice = User(first_name="Alice", last_name="Bulk")
+        bob = User(first_name="Bob", last_name="Bulk", image_url="bob.png")
+        posts = [Post(title="first", content="one, with \"quotes\"\nand lines",
+                      user=alice, tags=tags,
+                      created_at=datetime(2020, 5, 17, 8, 30)),
+                 Post(title="second", content="two", user=alice,
+                      tags=tags[:1], created_at=datetime(2021, 1, 2))]
+        db.session.add_all(tags + [alice, bob] + posts)
+        db.session.commit()
+
+        self.runner = app.test_cli_runner()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def wipe(self):
+        clear_tables()
+        db.session.commit()
+
+    def assertRestored(self, copies=1):
+        db.session.expire_all()
+        self.assertEqual(User.query.count(), 2 * copies)
+        self.assertEqual(Tag.query.count(), 2)
+        self.assertEqual(PostTag.query.count(), 3 * copies)
+
+        posts = Post.query.filter_by(title="first").all()
+        self.assertEqual(len(posts), copies)
+        for post in posts:
+            self.assertEqual(post.created_at, datetime(2020, 5, 17, 8, 30))
+            self.assertEqual(post.content, 'one, with "quotes"\nand lines')
+            self.assertEqual(post.user.first_name, "Alice")
+            self.assertEqual(post.user.post_count, 2)
+            self.assertEqual(sorted(t.name for t in post.tags),
+                             ["bulk_a", "bulk_b"])
+
+        self.assertEqual(Tag.query.filter_by(name="bulk_a").one().post_count,
+                         2 * copies)
+        self.assertEqual(
+            User.query.filter_by(first_name="Bob").first().image_url,
+            "bob.png")
+
+    def test_ndjson_round_trip(self):
+        out = io.StringIO()
+        counts = export_ndjson(out, batch_size=1)
+        self.assertEqual(counts, {"user": 2, "tag": 2, "post": 2})
+
+        self.wipe()
+        out.seek(0)
+        report = import_records(read_ndjson(out), batch_size=2)
+
+        self.assertEqual(report["post"]["rows"], 2)
+        self.assertEqual(report["post_tag"]["rows"], 3)
+        self.assertRestored()
+
+    def test_csv_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            counts = export_csv(directory)
+            self.assertEqual(counts["post_tag"], 3)
+
+            self.wipe()
+            import_records(read_csv(directory))
+
+        self.assertRestored()
+
+    def test_import_appends(self):
+        """Importing into a populated database shifts ids, reuses tags."""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dump.ndjson")
+            result = self.runner.invoke(args=["blog", "export", path])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+            result = self.runner.invoke(args=["blog", "import", path])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+        self.assertIn("0 new tags", result.output)
+        self.assertRestored(copies=2)
+
+    def test_unknown_record(self):
+        with self.assertRaises(ValueError):
+            import_records(read_ndjson(['{"type": "comment", "id": 1}']))
+
+
+######################### QUERY PLANS ##########################################
+
+@skipUnless(db.engine.dialect.name == "postgresql", "EXPLAIN checks need Postgres")
+class QueryPlanTestCase(TestCase):
+    """Every view query must be answerable from an index on a large table."""
+
+    N_USERS = 5000
+    N_TAGS = 100
+    N_POSTS = 50000
+
+    @classmethod
+    def setUpClass(cls):
+        """Seed a dataset big enough that the planner prefers indexes."""
+
+        clear_tables()
+        db.session.commit()
+
+        start = datetime(2020, 1, 1)
+        db.session.execute(insert(User), [
+            {"id": i, "first_name": f"first{i}", "last_name": f"last{i % 997}"}
+            for i in range(1, cls.N_USERS + 1)])
+        db.session.execute(insert(Tag), [
+            {"id": i, "name": f"plan_tag_{i}"}
+            for i in range(1, cls.N_TAGS + 1)])
+        db.session.execute(insert(Post), [
+            {"id": i, "title": f"post {i}", "content": "content",
+             "user_id": i % cls.N_USERS + 1,
+             "created_at": start + timedelta(minutes=i)}
+            for i in range(1, cls.N_POSTS + 1)])
+        db.session.execute(insert(PostTag), [
+            {"post_id": i, "tag_id": tag_id}
+            for i in range(1, cls.N_POSTS + 1)
+            for tag_id in {i % cls.N_TAGS + 1, i * 7 % cls.N_TAGS + 1}])
+        db.session.commit()
+
+        with db.engine.connect() as conn:
+            conn.execute(text("ANALYZE"))
+            conn.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        clear_tables()
+        db.session.commit()
+
+    def assertUsesIndexes(self, query):
+        # with the criteria the session adds, which the partial indexes need
+        statement = query.statement.options(*live_criteria())
+        compiled = statement.compile(dialect=db.engine.dialect)
+        plan = db.session.connection().exec_driver_sql(
+            "EXPLAIN " + str(compiled), compiled.params).scalars().all()
+        plan = "\n".join(plan)
+
+        for table in ("users", "posts", "posts_tags"):
+            self.assertNotIn(f"Seq Scan on {table}", plan, plan)
+
+    def test_homepage_plan(self):
+        self.assertUsesIndexes(recent_posts_query(5))
+
+    def test_list_users_plan(self):
+        self.assertUsesIndexes(
+            keyset_query(users_query(), USER_ORDER, limit=21))
+        self.assertUsesIndexes(
+            keyset_query(users_query(), USER_ORDER,
+                         values=["last500", "first500", 500], limit=21))
+
+    def test_user_posts_plan(self):
+        self.assertUsesIndexes(
+            keyset_query(user_posts_query(42), POST_ORDER,
+                         reverse=True, limit=21))
+
+    def test_tag_posts_plan(self):
+        self.assertUsesIndexes(
+            keyset_query(tag_posts_query(7), POST_ORDER,
+                         reverse=True, limit=21))
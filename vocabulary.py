@@ -0,0 +1,189 @@
+"""The tag vocabulary: every tag's id and name, cached in each process.
+
+Post forms list every tag, and post writes turn tag names into ids; both
+read this instead of the tags table. The copy is tied to the "tags" row of
+cache_versions, which triggers bump on any change to the set of tag names.
+
+A process drops its copy as soon as it commits a tag change itself, and
+notices other processes' changes by re-reading the version at most every
+TAG_CACHE_CHECK_SECONDS. resolve_tags() always re-reads it, in the writing
+transaction, so a write never picks up the id of a tag that's been deleted.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect, select
+
+from models import db, tag_ids_by_name, CacheVersion, Tag
+from replicas import reading_from_primary
+
+TagEntry = namedtuple("TagEntry", "id name")
+
+Snapshot = namedtuple("Snapshot", "version tags ids checked_at")
+
+
+class TagVocabulary:
+    """One process' copy of the tag names and ids."""
+
+    def __init__(self, check_seconds=5):
+        self.check_seconds = check_seconds
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def snapshot(self, max_age=None):
+        """The current Snapshot, re-reading the version when this copy was
+        last checked more than `max_age` seconds ago."""
+
+        if max_age is None:
+            max_age = self.check_seconds
+
+        snapshot = self._snapshot
+        now = time.monotonic()
+
+        if snapshot is None:
+            snapshot = self._load(now)
+        elif now - snapshot.checked_at >= max_age:
+            return self.check(self.read_version())
+
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    def check(self, version):
+        """The Snapshot, reloaded unless it's at `version`."""
+
+        snapshot = self._snapshot
+        now = time.monotonic()
+
+        if snapshot is not None and snapshot.version == version:
+            snapshot = snapshot._replace(checked_at=now)
+        else:
+            snapshot = self._load(now)
+
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    @property
+    def tags(self):
+        """Every tag as a TagEntry, in name order."""
+
+        return self.snapshot().tags
+
+    def invalidate(self):
+        """Forget the copy; the next use reloads it."""
+
+        with self._lock:
+            self._snapshot = None
+
+    def read_version(self):
+        """The version the session's transaction sees."""
+
+        # the copy is loaded from the primary; so is the version it's checked
+        # against, or a lagging replica would have it reloaded every time
+        with reading_from_primary():
+            return db.session.execute(
+                select(CacheVersion.version)
+                .where(CacheVersion.key == "tags")).scalar()
+
+    def _load(self, now):
+        """Read the version and every tag in one statement."""
+
+        # on a connection of its own, so the copy never holds a transaction's
+        # uncommitted tags
+        with db.engine.connect() as conn:
+            rows = conn.execute(
+                select(CacheVersion.version, Tag.id, Tag.name)
+                .select_from(CacheVersion)
+                # not an ORM session, so no automatic soft-delete filter
+                .outerjoin(Tag, Tag.deleted_at.is_(None))
+                .where(CacheVersion.key == "tags")
+                .order_by(Tag.name)).all()
+
+        version = rows[0].version if rows else None
+        tags = tuple(TagEntry(row.id, row.name)
+                     for row in rows if row.id is not None)
+        return Snapshot(version, tags, {tag.name: tag.id for tag in tags},
+                        now)
+
+
+def get_tag_vocabulary():
+    """The current app's tag vocabulary."""
+
+    return current_app.extensions['tag_vocabulary']
+
+
+def resolve_tags(names):
+    """Map tag names to ids, like tag_ids_by_name, from the vocabulary.
+
+    Names it doesn't know, such as tags added earlier in this transaction,
+    are looked up in the database; unknown names are dropped.
+    """
+
+    names = set(names)
+    if not names:
+        return {}
+
+    vocabulary = get_tag_vocabulary()
+    if vocabulary._snapshot is None:
+        # a fresh copy is as current as the version would be
+        ids = vocabulary.snapshot().ids
+    else:
+        # a transaction that changed tags itself sees a version no copy
+        # has; its names are all looked up below
+        version = vocabulary.read_version()
+        snapshot = vocabulary.check(version)
+        ids = snapshot.ids if snapshot.version == version else {}
+    found = {name: ids[name] for name in names if name in ids}
+
+    missing = names - set(found)
+    if missing:
+        found.update(tag_ids_by_name(missing))
+    return found
+
+
+def init_tag_vocabulary(app):
+    app.extensions['tag_vocabulary'] = TagVocabulary(
+        app.config['TAG_CACHE_CHECK_SECONDS'])
+
+
+############################# Invalidation ######################################
+
+def _changes_tags(session):
+    def changed(tag):
+        attrs = inspect(tag).attrs
+        return (attrs.name.history.has_changes()
+                or attrs.deleted_at.history.has_changes())
+
+    return (any(isinstance(obj, Tag) for obj in session.new)
+            or any(isinstance(obj, Tag) for obj in session.deleted)
+            or any(isinstance(obj, Tag) and changed(obj)
+                   for obj in session.dirty))
+
+
+def watch_tags(session):
+    """Drop this process' vocabulary when `session` commits a tag change."""
+
+    @event.listens_for(session, "after_flush")
+    def tags_flushed(session, flush_context):
+        if _changes_tags(session):
+            session.info['tags_changed'] = True
+
+    @event.listens_for(session, "do_orm_execute")
+    def tags_written(orm_execute_state):
+        state = orm_execute_state
+        if (not state.is_select
+                and state.bind_mapper is Tag.__mapper__):
+            state.session.info['tags_changed'] = True
+
+    @event.listens_for(session, "after_commit")
+    def forget_vocabulary(session):
+        if session.info.pop('tags_changed', False) and has_app_context():
+            get_tag_vocabulary().invalidate()
+
+    @event.listens_for(session, "after_rollback")
+    def keep_vocabulary(session):
+        session.info.pop('tags_changed', None)